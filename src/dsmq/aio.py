@@ -0,0 +1,599 @@
+"""
+An asyncio client for dsmq.
+
+Every request is tagged with an id, and the server echoes that id in its
+reply. That lets one connection have many requests in flight at once,
+from as many tasks as you like, with replies matched up as they arrive,
+in whatever order they arrive.
+
+    mq = await dsmq.aio.connect(host, port)
+    await mq.put("greetings", "hello world!")
+    msg = await mq.get("greetings", timeout=1.0)
+"""
+
+import asyncio
+from collections import deque
+from itertools import count
+from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
+from dsmq.arrays import pack_array, unpack_array
+from dsmq.codec import decode, encode
+from dsmq.retention import check_policy
+from dsmq import transport
+from dsmq.client import (
+    _closed_before_ack_error,
+    _default_host,
+    _default_port,
+    _default_max_n,
+    _initial_retry,
+    _max_errors,
+    _max_frame_size,
+    _n_retries,
+    _put_messages,
+    _put_topics,
+    _shard_poll_interval,
+    _shutdown_delay,
+)
+from dsmq.sharding import shard_of, split_topics
+from dsmq.topics import TopicTrie, check_pattern, is_pattern
+
+
+async def connect(
+    host=_default_host, port=_default_port, verbose=False, codec="binary", ack_window=0
+):
+    mq = AsyncDSMQClientSideConnection(
+        host, port, verbose=verbose, codec=codec, ack_window=ack_window
+    )
+    await mq.open()
+    if mq.shards:
+        sharded = AsyncShardedConnection(
+            mq, verbose=verbose, codec=codec, ack_window=ack_window
+        )
+        await sharded.open()
+        return sharded
+    return mq
+
+
+class AsyncDSMQClientSideConnection:
+    def __init__(self, host, port, verbose=False, codec="binary", ack_window=0):
+        self.uri = transport.to_uri(host, port)
+        self.port = port
+        self.verbose = verbose
+        self.websocket = None
+        self.preferred_codec = codec
+        self.codec = "json"
+        # Where to find the shards, if the server is sharded.
+        # See dsmq.sharding.
+        self.shards = None
+
+        self.request_ids = count()
+        # Futures for requests still waiting on a reply, {id: Future}
+        self.pending = {}
+        # The offset of the most recent message read from each topic
+        self.offsets = {}
+        # Messages pushed by the server for subscribed topics, as
+        # (topic, message) pairs, waiting to be picked up by listen().
+        self.pushed = asyncio.Queue()
+        self.callbacks = {}
+        # The topics and patterns in self.callbacks, filed by pattern
+        self.callback_patterns = TopicTrie()
+        # Errors the server sent about requests that don't get a reply,
+        # as (topic, error) pairs
+        self.errors = deque(maxlen=_max_errors)
+
+        # With acks turned on, puts waiting on an ack, {seq: request},
+        # and those that failed, as (topic, message, error) for flush().
+        # `ack_window` puts can be waiting at once.
+        self.ack_window = ack_window
+        self.put_seqs = count()
+        self.unacked = {}
+        self.failed_puts = []
+        self.ack_slots = asyncio.Semaphore(max(ack_window, 1))
+        self.all_acked = asyncio.Event()
+        self.all_acked.set()
+        self.reader = None
+
+    async def open(self):
+        if self.verbose:
+            print(f"Connecting to dsmq server at {self.uri}")
+        for i_retry in range(_n_retries):
+            try:
+                self.websocket = await transport.connect_async(
+                    self.uri, max_size=_max_frame_size
+                )
+                break
+            except ConnectionRefusedError:
+                # Exponential backoff
+                # Wait twice as long each time before trying again.
+                await asyncio.sleep(_initial_retry * 2**i_retry)
+                if self.verbose:
+                    print("    ...trying again")
+
+        if self.websocket is None:
+            raise ConnectionRefusedError("Could not connect to dsmq server.")
+
+        msg = {
+            "action": "hello",
+            "topic": "",
+            "codecs": [self.preferred_codec, "json"],
+        }
+        await self.websocket.send(encode(msg, "json"))
+        reply = decode(await self.websocket.recv())
+        self.codec = reply["codec"]
+        self.shards = reply.get("shards")
+
+        self.reader = asyncio.create_task(self._read_replies())
+
+    async def get(self, topic, timeout=None, from_offset=None, group=None):
+        """
+        Get the oldest unread message in `topic`.
+        If there isn't one and `timeout` (seconds) is given, the server
+        holds the request open and replies as soon as a message is put,
+        or with "" once the timeout runs out.
+        With `from_offset`, get the oldest message at or after that offset
+        instead, and carry on reading from there.
+        With `group`, read as a member of that consumer group,
+        so that each message goes to just one member.
+        """
+        msg = {"action": "get", "topic": topic}
+        if timeout:
+            msg["timeout"] = timeout
+        if from_offset is not None:
+            msg["from_offset"] = from_offset
+        if group is not None:
+            msg["group"] = group
+        reply = await self._request(msg)
+        if reply is None:
+            return ""
+        self._record_offset(topic, reply.get("offset"))
+        return reply["message"]
+
+    async def get_any(self, topics, timeout=None):
+        """
+        Get the oldest unread message in any of `topics`.
+        Returns (topic, message), or (None, "") if there wasn't one.
+        """
+        msg = {"action": "get_any", "topic": "", "topics": list(topics)}
+        if timeout:
+            msg["timeout"] = timeout
+        reply = await self._request(msg)
+        if reply is None:
+            return None, ""
+        self._record_offset(reply["topic"], reply["offset"])
+        return reply["topic"], reply["message"]
+
+    async def get_all(self, topics):
+        msg = {"action": "get_all", "topic": "", "topics": list(topics)}
+        reply = await self._request(msg)
+        if reply is None:
+            return {topic: "" for topic in topics}
+        for topic, offset in reply["offsets"].items():
+            self._record_offset(topic, offset)
+        return reply["messages"]
+
+    async def get_array(self, topic, timeout=None, from_offset=None, group=None):
+        message = await self.get(
+            topic, timeout=timeout, from_offset=from_offset, group=group
+        )
+        if message == "":
+            return None
+        return unpack_array(message)
+
+    async def get_many(self, topic, max_n=_default_max_n, from_offset=None, group=None):
+        msg = {"action": "get_many", "topic": topic, "max_n": max_n}
+        if from_offset is not None:
+            msg["from_offset"] = from_offset
+        if group is not None:
+            msg["group"] = group
+        reply = await self._request(msg)
+        if reply is None:
+            return []
+        self._record_offset(topic, reply.get("offset"))
+        return reply["messages"]
+
+    async def get_many_topics(self, topics, max_n=_default_max_n):
+        msg = {
+            "action": "get_many_topics",
+            "topic": "",
+            "topics": list(topics),
+            "max_n": max_n,
+        }
+        reply = await self._request(msg)
+        if reply is None:
+            return {topic: [] for topic in topics}
+        for topic, offset in reply.get("offsets", {}).items():
+            self._record_offset(topic, offset)
+        return reply["messages"]
+
+    async def get_latest(self, topic):
+        reply = await self._request({"action": "get_latest", "topic": topic})
+        if reply is None:
+            return ""
+        self._record_offset(topic, reply.get("offset"))
+        return reply["message"]
+
+    async def get_latest_many(self, topics):
+        msg = {"action": "get_latest_many", "topic": "", "topics": list(topics)}
+        reply = await self._request(msg)
+        if reply is None:
+            return {topic: "" for topic in topics}
+        for topic, offset in reply["offsets"].items():
+            self._record_offset(topic, offset)
+        return reply["messages"]
+
+    async def get_wait(self, topic):
+        return await self.get(topic, timeout=_initial_retry * (2**_n_retries - 1))
+
+    async def put(self, topic, msg_body):
+        await self._send_put({"action": "put", "topic": topic, "message": msg_body})
+
+    async def put_array(self, topic, array):
+        await self.put(topic, pack_array(array))
+
+    async def put_many(self, topic, msg_bodies):
+        await self._send_put(
+            {"action": "put_many", "topic": topic, "messages": list(msg_bodies)}
+        )
+
+    async def put_many_topics(self, msg_bodies_by_topic):
+        await self._send_put(
+            {
+                "action": "put_many_topics",
+                "topic": "",
+                "messages": {
+                    topic: list(msg_bodies)
+                    for topic, msg_bodies in msg_bodies_by_topic.items()
+                },
+            }
+        )
+
+    async def flush(self, timeout=None):
+        """
+        With acks turned on, wait until the server has acknowledged
+        every put so far, or until `timeout` seconds have passed.
+        Returns a list of (topic, message, error) for each message that
+        the server couldn't store since the last flush().
+        """
+        try:
+            await asyncio.wait_for(self.all_acked.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        failed_puts = self.failed_puts
+        self.failed_puts = []
+        return failed_puts
+
+    async def set_retention(self, topic, **policy):
+        check_policy(policy)
+        await self._send({"action": "set_retention", "topic": topic, "policy": policy})
+
+    async def get_evictions(self):
+        reply = await self._request({"action": "get_evictions", "topic": ""})
+        if reply is None:
+            return {}
+        return reply["evictions"]
+
+    async def get_memory_usage(self):
+        reply = await self._request({"action": "get_memory_usage", "topic": ""})
+        if reply is None:
+            return {}
+        reply.pop("id")
+        return reply
+
+    async def subscribe(self, topic, callback=None):
+        """
+        Have the server push every new message in `topic` to this client.
+        `topic` can also be a pattern, like "robot1/arm/*".
+        If `callback` is given, it is called with each pushed message
+        as it arrives. Otherwise pushed messages are collected for `listen()`.
+        """
+        check_pattern(topic)
+        if callback is not None:
+            self.callbacks[topic] = callback
+            self.callback_patterns.add(topic, topic)
+        await self._send({"action": "subscribe", "topic": topic})
+
+    async def unsubscribe(self, topic):
+        self.callbacks.pop(topic, None)
+        self.callback_patterns.discard(topic, topic)
+        await self._send({"action": "unsubscribe", "topic": topic})
+
+    async def listen(self, timeout=None):
+        """
+        Iterate over (topic, message) pairs pushed from subscribed topics,
+        as they arrive. Stop after `timeout` seconds pass with nothing new,
+        or never if `timeout` is None.
+        """
+        while True:
+            try:
+                yield await asyncio.wait_for(self.pushed.get(), timeout)
+            except asyncio.TimeoutError:
+                return
+
+    async def shutdown_server(self):
+        await self._send({"action": "shutdown", "topic": ""})
+        # Give the server time to wind down
+        await asyncio.sleep(_shutdown_delay)
+
+    async def close(self):
+        await self.websocket.close()
+        if self.reader is not None:
+            await self.reader
+        # Give the websocket time to wind down
+        await asyncio.sleep(_shutdown_delay)
+
+    async def _send(self, msg):
+        try:
+            await self.websocket.send(encode(msg, self.codec))
+        except (ConnectionClosedError, ConnectionClosedOK):
+            return
+
+    async def _send_put(self, msg):
+        if self.ack_window:
+            await self.ack_slots.acquire()
+            if self.reader is not None and self.reader.done():
+                # The connection is already closed. No ack will come.
+                self.ack_slots.release()
+                self._fail_put(msg, _closed_before_ack_error)
+                return
+            msg["seq"] = next(self.put_seqs)
+            self.unacked[msg["seq"]] = msg
+            self.all_acked.clear()
+        await self._send(msg)
+
+    def _handle_ack(self, msg):
+        try:
+            put_msg = self.unacked.pop(msg["seq"])
+        except KeyError:
+            return
+        self.ack_slots.release()
+        for topic, error in msg["errors"].items():
+            for message in _put_messages(put_msg, topic):
+                self.failed_puts.append((topic, message, error))
+        if not self.unacked:
+            self.all_acked.set()
+
+    def _fail_put(self, msg, error):
+        for topic in _put_topics(msg):
+            for message in _put_messages(msg, topic):
+                self.failed_puts.append((topic, message, error))
+
+    async def _request(self, msg):
+        """
+        Send a request and wait for its reply.
+        Returns the reply dict, or None if the connection closed first.
+        """
+        if self.reader.done():
+            # The connection is already closed. No reply will come.
+            return None
+        request_id = next(self.request_ids)
+        msg["id"] = request_id
+        reply_future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = reply_future
+        try:
+            await self.websocket.send(encode(msg, self.codec))
+        except (ConnectionClosedError, ConnectionClosedOK):
+            self.pending.pop(request_id, None)
+            return None
+        return await reply_future
+
+    async def _read_replies(self):
+        try:
+            async for msg_text in self.websocket:
+                msg = decode(msg_text)
+                if "id" in msg:
+                    try:
+                        self.pending.pop(msg["id"]).set_result(msg)
+                    except KeyError:
+                        pass
+                elif msg.get("action") == "push":
+                    self._handle_pushed(msg)
+                elif msg.get("action") == "error":
+                    self.errors.append((msg["topic"], msg["error"]))
+                elif msg.get("action") == "ack":
+                    self._handle_ack(msg)
+        except (ConnectionClosedError, ConnectionClosedOK):
+            pass
+
+        # Nothing else is coming. Don't leave anyone waiting.
+        for reply_future in self.pending.values():
+            if not reply_future.done():
+                reply_future.set_result(None)
+        self.pending = {}
+        for put_msg in self.unacked.values():
+            self.ack_slots.release()
+            self._fail_put(put_msg, _closed_before_ack_error)
+        self.unacked = {}
+        self.all_acked.set()
+
+    def _record_offset(self, topic, offset):
+        if offset is not None:
+            self.offsets[topic] = offset
+
+    def _handle_pushed(self, msg):
+        topic = msg["topic"]
+        self._record_offset(topic, msg.get("offset"))
+        patterns = self.callback_patterns.match(topic)
+        if not patterns:
+            self.pushed.put_nowait((topic, msg["message"]))
+        for pattern in patterns:
+            self.callbacks[pattern](msg["message"])
+
+
+class AsyncShardedConnection:
+    """
+    The asyncio counterpart to dsmq.client.ShardedConnection.
+    Requests for several topics go out to their shards all at once.
+    """
+
+    def __init__(self, front, verbose=False, codec="binary", ack_window=0):
+        self.front = front
+        self.shards = [
+            AsyncDSMQClientSideConnection(
+                uri, None, verbose=verbose, codec=codec, ack_window=ack_window
+            )
+            for uri in front.shards
+        ]
+        # Messages pushed from every shard, for listen()
+        self.pushed = asyncio.Queue()
+        for shard in self.shards:
+            shard.pushed = self.pushed
+
+    async def open(self):
+        await asyncio.gather(*[shard.open() for shard in self.shards])
+
+    @property
+    def offsets(self):
+        return {
+            topic: offset
+            for shard in self.shards
+            for topic, offset in shard.offsets.items()
+        }
+
+    @property
+    def errors(self):
+        return [error for shard in self.shards for error in shard.errors]
+
+    async def get(self, topic, timeout=None, from_offset=None, group=None):
+        return await self._shard(topic).get(
+            topic, timeout=timeout, from_offset=from_offset, group=group
+        )
+
+    async def get_any(self, topics, timeout=None):
+        topics_by_shard = split_topics(topics, len(self.shards))
+        if len(topics_by_shard) == 1:
+            ((i_shard, shard_topics),) = topics_by_shard.items()
+            return await self.shards[i_shard].get_any(shard_topics, timeout=timeout)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or 0)
+        while True:
+            for i_shard, shard_topics in topics_by_shard.items():
+                topic, message = await self.shards[i_shard].get_any(shard_topics)
+                if topic is not None:
+                    return topic, message
+            if loop.time() >= deadline:
+                return None, ""
+            await asyncio.sleep(_shard_poll_interval)
+
+    async def get_all(self, topics):
+        return await self._merge("get_all", topics)
+
+    async def get_array(self, topic, timeout=None, from_offset=None, group=None):
+        return await self._shard(topic).get_array(
+            topic, timeout=timeout, from_offset=from_offset, group=group
+        )
+
+    async def get_many(self, topic, max_n=_default_max_n, from_offset=None, group=None):
+        return await self._shard(topic).get_many(
+            topic, max_n=max_n, from_offset=from_offset, group=group
+        )
+
+    async def get_many_topics(self, topics, max_n=_default_max_n):
+        return await self._merge("get_many_topics", topics, max_n=max_n)
+
+    async def get_latest(self, topic):
+        return await self._shard(topic).get_latest(topic)
+
+    async def get_latest_many(self, topics):
+        return await self._merge("get_latest_many", topics)
+
+    async def get_wait(self, topic):
+        return await self._shard(topic).get_wait(topic)
+
+    async def put(self, topic, msg_body):
+        await self._shard(topic).put(topic, msg_body)
+
+    async def put_array(self, topic, array):
+        await self._shard(topic).put_array(topic, array)
+
+    async def put_many(self, topic, msg_bodies):
+        await self._shard(topic).put_many(topic, msg_bodies)
+
+    async def put_many_topics(self, msg_bodies_by_topic):
+        topics_by_shard = split_topics(msg_bodies_by_topic, len(self.shards))
+        await asyncio.gather(
+            *[
+                self.shards[i_shard].put_many_topics(
+                    {topic: msg_bodies_by_topic[topic] for topic in shard_topics}
+                )
+                for i_shard, shard_topics in topics_by_shard.items()
+            ]
+        )
+
+    async def flush(self, timeout=None):
+        failed_puts = await asyncio.gather(
+            *[shard.flush(timeout) for shard in self.shards]
+        )
+        return [
+            failed_put for shard_failed in failed_puts for failed_put in shard_failed
+        ]
+
+    async def set_retention(self, topic, **policy):
+        shards = self.shards if topic == "*" else [self._shard(topic)]
+        for shard in shards:
+            await shard.set_retention(topic, **policy)
+
+    async def get_evictions(self):
+        evictions = {}
+        for shard_evictions in await asyncio.gather(
+            *[shard.get_evictions() for shard in self.shards]
+        ):
+            evictions |= shard_evictions
+        return evictions
+
+    async def get_memory_usage(self):
+        usage = {"total": 0, "budget": None, "topics": {}}
+        for shard_usage in await asyncio.gather(
+            *[shard.get_memory_usage() for shard in self.shards]
+        ):
+            # Empty if the shard's connection has closed
+            usage["total"] += shard_usage.get("total", 0)
+            if shard_usage.get("budget") is not None:
+                usage["budget"] = (usage["budget"] or 0) + shard_usage["budget"]
+            usage["topics"] |= shard_usage.get("topics", {})
+        return usage
+
+    async def subscribe(self, topic, callback=None):
+        for shard in self._shards_for(topic):
+            await shard.subscribe(topic, callback=callback)
+
+    async def unsubscribe(self, topic):
+        for shard in self._shards_for(topic):
+            await shard.unsubscribe(topic)
+
+    async def listen(self, timeout=None):
+        while True:
+            try:
+                yield await asyncio.wait_for(self.pushed.get(), timeout)
+            except asyncio.TimeoutError:
+                return
+
+    async def shutdown_server(self):
+        await self.front.shutdown_server()
+
+    async def close(self):
+        await asyncio.gather(*[shard.close() for shard in self.shards])
+        await self.front.close()
+
+    def _shard(self, topic):
+        return self.shards[shard_of(topic, len(self.shards))]
+
+    def _shards_for(self, topic):
+        if is_pattern(topic):
+            return self.shards
+        return [self._shard(topic)]
+
+    async def _merge(self, method, topics, **kwargs):
+        """
+        Split a request for several `topics` between the shards,
+        and merge the dicts they return.
+        """
+        topics_by_shard = split_topics(topics, len(self.shards))
+        merged = {}
+        for shard_reply in await asyncio.gather(
+            *[
+                getattr(self.shards[i_shard], method)(shard_topics, **kwargs)
+                for i_shard, shard_topics in topics_by_shard.items()
+            ]
+        ):
+            merged |= shard_reply
+        return merged
@@ -0,0 +1,74 @@
+"""
+Pack NumPy arrays into dsmq messages and back out again.
+
+An array message is bytes with three parts:
+- a 4-byte, big-endian length of the header,
+- the header, JSON with the array's dtype and shape, and
+- the array's raw data buffer.
+
+Packing doesn't copy the data. It hands back a tuple of parts that the
+codec joins straight into the outgoing frame. Unpacking doesn't copy
+either. The array is a view onto the received message with
+np.frombuffer, which makes it read-only.
+
+NumPy is only imported when an array is packed or unpacked, so dsmq
+doesn't need it installed otherwise.
+"""
+
+import json
+
+_header_size_bytes = 4
+_byteorder = "big"
+
+
+def pack_array(array):
+    """
+    Returns a tuple of bytes-like parts that make up the array message.
+    """
+    import numpy as np
+
+    array = np.asarray(array, order="C")
+    if array.dtype.hasobject:
+        raise TypeError("Arrays of Python objects can't be sent as raw bytes.")
+
+    header = {
+        "dtype": np.lib.format.dtype_to_descr(array.dtype),
+        "shape": array.shape,
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+    return (
+        len(header_bytes).to_bytes(_header_size_bytes, _byteorder),
+        header_bytes,
+        array.data,
+    )
+
+
+def unpack_array(message):
+    """
+    Returns the array held in `message`, a bytes-like array message.
+    """
+    import numpy as np
+
+    message = memoryview(message)
+    header_size = int.from_bytes(message[:_header_size_bytes], _byteorder)
+    i_data = _header_size_bytes + header_size
+    header = json.loads(bytes(message[_header_size_bytes:i_data]))
+
+    dtype = np.lib.format.descr_to_dtype(_to_tuples(header["dtype"]))
+    return np.frombuffer(message, dtype=dtype, offset=i_data).reshape(header["shape"])
+
+
+def _to_tuples(descr):
+    """
+    Structured dtype descriptions are lists of tuples,
+    which come back from JSON as lists of lists.
+    """
+    if not isinstance(descr, list):
+        return descr
+    fields = []
+    for name, field_descr, *shape in descr:
+        if shape:
+            fields.append((name, _to_tuples(field_descr), tuple(shape[0])))
+        else:
+            fields.append((name, _to_tuples(field_descr)))
+    return fields
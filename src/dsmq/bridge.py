@@ -0,0 +1,224 @@
+"""
+Mirroring topics from one dsmq server onto another, for deployments
+with a server on each machine and a few topics that have to cross between.
+
+serve(bridges={uri: topics}) has the server pass each new message in
+`topics` on to the server at `uri`, where it's put into the same topic.
+`topics` can include patterns, like "robot1/**". See dsmq.topics.
+
+Each bridge keeps one connection open to the other server. Whatever
+messages pile up while it waits for the other server to acknowledge
+one batch go out together as the next, in a single put_many_topics
+request. The busier the topics, the more messages share each round trip.
+If the connection drops, the bridge reconnects and sends the
+unacknowledged batch again, so a message can arrive twice, but isn't lost
+unless the backlog overflows while the other server is unreachable,
+or the other server rejects it, say for being over its memory budget.
+Messages lost either way are counted, and rejections are kept in `errors`.
+
+If the other server is sharded, the bridge connects to each of its shards
+and sends each topic's messages to the shard that owns it,
+just as a client would. See dsmq.sharding.
+
+Every server has a random id. A bridged put carries "via", the ids of every
+server its messages have passed through. A bridge never sends a message
+to a server that's already in its "via", so two servers can bridge the same
+topics to each other, or a ring of them can, without messages
+going round in circles.
+"""
+
+from collections import deque
+from itertools import count
+import queue
+from threading import Event, Thread
+from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
+from dsmq.codec import codecs, decode, encode
+from dsmq.sharding import split_topics
+from dsmq.topics import TopicTrie
+from dsmq import transport
+
+_max_backlog = 100_000  # messages
+_max_batch_size = 1000  # messages
+_initial_retry = 0.01  # seconds
+_max_retry = 1.0  # seconds
+_max_frame_size = 2**28  # bytes
+_max_errors = 100
+
+
+class Bridge:
+    def __init__(self, uri, topics, server_id):
+        self.uri = uri
+        self.server_id = server_id
+        self.topics = TopicTrie()
+        for topic in topics:
+            self.topics.add(topic, topic)
+
+        # Messages waiting to be sent, as (topic, message, via)
+        self.backlog = queue.Queue(maxsize=_max_backlog)
+        # How many messages were dropped because the backlog was full
+        self.n_dropped = 0
+        # How many messages the other server wouldn't store, and the most
+        # recent reasons it gave, as (topic, error) pairs
+        self.n_rejected = 0
+        self.errors = deque(maxlen=_max_errors)
+        # One link to the other server, or one to each of its shards
+        self.links = []
+        self.seqs = count()
+        self.stopping = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Send what's already in the backlog, then close the connection.
+        """
+        self.stopping.set()
+        try:
+            self.backlog.put_nowait(None)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+
+    def forward(self, topic, message, via=()):
+        """
+        Called from the put path. Queue up `message` to be sent
+        if `topic` is one of the bridged topics.
+        """
+        if not self.topics.match(topic):
+            return
+        try:
+            self.backlog.put_nowait((topic, message, via))
+        except queue.Full:
+            self.n_dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self.backlog.get()]
+            while len(batch) < _max_batch_size:
+                try:
+                    batch.append(self.backlog.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                self._send([record for record in batch if record is not None])
+                break
+            self._send(batch)
+
+        self._disconnect()
+
+    def _send(self, batch):
+        """
+        Send each group of messages that took the same path here
+        as one request to each server they're bound for,
+        and wait for it to be acknowledged.
+        """
+        if not batch or not self._connect():
+            return
+        messages_by_via = {}
+        for topic, message, via in batch:
+            messages_by_topic = messages_by_via.setdefault(tuple(via), {})
+            messages_by_topic.setdefault(topic, []).append(message)
+
+        for via, messages_by_topic in messages_by_via.items():
+            topics_by_link = split_topics(messages_by_topic, len(self.links))
+            for i_link, topics in topics_by_link.items():
+                if self.links[i_link].remote_id in via:
+                    # They've been there already.
+                    continue
+                msg = {
+                    "action": "put_many_topics",
+                    "topic": "",
+                    "messages": {topic: messages_by_topic[topic] for topic in topics},
+                    "via": [*via, self.server_id],
+                }
+                if not self._send_to(i_link, msg):
+                    return
+
+    def _send_to(self, i_link, msg):
+        """
+        Send `msg` over link `i_link`, reconnecting and sending it again
+        until it's acknowledged. Returns False if the bridge was stopped
+        before that could happen.
+        """
+        while True:
+            link = self.links[i_link]
+            msg["seq"] = next(self.seqs)
+            try:
+                link.connection.send(encode(msg, link.codec))
+                self._wait_for_ack(link, msg)
+                return True
+            except (ConnectionClosedError, ConnectionClosedOK):
+                self._disconnect()
+                if not self._connect():
+                    return False
+
+    def _wait_for_ack(self, link, msg):
+        while True:
+            reply = decode(link.connection.recv())
+            if reply.get("action") == "ack" and reply["seq"] == msg["seq"]:
+                for topic, error in reply["errors"].items():
+                    self._rejected(msg["messages"][topic], topic, error)
+                return
+            if reply.get("action") == "error":
+                # Errors come instead of an ack, not as well as one.
+                for topic, messages in msg["messages"].items():
+                    self._rejected(messages, topic, reply["error"])
+                return
+
+    def _rejected(self, messages, topic, error):
+        self.n_rejected += len(messages)
+        self.errors.append((topic, error))
+
+    def _connect(self):
+        """
+        Keep trying until connected to the other server, or to each of its
+        shards, backing off a little more each time. Returns False if the
+        bridge was stopped before it could connect.
+        """
+        retry = _initial_retry
+        while not self.links:
+            try:
+                link = _Link(self.uri)
+                if link.shard_uris:
+                    link.close()
+                    for shard_uri in link.shard_uris:
+                        self.links.append(_Link(shard_uri))
+                else:
+                    self.links.append(link)
+            except (OSError, ConnectionClosedError, ConnectionClosedOK):
+                self._disconnect()
+                if self.stopping.wait(retry):
+                    return False
+                retry = min(2 * retry, _max_retry)
+        return True
+
+    def _disconnect(self):
+        for link in self.links:
+            link.close()
+        self.links = []
+
+
+class _Link:
+    """
+    A connection to one server, or one shard of a sharded server.
+    """
+
+    def __init__(self, uri):
+        self.connection = transport.connect(uri, max_size=_max_frame_size)
+        try:
+            hello = {"action": "hello", "topic": "", "codecs": codecs}
+            self.connection.send(encode(hello, "json"))
+            reply = decode(self.connection.recv())
+        except (ConnectionClosedError, ConnectionClosedOK):
+            self.connection.close()
+            raise
+        self.codec = reply["codec"]
+        # The server's id, for telling where messages have already been
+        self.remote_id = reply.get("server_id")
+        # Where the shards are, if the server is sharded
+        self.shard_uris = reply.get("shards")
+
+    def close(self):
+        self.connection.close()
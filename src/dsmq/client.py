@@ -1,7 +1,22 @@
-import json
+from collections import deque
+from contextlib import contextmanager
+from itertools import count
+import queue
+from threading import Condition, Event, Thread
 import time
-from websockets.sync.client import connect as ws_connect
-from websockets.exceptions import ConnectionClosedError
+from websockets.exceptions import (
+    ConnectionClosed,
+    ConnectionClosedError,
+    ConnectionClosedOK,
+)
+from dsmq.arrays import pack_array, unpack_array
+from dsmq.codec import decode, encode
+from dsmq.retention import check_policy
+from dsmq import transport
+from dsmq.shared import SharedRing, _default_n_slots, _default_slot_size
+from dsmq.sharding import shard_of, split_topics
+from dsmq.storage import message_size
+from dsmq.topics import TopicTrie, check_pattern, is_pattern
 
 _default_host = "127.0.0.1"
 _default_port = 30008
@@ -9,22 +24,49 @@ _default_port = 30008
 _n_retries = 10
 _initial_retry = 0.01  # seconds
 _shutdown_delay = 0.1  # seconds
+_max_frame_size = 2**28  # bytes
+_default_max_n = 100  # messages per get_many
+_shared_poll_interval = 0.0001  # seconds
+_max_errors = 100
+_shard_poll_interval = 0.001  # seconds
+_default_linger = 0.001  # seconds
+_default_max_batch_n = 1000  # messages
+_default_max_batch_bytes = 2**20  # bytes
+_default_min_depth = 10  # messages
+_default_max_depth = 1000  # messages
+# Prefetch enough messages to last this long at the current rate.
+_prefetch_horizon = 0.01  # seconds
+_rate_smoothing = 0.5
+# How long a prefetch waits on the server when the topic has run dry
+_idle_wait = 0.1  # seconds
+_default_pool_size = 4  # connections
+_max_reconnect_retry = 1.0  # seconds
+_closed_before_ack_error = "The connection closed before the put was acknowledged."
 
 
-def connect(host=_default_host, port=_default_port, verbose=False):
-    return DSMQClientSideConnection(host, port, verbose=verbose)
+def connect(
+    host=_default_host, port=_default_port, verbose=False, codec="binary", ack_window=0
+):
+    mq = DSMQClientSideConnection(
+        host, port, verbose=verbose, codec=codec, ack_window=ack_window
+    )
+    if mq.shards:
+        return ShardedConnection(
+            mq, verbose=verbose, codec=codec, ack_window=ack_window
+        )
+    return mq
 
 
 class DSMQClientSideConnection:
-    def __init__(self, host, port, verbose=False):
-        self.uri = f"ws://{host}:{port}"
+    def __init__(self, host, port, verbose=False, codec="binary", ack_window=0):
+        self.uri = transport.to_uri(host, port)
         self.port = port
         self.verbose = verbose
         if self.verbose:
             print(f"Connecting to dsmq server at {self.uri}")
         for i_retry in range(_n_retries):
             try:
-                self.websocket = ws_connect(self.uri)
+                self.websocket = transport.connect(self.uri, max_size=_max_frame_size)
                 break
             except ConnectionRefusedError:
                 self.websocket = None
@@ -39,22 +81,227 @@ class DSMQClientSideConnection:
 
         self.time_of_last_request = time.time()
 
-    def get(self, topic):
+        # The offset of the most recent message read from each topic,
+        # {topic: int}. Pass one to get(from_offset=...) to read from there.
+        self.offsets = {}
+
+        # Messages pushed by the server for subscribed topics, as
+        # (topic, message) pairs, waiting to be picked up by listen().
+        self.pushed = deque()
+        self.callbacks = {}
+        # The topics and patterns in self.callbacks, filed by pattern
+        self.callback_patterns = TopicTrie()
+        # Errors the server sent about requests that don't get a reply,
+        # like puts rejected for going over the server's memory budget,
+        # as (topic, error) pairs
+        self.errors = deque(maxlen=_max_errors)
+
+        # With acks turned on, each put gets a sequence number, and waits in
+        # `unacked`, {seq: request}, until the server acknowledges it.
+        # Those that fail are kept as (topic, message, error) for flush().
+        self.ack_window = ack_window
+        self.put_seqs = count()
+        self.unacked = {}
+        self.failed_puts = []
+
+        # Shared memory rings for topics passed through share(), {topic: ring},
+        # and the sequence number of the next message to read from each.
+        self.shared = {}
+        self.shared_cursors = {}
+        # The shared topics this client has been cleared to put into
+        self.shared_writable = set()
+
+        # Where to find the shards, if the server is sharded.
+        # See dsmq.sharding.
+        self.shards = None
+        self.codec = self._negotiate_codec(codec)
+
+    def get(self, topic, timeout=None, from_offset=None, group=None):
+        """
+        Get the oldest unread message in `topic`.
+        If there isn't one and `timeout` (seconds) is given, the server
+        holds the request open and replies as soon as a message is put,
+        or with "" once the timeout runs out.
+
+        With `from_offset`, get the oldest message at or after that offset
+        instead, and carry on reading from there. Messages can be replayed
+        this way, as long as the server still holds them.
+
+        With `group`, read as a member of that consumer group. Each message
+        goes to just one member, the first to ask for it, so several clients
+        can split the work in a topic between them. The group has
+        one read cursor, shared by all its members.
+
+        Messages that were put as bytes come back as a memoryview.
+        """
+        if topic in self.shared:
+            _check_no_group(topic, group)
+            self._seek_shared(topic, from_offset)
+            return self._get_shared(topic, timeout=timeout)
+
         msg = {"action": "get", "topic": topic}
+        if timeout:
+            msg["timeout"] = timeout
+        if from_offset is not None:
+            msg["from_offset"] = from_offset
+        if group is not None:
+            msg["group"] = group
         try:
-            self.websocket.send(json.dumps(msg))
+            self.websocket.send(encode(msg, self.codec))
         except ConnectionClosedError:
             return ""
 
         try:
-            msg_text = self.websocket.recv()
+            msg = self._recv_reply()
         except ConnectionClosedError:
             self.close()
             return ""
 
-        msg = json.loads(msg_text)
+        self._record_offset(topic, msg.get("offset"))
         return msg["message"]
 
+    def get_any(self, topics, timeout=None):
+        """
+        Get the oldest unread message in any of `topics`,
+        in a single round trip. `timeout` works as it does in get(),
+        with the server replying as soon as a message is put in any of them.
+        Shared topics are checked first, without waiting.
+        Returns (topic, message), or (None, "") if there wasn't one.
+        """
+        for topic in topics:
+            if topic in self.shared:
+                message = self._get_shared(topic)
+                if message != "":
+                    return topic, message
+        topics = [topic for topic in topics if topic not in self.shared]
+        if not topics:
+            return None, ""
+
+        msg = {"action": "get_any", "topic": "", "topics": topics}
+        if timeout:
+            msg["timeout"] = timeout
+        try:
+            self.websocket.send(encode(msg, self.codec))
+        except ConnectionClosedError:
+            return None, ""
+
+        try:
+            msg = self._recv_reply()
+        except ConnectionClosedError:
+            self.close()
+            return None, ""
+
+        self._record_offset(msg["topic"], msg["offset"])
+        return msg["topic"], msg["message"]
+
+    def get_all(self, topics):
+        """
+        Get the oldest unread message in each of `topics`,
+        in a single round trip.
+        Returns a dict of {topic: message}, with "" for topics that
+        have nothing unread.
+        """
+        messages = {
+            topic: self._get_shared(topic) for topic in topics if topic in self.shared
+        }
+        topics = [topic for topic in topics if topic not in self.shared]
+        if not topics:
+            return messages
+
+        msg = {"action": "get_all", "topic": "", "topics": topics}
+        try:
+            self.websocket.send(encode(msg, self.codec))
+        except ConnectionClosedError:
+            return messages | {topic: "" for topic in topics}
+
+        try:
+            msg = self._recv_reply()
+        except ConnectionClosedError:
+            self.close()
+            return messages | {topic: "" for topic in topics}
+
+        for topic, offset in msg["offsets"].items():
+            self._record_offset(topic, offset)
+        return messages | msg["messages"]
+
+    def get_array(self, topic, timeout=None, from_offset=None, group=None):
+        """
+        Get the oldest unread message in `topic`, which must have been
+        put with `put_array()`, as a NumPy array.
+        The array is a read-only view onto the received message,
+        with no copying. Returns None if there was no message.
+        """
+        message = self.get(topic, timeout=timeout, from_offset=from_offset, group=group)
+        if message == "":
+            return None
+        return unpack_array(message)
+
+    def get_many(self, topic, max_n=_default_max_n, from_offset=None, group=None):
+        """
+        Get up to `max_n` of the oldest unread messages in `topic`,
+        oldest first, in a single round trip.
+        `from_offset` and `group` work as they do in get().
+        Returns a list of messages, which is empty if there were none.
+        """
+        if topic in self.shared:
+            _check_no_group(topic, group)
+            self._seek_shared(topic, from_offset)
+            return self._get_many_shared(topic, max_n)
+
+        msg = {"action": "get_many", "topic": topic, "max_n": max_n}
+        if from_offset is not None:
+            msg["from_offset"] = from_offset
+        if group is not None:
+            msg["group"] = group
+        try:
+            self.websocket.send(encode(msg, self.codec))
+        except ConnectionClosedError:
+            return []
+
+        try:
+            msg = self._recv_reply()
+        except ConnectionClosedError:
+            self.close()
+            return []
+
+        self._record_offset(topic, msg.get("offset"))
+        return msg["messages"]
+
+    def get_many_topics(self, topics, max_n=_default_max_n):
+        """
+        `get_many()` for several topics at once, in a single round trip.
+        Returns a dict of {topic: list of messages}.
+        """
+        messages = {
+            topic: self._get_many_shared(topic, max_n)
+            for topic in topics
+            if topic in self.shared
+        }
+        topics = [topic for topic in topics if topic not in self.shared]
+        if not topics:
+            return messages
+
+        msg = {
+            "action": "get_many_topics",
+            "topic": "",
+            "topics": topics,
+            "max_n": max_n,
+        }
+        try:
+            self.websocket.send(encode(msg, self.codec))
+        except ConnectionClosedError:
+            return messages | {topic: [] for topic in topics}
+
+        try:
+            msg = self._recv_reply()
+        except ConnectionClosedError:
+            self.close()
+            return messages | {topic: [] for topic in topics}
+
+        for topic, offset in msg.get("offsets", {}).items():
+            self._record_offset(topic, offset)
+        return messages | msg["messages"]
+
     def get_latest(self, topic):
         """
         A variant of `get()` that grabs the latest available message
@@ -62,49 +309,1014 @@ class DSMQClientSideConnection:
         It will not go back to read older ones on subsequent calls;
         it will leave them unread.
         """
+        if topic in self.shared:
+            return self._get_shared(topic, latest=True)
+
         msg = {"action": "get_latest", "topic": topic}
         try:
-            self.websocket.send(json.dumps(msg))
+            self.websocket.send(encode(msg, self.codec))
         except ConnectionClosedError:
             return ""
 
         try:
-            msg_text = self.websocket.recv()
+            msg = self._recv_reply()
         except ConnectionClosedError:
             self.close()
             return ""
 
-        msg = json.loads(msg_text)
-
+        self._record_offset(topic, msg.get("offset"))
         return msg["message"]
 
+    def get_latest_many(self, topics):
+        """
+        `get_latest()` for several topics at once, in a single round trip.
+        Returns a dict of {topic: message}, with "" for topics that
+        have nothing new.
+        """
+        messages = {
+            topic: self._get_shared(topic, latest=True)
+            for topic in topics
+            if topic in self.shared
+        }
+        topics = [topic for topic in topics if topic not in self.shared]
+        if not topics:
+            return messages
+
+        msg = {"action": "get_latest_many", "topic": "", "topics": topics}
+        try:
+            self.websocket.send(encode(msg, self.codec))
+        except ConnectionClosedError:
+            return messages | {topic: "" for topic in topics}
+
+        try:
+            msg = self._recv_reply()
+        except ConnectionClosedError:
+            self.close()
+            return messages | {topic: "" for topic in topics}
+
+        for topic, offset in msg["offsets"].items():
+            self._record_offset(topic, offset)
+        return messages | msg["messages"]
+
     def get_wait(self, topic):
         """
-        A variant of `get()` that retries a few times until it gets
-        a non-empty message. Adjust `_n_tries` and `_initial_retry`
-        to change how persistent it will be.
+        A variant of `get()` that waits a while for a non-empty message.
+        It waits as long as retrying `_n_tries` times with exponential
+        backoff from `_initial_retry` would, but the waiting happens
+        on the server, so the message comes back as soon as it's put.
         """
-        for i_retry in range(_n_retries):
-            message = self.get(topic)
-            if message != "":
-                return message
-            time.sleep(_initial_retry * 2**i_retry)
-        return message
+        return self.get(topic, timeout=_initial_retry * (2**_n_retries - 1))
 
     def put(self, topic, msg_body):
-        msg_dict = {"action": "put", "topic": topic, "message": msg_body}
+        """
+        `msg_body` can be a str or anything bytes-like.
+        Bytes are sent as-is in a binary frame.
+        """
+        if topic in self.shared:
+            self._put_shared(topic, msg_body)
+            return
+
+        self._send_put({"action": "put", "topic": topic, "message": msg_body})
+
+    def put_array(self, topic, array):
+        """
+        Put a NumPy array into `topic` as its raw data buffer,
+        along with its dtype and shape.
+        """
+        self.put(topic, pack_array(array))
+
+    def put_many(self, topic, msg_bodies):
+        """
+        Put a list of messages into `topic`, in order, in a single frame.
+        """
+        if topic in self.shared:
+            for msg_body in msg_bodies:
+                self._put_shared(topic, msg_body)
+            return
+
+        self._send_put(
+            {"action": "put_many", "topic": topic, "messages": list(msg_bodies)}
+        )
+
+    def put_many_topics(self, msg_bodies_by_topic):
+        """
+        `put_many()` for several topics at once, in a single frame.
+        - `msg_bodies_by_topic` (dict), {topic: list of messages}
+        """
+        messages = {}
+        for topic, msg_bodies in msg_bodies_by_topic.items():
+            if topic in self.shared:
+                self.put_many(topic, msg_bodies)
+            else:
+                messages[topic] = list(msg_bodies)
+        if not messages:
+            return
+
+        self._send_put({"action": "put_many_topics", "topic": "", "messages": messages})
+
+    def flush(self, timeout=None):
+        """
+        With acks turned on, wait until the server has acknowledged
+        every put so far, or until `timeout` seconds have passed.
+        Returns a list of (topic, message, error) for each message that
+        the server couldn't store since the last flush(), so they can be
+        put again. Puts still waiting on an ack stay in `unacked`.
+        """
+        self._wait_for_acks(0, timeout=timeout)
+        failed_puts = self.failed_puts
+        self.failed_puts = []
+        return failed_puts
+
+    def set_retention(self, topic, **policy):
+        """
+        Change how many messages the server keeps in `topic`,
+        or in every topic if it's "*". `policy` can include any of
+        `max_length` (messages), `max_age` (seconds), and `max_bytes`.
+        A limit of None means no limit.
+        Raises a ValueError for a limit it doesn't know.
+        """
+        check_policy(policy)
+        msg_dict = {"action": "set_retention", "topic": topic, "policy": policy}
+        try:
+            self.websocket.send(encode(msg_dict, self.codec))
+        except ConnectionClosedError:
+            return
+
+    def get_evictions(self):
+        """
+        Returns a dict of {topic: the number of messages the server
+        has evicted from it to keep within its retention limits}.
+        """
+        msg = {"action": "get_evictions", "topic": ""}
         try:
-            self.websocket.send(json.dumps(msg_dict))
+            self.websocket.send(encode(msg, self.codec))
         except ConnectionClosedError:
+            return {}
+
+        try:
+            msg = self._recv_reply()
+        except ConnectionClosedError:
+            self.close()
+            return {}
+
+        return msg["evictions"]
+
+    def get_memory_usage(self):
+        """
+        Returns a dict with the bytes of messages the server holds,
+        "total", its memory budget, "budget", and a breakdown by topic,
+        "topics".
+        """
+        msg = {"action": "get_memory_usage", "topic": ""}
+        try:
+            self.websocket.send(encode(msg, self.codec))
+        except ConnectionClosedError:
+            return {}
+
+        try:
+            msg = self._recv_reply()
+        except ConnectionClosedError:
+            self.close()
+            return {}
+
+        return msg
+
+    def share(self, topic, n_slots=_default_n_slots, slot_size=_default_slot_size):
+        """
+        Pass messages in `topic` through shared memory rather than through
+        the server. It's for high-rate topics where every client is on the
+        same machine as the server. After this, `put()` and all the
+        flavors of `get()` for `topic` go straight to a ring buffer
+        in shared memory that the server sets up.
+
+        Only one client can put into a shared topic. Each message has to fit
+        in `slot_size` bytes, and only the latest `n_slots` are kept.
+        Those are set by the first client to share the topic.
+        Messages come back as str or bytes.
+        """
+        msg = {
+            "action": "share",
+            "topic": topic,
+            "n_slots": n_slots,
+            "slot_size": slot_size,
+        }
+        self.websocket.send(encode(msg, self.codec))
+        ring = SharedRing.attach(self._recv_reply()["name"])
+        self.shared[topic] = ring
+        # Like any other topic, only messages put from now on are eligible.
+        self.shared_cursors[topic] = ring.next_seq
+
+    def subscribe(self, topic, callback=None):
+        """
+        Ask the server to push every new message in `topic` to this client
+        as soon as it is put, rather than waiting to be asked for it.
+        Pushed messages count as read, and won't be returned by `get()`.
+        `topic` can also be a pattern, like "robot1/arm/*" or "robot1/**",
+        to subscribe to every topic it matches. See dsmq.topics.
+
+        If `callback` is given, it is called with each pushed message
+        whenever this client reads from the server. Otherwise pushed
+        messages are collected for `listen()`.
+        """
+        check_pattern(topic)
+        if callback is not None:
+            self.callbacks[topic] = callback
+            self.callback_patterns.add(topic, topic)
+        msg_dict = {"action": "subscribe", "topic": topic}
+        try:
+            self.websocket.send(encode(msg_dict, self.codec))
+        except ConnectionClosedError:
+            return
+
+    def unsubscribe(self, topic):
+        self.callbacks.pop(topic, None)
+        self.callback_patterns.discard(topic, topic)
+        msg_dict = {"action": "unsubscribe", "topic": topic}
+        try:
+            self.websocket.send(encode(msg_dict, self.codec))
+        except ConnectionClosedError:
+            return
+
+    def listen(self, timeout=None):
+        """
+        Iterate over (topic, message) pairs pushed from subscribed topics,
+        as they arrive. Stop after `timeout` seconds pass with nothing new,
+        or never if `timeout` is None.
+        Messages for topics with a callback go to the callback instead.
+        """
+        while True:
+            while self.pushed:
+                yield self.pushed.popleft()
+            try:
+                msg_text = self.websocket.recv(timeout=timeout)
+            except (ConnectionClosedError, TimeoutError):
+                return
+            self._handle_pushed(decode(msg_text))
+
+    def _send_put(self, msg_dict):
+        if self.ack_window:
+            # Don't get more than `ack_window` puts ahead of the server.
+            self._wait_for_acks(self.ack_window - 1)
+            msg_dict["seq"] = next(self.put_seqs)
+            self.unacked[msg_dict["seq"]] = msg_dict
+        try:
+            self.websocket.send(encode(msg_dict, self.codec))
+        except ConnectionClosedError:
+            self._fail_unacked()
+
+    def _wait_for_acks(self, max_unacked, timeout=None):
+        """
+        Read from the server until no more than `max_unacked` puts
+        are waiting on an ack, or until `timeout` seconds have passed.
+        """
+        if timeout is not None:
+            stop_time = time.time() + timeout
+        while len(self.unacked) > max_unacked:
+            if timeout is not None:
+                timeout = stop_time - time.time()
+                if timeout <= 0:
+                    return
+            try:
+                msg = decode(self.websocket.recv(timeout=timeout))
+            except TimeoutError:
+                return
+            except (ConnectionClosedError, ConnectionClosedOK):
+                self._fail_unacked()
+                return
+            self._handle_pushed(msg)
+
+    def _handle_ack(self, msg):
+        msg_dict = self.unacked.pop(msg["seq"], None)
+        if msg_dict is None:
+            return
+        for topic, error in msg["errors"].items():
+            for message in _put_messages(msg_dict, topic):
+                self.failed_puts.append((topic, message, error))
+
+    def _fail_unacked(self):
+        """
+        No acks are coming for puts still waiting on one.
+        """
+        for msg_dict in self.unacked.values():
+            for topic in _put_topics(msg_dict):
+                for message in _put_messages(msg_dict, topic):
+                    self.failed_puts.append((topic, message, _closed_before_ack_error))
+        self.unacked = {}
+
+    def _get_records(self, topic, max_n):
+        """
+        get_many(), but returning (offset, message) pairs.
+        Unlike get_many(), it lets ConnectionClosed through.
+        """
+        if topic in self.shared:
+            raise ValueError(
+                f"'{topic}' is a shared memory topic, whose messages don't "
+                + "come from the server. Try reading it with get()."
+            )
+        msg = {"action": "get_many", "topic": topic, "max_n": max_n}
+        msg["with_offsets"] = True
+        self.websocket.send(encode(msg, self.codec))
+        msg = self._recv_reply()
+        self._record_offset(topic, msg.get("offset"))
+        return list(zip(msg["offsets"], msg["messages"]))
+
+    def _put_shared(self, topic, msg_body):
+        if topic not in self.shared_writable:
+            # Ask to be the topic's one and only writer
+            msg = {"action": "share", "topic": topic, "writer": True}
+            self.websocket.send(encode(msg, self.codec))
+            if not self._recv_reply()["writer"]:
+                raise RuntimeError(
+                    f"Another client is already putting messages into '{topic}'. "
+                    + "Shared topics can only have one."
+                )
+            self.shared_writable.add(topic)
+        self.shared[topic].put(msg_body)
+
+    def _get_shared(self, topic, timeout=None, latest=False):
+        """
+        Read from the shared memory ring for `topic`, waiting up to `timeout`
+        seconds for a message if there isn't one there yet.
+        """
+        ring = self.shared[topic]
+        read = ring.get_latest if latest else ring.get
+        stop_time = time.time() + (timeout or 0.0)
+        while True:
+            message, self.shared_cursors[topic] = read(self.shared_cursors[topic])
+            if message is not None:
+                self.offsets[topic] = self.shared_cursors[topic] - 1
+                return message
+            if time.time() >= stop_time:
+                return ""
+            time.sleep(_shared_poll_interval)
+
+    def _get_many_shared(self, topic, max_n):
+        messages = []
+        for _ in range(max_n):
+            message, self.shared_cursors[topic] = self.shared[topic].get(
+                self.shared_cursors[topic]
+            )
+            if message is None:
+                break
+            messages.append(message)
+        if messages:
+            self.offsets[topic] = self.shared_cursors[topic] - 1
+        return messages
+
+    def _seek_shared(self, topic, from_offset):
+        """
+        In a shared topic, offsets are the ring's sequence numbers.
+        """
+        if from_offset is not None:
+            self.shared_cursors[topic] = from_offset
+
+    def _record_offset(self, topic, offset):
+        if offset is not None:
+            self.offsets[topic] = offset
+
+    def _negotiate_codec(self, preferred_codec):
+        """
+        Offer the server `preferred_codec`, falling back to "json".
+        Returns the codec the server picked.
+        A sharded server also says where its shards are.
+        """
+        msg = {"action": "hello", "topic": "", "codecs": [preferred_codec, "json"]}
+        self.websocket.send(encode(msg, "json"))
+        reply = self._recv_reply()
+        self.shards = reply.get("shards")
+        return reply["codec"]
+
+    def _recv_reply(self):
+        """
+        Wait for the reply to the most recent request, setting aside
+        any pushed messages that show up first.
+        """
+        while True:
+            msg = decode(self.websocket.recv())
+            if "action" not in msg:
+                return msg
+            self._handle_pushed(msg)
+
+    def _handle_pushed(self, msg):
+        if msg.get("action") == "ack":
+            self._handle_ack(msg)
+            return
+        if msg.get("action") == "error":
+            self.errors.append((msg["topic"], msg["error"]))
             return
+        if msg.get("action") != "push":
+            return
+        topic = msg["topic"]
+        self._record_offset(topic, msg.get("offset"))
+        patterns = self.callback_patterns.match(topic)
+        if not patterns:
+            self.pushed.append((topic, msg["message"]))
+        for pattern in patterns:
+            self.callbacks[pattern](msg["message"])
 
     def shutdown_server(self):
         msg_dict = {"action": "shutdown", "topic": ""}
-        self.websocket.send(json.dumps(msg_dict))
+        self.websocket.send(encode(msg_dict, self.codec))
         # Give the server time to wind down
         time.sleep(_shutdown_delay)
 
     def close(self):
+        for ring in self.shared.values():
+            ring.close()
+        self.shared = {}
         self.websocket.close()
         # Give the websocket time to wind down
         time.sleep(_shutdown_delay)
+
+
+class ShardedConnection:
+    """
+    A client for a sharded server, one started with serve(workers=N).
+    It connects to every shard and sends each request straight to the
+    shard that owns its topic. Requests for several topics are split
+    between the shards and their replies merged, so it can be used
+    just like a DSMQClientSideConnection, with a few differences.
+    - get_any() gets the oldest message from the first shard that has one,
+      which might not be the oldest of all. With a `timeout`, it checks
+      the shards in turn, rather than waiting on the server.
+    - Patterns passed to subscribe() go to every shard.
+    """
+
+    def __init__(self, front, verbose=False, codec="binary", ack_window=0):
+        self.front = front
+        self.shards = [
+            DSMQClientSideConnection(
+                uri, None, verbose=verbose, codec=codec, ack_window=ack_window
+            )
+            for uri in front.shards
+        ]
+        # Messages pushed from every shard, for listen()
+        self.pushed = deque()
+        for shard in self.shards:
+            shard.pushed = self.pushed
+
+    @property
+    def offsets(self):
+        return {
+            topic: offset
+            for shard in self.shards
+            for topic, offset in shard.offsets.items()
+        }
+
+    @property
+    def errors(self):
+        return [error for shard in self.shards for error in shard.errors]
+
+    def get(self, topic, timeout=None, from_offset=None, group=None):
+        return self._shard(topic).get(
+            topic, timeout=timeout, from_offset=from_offset, group=group
+        )
+
+    def get_any(self, topics, timeout=None):
+        topics_by_shard = split_topics(topics, len(self.shards))
+        if len(topics_by_shard) == 1:
+            ((i_shard, shard_topics),) = topics_by_shard.items()
+            return self.shards[i_shard].get_any(shard_topics, timeout=timeout)
+
+        deadline = time.time() + (timeout or 0)
+        while True:
+            for i_shard, shard_topics in topics_by_shard.items():
+                topic, message = self.shards[i_shard].get_any(shard_topics)
+                if topic is not None:
+                    return topic, message
+            if time.time() >= deadline:
+                return None, ""
+            time.sleep(_shard_poll_interval)
+
+    def get_all(self, topics):
+        return self._merge("get_all", topics)
+
+    def get_array(self, topic, timeout=None, from_offset=None, group=None):
+        return self._shard(topic).get_array(
+            topic, timeout=timeout, from_offset=from_offset, group=group
+        )
+
+    def get_many(self, topic, max_n=_default_max_n, from_offset=None, group=None):
+        return self._shard(topic).get_many(
+            topic, max_n=max_n, from_offset=from_offset, group=group
+        )
+
+    def get_many_topics(self, topics, max_n=_default_max_n):
+        return self._merge("get_many_topics", topics, max_n=max_n)
+
+    def get_latest(self, topic):
+        return self._shard(topic).get_latest(topic)
+
+    def get_latest_many(self, topics):
+        return self._merge("get_latest_many", topics)
+
+    def get_wait(self, topic):
+        return self._shard(topic).get_wait(topic)
+
+    def put(self, topic, msg_body):
+        self._shard(topic).put(topic, msg_body)
+
+    def put_array(self, topic, array):
+        self._shard(topic).put_array(topic, array)
+
+    def put_many(self, topic, msg_bodies):
+        self._shard(topic).put_many(topic, msg_bodies)
+
+    def put_many_topics(self, msg_bodies_by_topic):
+        topics_by_shard = split_topics(msg_bodies_by_topic, len(self.shards))
+        for i_shard, shard_topics in topics_by_shard.items():
+            self.shards[i_shard].put_many_topics(
+                {topic: msg_bodies_by_topic[topic] for topic in shard_topics}
+            )
+
+    def flush(self, timeout=None):
+        return [
+            failed_put for shard in self.shards for failed_put in shard.flush(timeout)
+        ]
+
+    def set_retention(self, topic, **policy):
+        shards = self.shards if topic == "*" else [self._shard(topic)]
+        for shard in shards:
+            shard.set_retention(topic, **policy)
+
+    def get_evictions(self):
+        evictions = {}
+        for shard in self.shards:
+            evictions |= shard.get_evictions()
+        return evictions
+
+    def get_memory_usage(self):
+        usage = {"total": 0, "budget": None, "topics": {}}
+        for shard in self.shards:
+            shard_usage = shard.get_memory_usage()
+            # Empty if the shard's connection has closed
+            usage["total"] += shard_usage.get("total", 0)
+            if shard_usage.get("budget") is not None:
+                usage["budget"] = (usage["budget"] or 0) + shard_usage["budget"]
+            usage["topics"] |= shard_usage.get("topics", {})
+        return usage
+
+    def share(self, topic, n_slots=_default_n_slots, slot_size=_default_slot_size):
+        self._shard(topic).share(topic, n_slots=n_slots, slot_size=slot_size)
+
+    def subscribe(self, topic, callback=None):
+        for shard in self._shards_for(topic):
+            shard.subscribe(topic, callback=callback)
+
+    def unsubscribe(self, topic):
+        for shard in self._shards_for(topic):
+            shard.unsubscribe(topic)
+
+    def listen(self, timeout=None):
+        """
+        Messages pushed from any shard. The shards are checked in turn.
+        """
+        last_heard = time.time()
+        while True:
+            while self.pushed:
+                yield self.pushed.popleft()
+                last_heard = time.time()
+            for shard in self.shards:
+                try:
+                    msg_text = shard.websocket.recv(timeout=0)
+                except TimeoutError:
+                    continue
+                except (ConnectionClosedError, ConnectionClosedOK):
+                    return
+                shard._handle_pushed(decode(msg_text))
+            if self.pushed:
+                continue
+            if timeout is not None and time.time() - last_heard > timeout:
+                return
+            time.sleep(_shard_poll_interval)
+
+    def shutdown_server(self):
+        self.front.shutdown_server()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.front.close()
+
+    def _get_records(self, topic, max_n):
+        return self._shard(topic)._get_records(topic, max_n)
+
+    def _shard(self, topic):
+        return self.shards[shard_of(topic, len(self.shards))]
+
+    def _shards_for(self, topic):
+        if is_pattern(topic):
+            return self.shards
+        return [self._shard(topic)]
+
+    def _merge(self, method, topics, **kwargs):
+        """
+        Split a request for several `topics` between the shards,
+        and merge the dicts they return.
+        """
+        merged = {}
+        for i_shard, shard_topics in split_topics(topics, len(self.shards)).items():
+            merged |= getattr(self.shards[i_shard], method)(shard_topics, **kwargs)
+        return merged
+
+
+class BufferedProducer:
+    """
+    Collects puts and sends them to the server in batches, a single
+    put_many_topics request each, rather than one frame per message.
+    A batch goes out when it reaches `max_n` messages or `max_bytes`,
+    or `linger` seconds after its first message was put,
+    whichever comes first.
+
+    It takes over `connection`, which shouldn't be used directly
+    while the producer is open. Order is kept within each topic.
+    """
+
+    def __init__(
+        self,
+        connection,
+        linger=_default_linger,
+        max_n=_default_max_batch_n,
+        max_bytes=_default_max_batch_bytes,
+    ):
+        self.connection = connection
+        self.linger = linger
+        self.max_n = max_n
+        self.max_bytes = max_bytes
+
+        # Messages waiting to be sent, {topic: list of messages}
+        self.batch = {}
+        self.n_batched = 0
+        self.n_batched_bytes = 0
+        self.time_of_first_put = None
+        self.closed = False
+        # Guards the batch and the connection. The linger thread
+        # waits on it for the first put of each batch.
+        self.lock = Condition()
+        self.linger_thread = Thread(target=self._send_lingering, daemon=True)
+        self.linger_thread.start()
+
+    def put(self, topic, msg_body):
+        with self.lock:
+            if not self.batch:
+                self.time_of_first_put = time.monotonic()
+                self.lock.notify()
+            self.batch.setdefault(topic, []).append(msg_body)
+            self.n_batched += 1
+            self.n_batched_bytes += _message_size(msg_body)
+            if self.n_batched >= self.max_n or self.n_batched_bytes >= self.max_bytes:
+                self._send_batch()
+
+    def put_array(self, topic, array):
+        self.put(topic, pack_array(array))
+
+    def put_many(self, topic, msg_bodies):
+        for msg_body in msg_bodies:
+            self.put(topic, msg_body)
+
+    def flush(self, timeout=None):
+        """
+        Send whatever is waiting, then call the connection's flush().
+        """
+        with self.lock:
+            self._send_batch()
+            return self.connection.flush(timeout=timeout)
+
+    def close(self):
+        """
+        Send whatever is waiting and close the connection.
+        """
+        with self.lock:
+            self._send_batch()
+            self.closed = True
+            self.lock.notify()
+        self.linger_thread.join()
+        self.connection.close()
+
+    def _send_lingering(self):
+        with self.lock:
+            while not self.closed:
+                if not self.batch:
+                    self.lock.wait()
+                    continue
+                remaining = self.time_of_first_put + self.linger - time.monotonic()
+                if remaining > 0:
+                    self.lock.wait(remaining)
+                    continue
+                self._send_batch()
+
+    def _send_batch(self):
+        """
+        Only call with the lock held.
+        """
+        if not self.batch:
+            return
+        batch = self.batch
+        self.batch = {}
+        self.n_batched = 0
+        self.n_batched_bytes = 0
+        self.connection.put_many_topics(batch)
+
+
+class Prefetcher:
+    """
+    Reads ahead in `topic`. A background thread fetches the next batch of
+    unread messages while get() hands out the ones already fetched,
+    so get() rarely has to wait on a round trip to the server.
+
+    It fetches enough messages to last `_prefetch_horizon` at the rate
+    they're being read, but never fewer than `min_depth` or more than
+    `max_depth`, and fetches again when half of them are gone.
+
+    It takes over `connection`, which shouldn't be used directly
+    while the prefetcher is open.
+    """
+
+    def __init__(
+        self,
+        connection,
+        topic,
+        min_depth=_default_min_depth,
+        max_depth=_default_max_depth,
+    ):
+        self.connection = connection
+        self.topic = topic
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.depth = min_depth
+
+        # Messages fetched but not yet handed out, as (offset, message) pairs
+        self.buffer = deque()
+        # Whether the last fetch found no messages
+        self.drained = False
+        # The offset of the most recent message handed out by get(),
+        # {topic: int}, as in DSMQClientSideConnection.
+        self.offsets = {}
+        # How fast messages are being read, in messages per second
+        self.rate = 0.0
+        self.n_taken = 0
+        self.time_of_last_fetch = time.monotonic()
+        self.closed = False
+        # Guards the buffer. The prefetch thread waits on it
+        # for the buffer to run low, and get() for it to fill.
+        self.lock = Condition()
+        self.prefetch_thread = Thread(target=self._prefetch, daemon=True)
+        self.prefetch_thread.start()
+
+    def get(self, timeout=None):
+        """
+        Get the oldest unread message in the topic, as in
+        DSMQClientSideConnection.get(). Returns "" if there isn't one,
+        after waiting up to `timeout` seconds for one to arrive.
+        """
+        with self.lock:
+            if timeout:
+                self.lock.wait_for(lambda: self.buffer or self.closed, timeout)
+            else:
+                # Wait for a fetch already on its way.
+                self.lock.wait_for(lambda: self.buffer or self.drained or self.closed)
+            if not self.buffer:
+                return ""
+            offset, message = self.buffer.popleft()
+            self.offsets[self.topic] = offset
+            self.n_taken += 1
+            if len(self.buffer) <= self.depth // 2:
+                self.lock.notify_all()
+            return message
+
+    def close(self):
+        """
+        Stop prefetching and close the connection. Messages that were
+        fetched but not handed out by get() are dropped.
+        """
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.prefetch_thread.join()
+        self.connection.close()
+
+    def _prefetch(self):
+        while True:
+            with self.lock:
+                self.lock.wait_for(
+                    lambda: self.closed or len(self.buffer) <= self.depth // 2
+                )
+                if self.closed:
+                    return
+                self._adapt_depth()
+                max_n = self.depth - len(self.buffer)
+
+            try:
+                if self.drained:
+                    records = self._wait_for_message()
+                else:
+                    records = self.connection._get_records(self.topic, max_n)
+                # get() hides a closed connection behind an empty reply.
+                lost = not records and _is_closed(self.connection)
+            except ConnectionClosed:
+                lost = True
+
+            with self.lock:
+                if lost:
+                    # Nothing more is coming. Let get() stop waiting.
+                    self.closed = True
+                    self.lock.notify_all()
+                    return
+                self.buffer.extend(records)
+                self.drained = not records
+                self.lock.notify_all()
+
+    def _adapt_depth(self):
+        """
+        Only call with the lock held.
+        """
+        now = time.monotonic()
+        elapsed = now - self.time_of_last_fetch
+        if elapsed > 0:
+            rate = self.n_taken / elapsed
+            self.rate = _rate_smoothing * self.rate + (1 - _rate_smoothing) * rate
+        self.n_taken = 0
+        self.time_of_last_fetch = now
+        self.depth = min(
+            max(int(self.rate * _prefetch_horizon), self.min_depth), self.max_depth
+        )
+
+    def _wait_for_message(self):
+        """
+        Once the topic has run dry, have the server hold a get() open
+        until the next message arrives, rather than asking over and over.
+        """
+        last_offset = self.connection.offsets.get(self.topic)
+        message = self.connection.get(self.topic, timeout=_idle_wait)
+        offset = self.connection.offsets.get(self.topic)
+        if offset == last_offset:
+            return []
+        return [(offset, message)]
+
+
+class Pool:
+    """
+    A fixed number of connections to share between threads.
+    A thread borrows one for as long as it needs it,
+
+        with pool.connection() as mq:
+            mq.put("greetings", "hello")
+
+    and no other thread can use it until it's given back. Connections
+    that come back closed, or with an exception raised while they were
+    out, are replaced with fresh ones by a background thread.
+
+    Read cursors belong to connections, so a thread reading a topic
+    through the pool can get a different cursor each time. To share
+    the work in a topic between threads, read it with a consumer `group`.
+    """
+
+    def __init__(
+        self, host=_default_host, port=_default_port, size=_default_pool_size, **kwargs
+    ):
+        self.host = host
+        self.port = port
+        self.size = size
+        # Passed on to connect(), like codec or ack_window
+        self.connect_kwargs = kwargs
+
+        self.idle = queue.Queue()
+        # Connections waiting to be replaced
+        self.broken = queue.Queue()
+        self.stopping = Event()
+        for _ in range(size):
+            self.idle.put(connect(host, port, **kwargs))
+        self.reconnect_thread = Thread(target=self._reconnect, daemon=True)
+        self.reconnect_thread.start()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Borrow a connection, waiting up to `timeout` seconds
+        for one to be free. Raises TimeoutError if none is.
+        """
+        try:
+            mq = self.idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(
+                f"All {self.size} connections in the pool were in use. "
+                + "Try a larger pool size or a longer timeout."
+            )
+        try:
+            yield mq
+        except BaseException:
+            # It might be partway through a request, with a reply
+            # on its way that the next borrower would take for their own.
+            if self.stopping.is_set():
+                # The reconnect thread is gone, so nothing would close it.
+                _close_quietly(mq)
+            else:
+                self.broken.put(mq)
+            raise
+        if self.stopping.is_set():
+            mq.close()
+        elif _is_closed(mq):
+            self.broken.put(mq)
+        else:
+            self.idle.put(mq)
+
+    def close(self):
+        """
+        Close every connection that isn't borrowed.
+        Borrowed ones are closed when they're given back.
+        """
+        self.stopping.set()
+        self.broken.put(None)
+        self.reconnect_thread.join()
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _reconnect(self):
+        while True:
+            mq = self.broken.get()
+            if mq is None:
+                return
+            _close_quietly(mq)
+
+            retry = _initial_retry
+            while not self.stopping.is_set():
+                try:
+                    mq = connect(self.host, self.port, **self.connect_kwargs)
+                except (ConnectionClosedError, ConnectionClosedOK, OSError):
+                    self.stopping.wait(retry)
+                    retry = min(2 * retry, _max_reconnect_retry)
+                    continue
+                self.idle.put(mq)
+                break
+
+
+def _close_quietly(mq):
+    """
+    Close a connection that may already be broken.
+    """
+    try:
+        mq.close()
+    except (ConnectionClosedError, ConnectionClosedOK, OSError):
+        pass
+
+
+def _is_closed(mq):
+    """
+    Check whether any of the connection's websockets has closed,
+    without waiting.
+    """
+    if isinstance(mq, ShardedConnection):
+        connections = mq.shards
+    else:
+        connections = [mq]
+    for connection in connections:
+        try:
+            msg_text = connection.websocket.recv(timeout=0)
+        except TimeoutError:
+            continue
+        except (ConnectionClosedError, ConnectionClosedOK):
+            return True
+        connection._handle_pushed(decode(msg_text))
+    return False
+
+
+def _message_size(msg_body):
+    """
+    Roughly how many bytes `msg_body` will take on the wire.
+    """
+    if isinstance(msg_body, tuple):
+        return sum(message_size(part) for part in msg_body)
+    return message_size(msg_body)
+
+
+def _put_topics(msg_dict):
+    if msg_dict["action"] == "put_many_topics":
+        return list(msg_dict["messages"])
+    return [msg_dict["topic"]]
+
+
+def _put_messages(msg_dict, topic):
+    """
+    The messages in the put request `msg_dict` bound for `topic`.
+    """
+    if msg_dict["action"] == "put":
+        return [msg_dict["message"]]
+    elif msg_dict["action"] == "put_many":
+        return msg_dict["messages"]
+    else:
+        return msg_dict["messages"][topic]
+
+
+def _check_no_group(topic, group):
+    """
+    Messages in shared topics never pass through the server,
+    so it can't hand them out to a consumer group.
+    """
+    if group is not None:
+        raise ValueError(
+            f"'{topic}' is a shared memory topic, which can't be read "
+            + "as a consumer group. Try a topic that hasn't been shared."
+        )
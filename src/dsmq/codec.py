@@ -0,0 +1,150 @@
+"""
+Ways of turning the dicts that dsmq clients and servers exchange
+into websocket frames, and back again.
+
+"json" is the original protocol. Each dict goes out as one JSON text frame.
+
+"binary" goes out as a binary frame with three parts:
+- a 4-byte, big-endian length of the header,
+- the header, the dict as JSON but without its message contents, and
+- the message contents, one after the other.
+The header records how long each message is and where it belongs.
+Long messages are never escaped or parsed as JSON, which is where most
+of the time goes for the "json" codec.
+
+Messages can be str or bytes-like (bytes, bytearray, memoryview).
+Strings travel UTF-8 encoded. Bytes travel as-is and come back out
+as memoryview slices of the received frame, without being copied.
+A tuple of bytes-like parts is sent as a single bytes message, the parts
+joined end to end. That lets a caller prepend a small header to a large
+buffer without first copying them together.
+JSON has no way to carry bytes, so any frame that holds them goes out
+as "binary", whichever codec was agreed on.
+
+A client asks for the codecs it knows at connect time with a "hello"
+request. Clients that never say hello get "json".
+"""
+
+import json
+
+codecs = ["binary", "json"]
+
+_header_size_bytes = 4
+_byteorder = "big"
+
+
+def choose_codec(client_codecs):
+    """
+    Pick the first codec on the client's list that this side knows.
+    """
+    for codec in client_codecs:
+        if codec in codecs:
+            return codec
+    return "json"
+
+
+def encode(msg, codec="json"):
+    if codec == "json":
+        try:
+            return json.dumps(msg)
+        except TypeError:
+            # There are bytes in there
+            return encode_binary(msg)
+    elif codec == "binary":
+        return encode_binary(msg)
+    else:
+        raise ValueError(f"Unknown dsmq codec '{codec}'. Try one of {codecs}.")
+
+
+def decode(frame):
+    """
+    Text frames are JSON and binary frames are "binary".
+    """
+    if isinstance(frame, str):
+        return json.loads(frame)
+    return decode_binary(frame)
+
+
+def encode_binary(msg):
+    header = dict(msg)
+    payloads = []
+    for field in ["message", "messages"]:
+        if field in header:
+            header[field] = _pack(header[field], payloads)
+    header["sizes"] = [sum(len(part) for part in parts) for parts in payloads]
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    return b"".join(
+        [len(header_bytes).to_bytes(_header_size_bytes, _byteorder), header_bytes]
+        + [part for parts in payloads for part in parts]
+    )
+
+
+def decode_binary(frame):
+    frame = memoryview(frame)
+    header_size = int.from_bytes(frame[:_header_size_bytes], _byteorder)
+    i_start = _header_size_bytes + header_size
+    msg = json.loads(bytes(frame[_header_size_bytes:i_start]))
+
+    payloads = []
+    for size in msg.pop("sizes"):
+        payloads.append(frame[i_start : i_start + size])
+        i_start += size
+
+    payloads.reverse()
+    for field in ["message", "messages"]:
+        if field in msg:
+            msg[field] = _unpack(msg[field], payloads)
+    return msg
+
+
+def _pack(value, payloads):
+    """
+    Pull the messages out of `value`, a single message,
+    a list of them, or a dict of lists of them, and append each one to
+    `payloads` as a list of its parts. Return a placeholder with the same
+    shape as `value`: None where there was a str and "bytes" where
+    there were bytes.
+    """
+    if isinstance(value, str):
+        payloads.append([value.encode("utf-8")])
+        return None
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        payloads.append([_flat_view(value)])
+        return "bytes"
+    elif isinstance(value, tuple):
+        payloads.append([_flat_view(part) for part in value])
+        return "bytes"
+    elif isinstance(value, list):
+        return [_pack(item, payloads) for item in value]
+    elif isinstance(value, dict):
+        return {key: _pack(item, payloads) for key, item in value.items()}
+    else:
+        raise TypeError(f"Can't send a message of type {type(value)}")
+
+
+def _flat_view(buffer):
+    """
+    A flat view of the bytes, so that len() counts bytes
+    no matter the shape or item size of the original buffer.
+    """
+    view = memoryview(buffer)
+    if view.nbytes == 0:
+        # Empty buffers can't always be cast, but there's nothing to send.
+        return b""
+    return view.cast("B")
+
+
+def _unpack(placeholder, payloads):
+    """
+    The reverse of _pack(). `payloads` is in reverse order,
+    so that each one can be popped off the end.
+    """
+    if placeholder is None:
+        return str(payloads.pop(), "utf-8")
+    elif placeholder == "bytes":
+        return payloads.pop()
+    elif isinstance(placeholder, list):
+        return [_unpack(item, payloads) for item in placeholder]
+    else:
+        return {key: _unpack(item, payloads) for key, item in placeholder.items()}
@@ -0,0 +1,21 @@
+"""
+The limits a retention policy can set, shared by the server, which
+enforces them, and the clients, which check them before sending,
+so that a typo is caught where it's made.
+"""
+
+_limits = ["max_length", "max_age", "max_bytes", "when_full"]
+_when_full_options = ["drop_oldest", "reject", "delay"]
+
+
+def check_policy(policy):
+    unknown = set(policy) - set(_limits)
+    if unknown:
+        raise ValueError(
+            f"Unknown retention limits {sorted(unknown)}. Try any of {_limits}."
+        )
+    if policy.get("when_full", "drop_oldest") not in _when_full_options:
+        raise ValueError(
+            f"Unknown when_full policy '{policy['when_full']}'. "
+            + f"Try one of {_when_full_options}."
+        )
@@ -1,23 +1,87 @@
-import json
-import os
-import sqlite3
+import asyncio
+from contextlib import nullcontext
+import math
+import multiprocessing as mp
 import sys
-from threading import Thread
+from threading import Event, Lock, Thread, Timer
 import time
-from websockets.sync.server import serve as ws_serve
+from uuid import uuid4
 from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
+from dsmq.bridge import Bridge
+from dsmq.codec import choose_codec, decode, encode
+from dsmq.retention import check_policy
+from dsmq.shared import SharedRing, _default_n_slots, _default_slot_size
+from dsmq.sharding import shard_uris
+from dsmq.storage import message_size, open_store
+from dsmq.topics import TopicTrie
+from dsmq import transport
 
 _default_host = "127.0.0.1"
 _default_port = 30008
 _max_queue_length = 10
 _shutdown_pause = 1.0  # seconds
+_max_frame_size = 2**28  # bytes
 _time_between_cleanup = 3.0  # seconds
 _time_to_keep = 0.3  # seconds
+_default_max_n = 100  # messages per get_many
 # _time_between_cleanup = 60.0  # seconds
 # _time_to_keep = 10.0  # seconds
+_default_retention = {
+    "max_length": _max_queue_length,
+    "max_age": _time_to_keep,
+    "max_bytes": None,
+    "when_full": "drop_oldest",
+}
+_over_budget_delay = 0.01  # seconds
+_over_budget_error = "Put rejected. The server is over its memory budget."
+_store_busy_error = "Put failed. The message store was busy. Try again."
+_sharded_error = (
+    "This dsmq server is sharded, and only hands out the addresses "
+    + "of its shards. Connect with dsmq.client.connect() or dsmq.aio.connect()."
+)
 
-# Make this global so it's easy to share
+# Make these global so they're easy to share
 dsmq_server = None
+_store = None
+# A random id for this server, so that bridged messages can tell
+# which servers they've been through. See dsmq.bridge.
+_server_id = None
+# Bridges carrying topics on to other servers, [Bridge]
+_bridges = []
+# The sessions subscribed to each topic or pattern, filed by pattern.
+# See dsmq.topics.
+_subscribers = TopicTrie()
+_subscribers_lock = Lock()
+# How far each consumer group has read in each topic,
+# {(topic, group): offset of the next message to hand out}
+_group_offsets = {}
+_groups_lock = Lock()
+# The get requests being held open for each topic, {topic: set of PendingGet}
+_waiters = {}
+_waiters_lock = Lock()
+# Shared memory rings for the topics that have one, {topic: SharedRing}
+_shared_rings = {}
+# The session allowed to put into each shared topic, {topic: ClientSession}
+_shared_writers = {}
+_shared_lock = Lock()
+# Retention limits for each topic, {topic: policy}. See serve().
+_retention = {}
+_retention_lock = Lock()
+# The most bytes of messages to hold across all topics, or None for no limit
+_memory_budget = None
+# Held from checking the budget until the put is stored,
+# so that two puts can't both fit in the same room
+_budget_lock = Lock()
+# How many messages have been evicted from each topic, {topic: int}
+_evictions = {}
+_evictions_lock = Lock()
+# The newest message in each topic, {topic: (offset, message)},
+# so that get_latest never has to go to the store
+_latest = {}
+_latest_lock = Lock()
+# The most recent timestamp handed out by new_timestamps()
+_last_timestamp = 0.0
+_timestamp_lock = Lock()
 
 
 def serve(
@@ -25,263 +89,973 @@ def serve(
     port=_default_port,
     name="mqdb",
     verbose=False,
+    backend="sqlite",
+    engine="sync",
+    retention=None,
+    memory_budget=None,
+    workers=None,
+    bridges=None,
 ):
     """
     For best results, start this running in its own process and walk away.
+
+    `host` can also be a full URI that picks the transport, like
+    "tcp://127.0.0.1:30008" or "unix:///run/dsmq.sock", in which case
+    `port` is ignored. A plain host name gets websockets, "ws://host:port".
+
+    `backend` picks the storage engine, either "sqlite" for an in-memory
+    SQLite database, "sqlite_ingest" for the same database with every write
+    funneled through one ingest thread that commits them in batches,
+    or "ring" for a plain-Python ring buffer per topic.
+
+    `engine` picks how client connections are handled, either "sync"
+    for one thread per client or "async" for a single asyncio event loop
+    that handles all of them.
+
+    `retention` sets how many messages to keep in each topic,
+    {topic: policy}. A policy is a dict with any of
+    - "max_length", the most messages to keep,
+    - "max_age", the oldest a message can get, in seconds, and
+    - "max_bytes", the most bytes of messages to keep.
+    The policy for "*" applies to every topic. A topic's own policy
+    overrides it one limit at a time. A limit of None means no limit.
+    A background sweeper enforces the limits every few seconds.
+
+    `memory_budget` is the most bytes of messages to hold, across all
+    topics. When a put would go over it, the topic's "when_full" policy
+    decides what happens.
+    - "drop_oldest", the default, evicts the topic's oldest messages
+      to make room. If the topic doesn't hold enough to make room,
+      the put is rejected.
+    - "reject" drops the new message and sends the client an error.
+    - "delay" keeps the new message, but the server waits a moment
+      before replying or reading anything else from that client,
+      slowing it down until the sweeper has cleared some space.
+      The budget can be overrun a little this way.
+
+    `workers` splits the server into that many shards, each running in
+    its own process and holding its own share of the topics.
+    See dsmq.sharding. The `memory_budget` is split evenly between them.
+
+    `bridges` mirrors topics onto other servers, {uri: list of topics}.
+    Each new message in one of the topics, or matching one of them if it's
+    a pattern, is put into the same topic on the server at `uri`.
+    See dsmq.bridge.
     """
-    # May occasionally create files with this name.
-    # https://sqlite.org/inmemorydb.html
-    # "...parts of a temporary database might be flushed to disk if the
-    # database becomes large or if SQLite comes under memory pressure."
-    global _db_name
-    _db_name = f"file:{name}?mode=memory&cache=shared"
-
-    cleanup_temp_files()
-    sqlite_conn = sqlite3.connect(_db_name)
-    cursor = sqlite_conn.cursor()
-
-    # Tweak the connection to make it faster
-    # and keep long-term latency more predictable.
-    # These also make it more susceptible to corruption during shutdown,
-    # but since dsmq is meant to be ephemeral, that's not a concern.
-    # See https://www.sqlite.org/pragma.html
-    # After playing around with them, I'm not sure these have any noticeable effect.
-    #
-    # cursor.execute("PRAGMA journal_mode = OFF")
-    # cursor.execute("PRAGMA journal_mode = MEMORY")
-    # cursor.execute("PRAGMA synchronous = NORMAL")
-    # cursor.execute("PRAGMA synchronous = OFF")
-    # cursor.execute("PRAGMA secure_delete = OFF")
-    # cursor.execute("PRAGMA temp_store = MEMORY")
-
-    cursor.execute("""
-CREATE TABLE IF NOT EXISTS messages (timestamp DOUBLE, topic TEXT, message TEXT)
-    """)
-
-    # Making this global in scope is a way to make it available
-    # to the shutdown operation. It's an awkward construction,
-    # and a method of last resort.
-    global dsmq_server
+    if engine == "sync":
+        run_server = _serve_sync
+    elif engine == "async":
+        run_server = _serve_async
+    else:
+        raise ValueError(
+            f"Unknown dsmq server engine '{engine}'. Try either 'sync' or 'async'."
+        )
+
+    uri = transport.to_uri(host, port)
+    if workers:
+        if memory_budget is not None:
+            memory_budget //= workers
+        _serve_sharded(
+            uri,
+            workers,
+            {
+                "name": name,
+                "verbose": verbose,
+                "backend": backend,
+                "engine": engine,
+                "retention": retention,
+                "memory_budget": memory_budget,
+                "bridges": bridges,
+            },
+        )
+        return
+
+    # Making these global in scope is a way to make them available
+    # to the request handlers and the shutdown operation.
+    # It's an awkward construction, and a method of last resort.
+    global _store, _memory_budget, _server_id
+    _store = open_store(backend=backend, name=name)
+    _memory_budget = memory_budget
+    _server_id = uuid4().hex
+
+    _retention.clear()
+    _evictions.clear()
+    _latest.clear()
+    _group_offsets.clear()
+    set_retention("*", _default_retention)
+    for topic, policy in (retention or {}).items():
+        set_retention(topic, policy)
+    stop_sweeping = Event()
+    Thread(target=sweep, args=(stop_sweeping, verbose), daemon=True).start()
+    _bridges[:] = [
+        Bridge(bridge_uri, topics, _server_id)
+        for bridge_uri, topics in (bridges or {}).items()
+    ]
+    for bridge in _bridges:
+        bridge.start()
 
     try:
-        with ws_serve(request_handler, host, port) as dsmq_server:
-            dsmq_server.serve_forever()
+        run_server(uri)
 
     except OSError:
         # Catch the case where the address is already in use
         if verbose:
             print()
-            print(f"Found a dsmq server already running on {host} on port {port}.")
+            print(f"Found a dsmq server already running at {uri}.")
             print("    Closing it down.")
 
-            def shutdown_gracefully(server_to_shutdown):
-                server_to_shutdown.shutdown()
-
-            Thread(target=shutdown_gracefully, args=(dsmq_server,)).start()
+            Thread(target=shutdown_gracefully).start()
             time.sleep(_shutdown_pause)
 
-            with ws_serve(request_handler, host, port) as dsmq_server:
-                dsmq_server.serve_forever()
+            run_server(uri)
 
     if verbose:
         print()
-        print(f"Server started at {host} on port {port}.")
+        print(f"Server started at {uri}.")
         print("Waiting for clients...")
 
-    sqlite_conn.close()
+    stop_sweeping.set()
+    for bridge in _bridges:
+        bridge.stop(timeout=_shutdown_pause)
     time.sleep(_shutdown_pause)
-    cleanup_temp_files()
-
-
-def cleanup_temp_files():
-    # Under some condition
-    # (which I haven't yet been able to pin down)
-    # a file is generated with the db name.
-    # If it is not removed, it gets
-    # treated as a SQLite db on disk,
-    # which dramatically slows it down,
-    # especially the way it's used here for
-    # rapid-fire one-item reads and writes.
-    global _db_name
-    filenames = os.listdir()
-    for filename in filenames:
-        if filename[: len(_db_name)] == _db_name:
-            try:
-                os.remove(filename)
-            except FileNotFoundError:
-                pass
+    _store.close()
+    _close_shared_rings()
 
 
-def request_handler(websocket):
-    global _db_name
-    sqlite_conn = sqlite3.connect(_db_name)
-    cursor = sqlite_conn.cursor()
+def _serve_sync(uri):
+    global dsmq_server
+    with transport.serve(request_handler, uri, max_size=_max_frame_size) as dsmq_server:
+        dsmq_server.serve_forever()
+
+
+def _serve_async(uri):
+    async def serve_until_closed():
+        global dsmq_server
+        async with transport.serve_async(
+            async_request_handler, uri, max_size=_max_frame_size
+        ) as dsmq_server:
+            await dsmq_server.wait_closed()
+
+    asyncio.run(serve_until_closed())
+
+
+def _serve_sharded(uri, n_workers, options):
+    """
+    Start a shard server in its own process for each worker,
+    then answer clients at `uri` with where to find them,
+    until every shard has shut down.
+    """
+    global dsmq_server
+    uris = shard_uris(uri, n_workers)
+    shards = [
+        mp.Process(target=serve, args=(shard_uri,), kwargs=options)
+        for shard_uri in uris
+    ]
+    for shard in shards:
+        shard.start()
+
+    def handler(websocket):
+        front_request_handler(websocket, uris)
+
+    def stop_when_shards_stop():
+        for shard in shards:
+            shard.join()
+        shutdown_gracefully()
+
+    with transport.serve(handler, uri, max_size=_max_frame_size) as dsmq_server:
+        Thread(target=stop_when_shards_stop, daemon=True).start()
+        if options["verbose"]:
+            print()
+            print(f"Sharded server started at {uri}, with shards at {uris}.")
+        dsmq_server.serve_forever()
 
-    client_creation_time = time.time()
-    last_read_times = {}
-    time_of_last_purge = time.time()
 
+def shutdown_gracefully():
+    global dsmq_server
+    if dsmq_server is None:
+        return
+    # The threaded server has shutdown() and the asyncio server has close().
+    # Both stop accepting connections and make serve_forever() return.
     try:
-        for msg_text in websocket:
-            msg = json.loads(msg_text)
-            topic = msg["topic"]
-            action = msg["action"]
-            timestamp = time.time()
+        dsmq_server.shutdown()
+    except AttributeError:
+        dsmq_server.close()
 
-            if action == "put":
-                msg["timestamp"] = timestamp
 
-                try:
-                    cursor.execute(
-                        """
-                        INSERT INTO messages (timestamp, topic, message)
-                        VALUES (:timestamp, :topic, :message)
-                        """,
-                        (msg),
-                    )
-                    sqlite_conn.commit()
-                except sqlite3.OperationalError:
-                    pass
+class ClientSession:
+    """
+    Everything the server knows about one client connection:
+    when it connected, how far it has read in each topic,
+    and which topics it is subscribed to.
+    It turns each incoming request into a reply (or no reply),
+    independent of how the request arrived.
 
-            elif action == "get":
-                try:
-                    last_read_time = last_read_times[topic]
-                except KeyError:
-                    last_read_times[topic] = client_creation_time
-                    last_read_time = last_read_times[topic]
-                msg["last_read_time"] = last_read_time
+    How far it has read is the offset of the next message it will get
+    from each topic. The first time a client reads from a topic,
+    it starts at the first message put after it connected.
+    Clients reading as part of a consumer group share the group's
+    read cursor instead, so that each message goes to just one of them.
 
-                try:
-                    cursor.execute(
-                        """
-                        SELECT message,
-                        timestamp
-                        FROM messages
-                        WHERE topic = :topic
-                        AND timestamp > :last_read_time
-                        ORDER BY timestamp ASC
-                        LIMIT 1
-                        """,
-                        msg,
-                    )
-                except sqlite3.OperationalError:
-                    pass
+    `send` is a function that delivers a dict to the client.
+    It's used for messages pushed to subscribers and for replies
+    to get requests that were held open.
 
-                try:
-                    result = cursor.fetchall()[0]
-                    message = result[0]
-                    timestamp = result[1]
-                    last_read_times[topic] = timestamp
-                except IndexError:
-                    # Handle the case where no results are returned
-                    message = ""
+    `schedule` is a function that calls `fn` after `delay` seconds,
+    schedule(delay, fn), and returns something with a cancel() method.
+    """
 
-                websocket.send(json.dumps({"message": message}))
+    def __init__(self, send, schedule):
+        self.send = send
+        self.schedule = schedule
+        # Until the client says otherwise, assume it only speaks JSON.
+        self.codec = "json"
+        self.client_creation_time = time.time()
+        # The offset of the next message to read in each topic, {topic: int}
+        self.next_offsets = {}
+        self.subscriptions = set()
+        self.pending_gets = set()
+        # Seconds to wait before reading this client's next request,
+        # to slow it down while the server is over its memory budget
+        self.delay = 0.0
 
-            elif action == "get_latest":
-                try:
-                    last_read_time = last_read_times[topic]
-                except KeyError:
-                    last_read_times[topic] = client_creation_time
-                    last_read_time = last_read_times[topic]
-                msg["last_read_time"] = last_read_time
+    def respond(self, msg):
+        """
+        Carry out the request in `msg`, a dict.
+        Returns the reply dict, or None if the request doesn't get one.
+
+        If the request carries an "id", its reply carries the same "id",
+        so that clients with several requests in flight can tell
+        which reply goes with which request.
+        """
+        global _store
+        topic = msg["topic"]
+        action = msg["action"]
+        reply = None
+
+        if action == "put":
+            errors = {}
+            error = self._put(topic, msg["message"], msg.get("via", ()))
+            if error is not None:
+                errors[topic] = error
+            reply = self._acknowledge(msg, errors)
+
+        elif action == "put_many":
+            errors = {}
+            error = self._put_many(topic, msg["messages"], msg.get("via", ()))
+            if error is not None:
+                errors[topic] = error
+            reply = self._acknowledge(msg, errors)
+
+        elif action == "put_many_topics":
+            errors = {}
+            for batch_topic, messages in msg["messages"].items():
+                error = self._put_many(batch_topic, messages, msg.get("via", ()))
+                if error is not None:
+                    errors[batch_topic] = error
+            reply = self._acknowledge(msg, errors)
+
+        elif action in ("get", "get_any"):
+            group = msg.get("group")
+            if action == "get":
+                self._seek(topic, msg, group)
+                topics = [topic]
+            else:
+                topics = msg["topics"]
+            result = self._get_any(topics, group)
+            timeout = msg.get("timeout")
+            if result is None and timeout:
+                # Hold the request open. The reply gets sent later,
+                # either when a message is put or when time runs out.
+                self._hold_get(topics, timeout, msg.get("id"), group)
+            else:
+                reply = self._advance_any(result, group)
+
+        elif action == "get_all":
+            reply = {"messages": {}, "offsets": {}}
+            for batch_topic in msg["topics"]:
+                records = self._get_many(batch_topic, 1)
+                if records:
+                    offset, message = records[0]
+                    reply["messages"][batch_topic] = message
+                    reply["offsets"][batch_topic] = offset
+                else:
+                    reply["messages"][batch_topic] = ""
+
+        elif action == "get_many":
+            group = msg.get("group")
+            self._seek(topic, msg, group)
+            max_n = msg.get("max_n", _default_max_n)
+            if group is None:
+                records = self._get_many(topic, max_n)
+            else:
+                records = self._claim(topic, group, max_n)
+            reply = {
+                "messages": [message for _, message in records],
+                "offset": records[-1][0] if records else None,
+            }
+            if msg.get("with_offsets"):
+                reply["offsets"] = [offset for offset, _ in records]
+
+        elif action == "get_many_topics":
+            max_n = msg.get("max_n", _default_max_n)
+            reply = {"messages": {}, "offsets": {}}
+            for batch_topic in msg["topics"]:
+                records = self._get_many(batch_topic, max_n)
+                reply["messages"][batch_topic] = [message for _, message in records]
+                if records:
+                    reply["offsets"][batch_topic] = records[-1][0]
+
+        elif action == "get_latest":
+            reply = self._advance(topic, self._get_latest(topic))
+
+        elif action == "get_latest_many":
+            reply = {"messages": {}, "offsets": {}}
+            for batch_topic in msg["topics"]:
+                batch_reply = self._advance(batch_topic, self._get_latest(batch_topic))
+                reply["messages"][batch_topic] = batch_reply["message"]
+                if batch_reply["offset"] is not None:
+                    reply["offsets"][batch_topic] = batch_reply["offset"]
+
+        elif action == "hello":
+            # The client lists the codecs it can speak, in order of preference.
+            # The reply, and everything after it, uses the one chosen.
+            self.codec = choose_codec(msg.get("codecs", []))
+            reply = {"codec": self.codec, "server_id": _server_id}
+
+        elif action == "share":
+            reply = self._share(topic, msg)
+
+        elif action == "set_retention":
+            try:
+                set_retention(topic, msg["policy"])
+            except ValueError as error:
+                # Clients check policies before sending them,
+                # but this one might not have.
+                self._report_error(topic, str(error))
+
+        elif action == "get_evictions":
+            with _evictions_lock:
+                reply = {"evictions": dict(_evictions)}
+
+        elif action == "get_memory_usage":
+            reply = {
+                "total": _store.n_bytes(),
+                "budget": _memory_budget,
+                "topics": {
+                    store_topic: _store.n_bytes(store_topic)
+                    for store_topic in _store.topics()
+                },
+            }
+
+        elif action == "subscribe":
+            # `topic` can be a pattern, like "robot1/arm/*"
+            with _subscribers_lock:
+                _subscribers.add(topic, self)
+            self.subscriptions.add(topic)
+
+        elif action == "unsubscribe":
+            self._unsubscribe(topic)
+
+        else:
+            raise RuntimeWarning(
+                "dsmq client action must either be\n"
+                + "'put', 'put_many', 'put_many_topics', "
+                + "'get', 'get_any', 'get_all', 'get_wait', 'get_many', "
+                + "'get_many_topics', "
+                + "'get_latest', 'get_latest_many', "
+                + "'subscribe', 'unsubscribe', 'share', "
+                + "'set_retention', 'get_evictions', 'get_memory_usage', "
+                + "'hello', or 'shutdown'"
+            )
+
+        if reply is not None and "id" in msg:
+            reply["id"] = msg["id"]
+        return reply
+
+    def push(self, topic, offset, message):
+        """
+        Send a newly put message straight to this subscriber.
+        It counts as read, so a later get() won't return it again.
+        """
+        self.next_offsets[topic] = offset + 1
+        try:
+            self.send(
+                {"action": "push", "topic": topic, "message": message, "offset": offset}
+            )
+        except (ConnectionClosedError, ConnectionClosedOK):
+            # The subscriber's handler will clean up after it.
+            pass
+
+    def close(self):
+        for topic in list(self.subscriptions):
+            self._unsubscribe(topic)
+        for pending_get in list(self.pending_gets):
+            pending_get.cancel()
+        with _shared_lock:
+            for topic, writer in list(_shared_writers.items()):
+                if writer is self:
+                    del _shared_writers[topic]
+
+    def _share(self, topic, msg):
+        """
+        Tell the client where to find the shared memory ring for `topic`,
+        creating it if there isn't one yet.
+        If the client asks to be the topic's writer, it gets to be,
+        unless another client already is. Rings only have room for one.
+        """
+        with _shared_lock:
+            try:
+                ring = _shared_rings[topic]
+            except KeyError:
+                ring = SharedRing.create(
+                    n_slots=msg.get("n_slots", _default_n_slots),
+                    slot_size=msg.get("slot_size", _default_slot_size),
+                )
+                _shared_rings[topic] = ring
+            reply = {"name": ring.name}
+            if msg.get("writer"):
+                reply["writer"] = _shared_writers.setdefault(topic, self) is self
+        return reply
+
+    def _hold_get(self, topics, timeout, request_id=None, group=None):
+        pending_get = PendingGet(self, topics, request_id, group)
+        self.pending_gets.add(pending_get)
+        with _waiters_lock:
+            for topic in topics:
+                _waiters.setdefault(topic, set()).add(pending_get)
+        pending_get.timer = self.schedule(timeout, pending_get.expire)
+
+        # In case a message arrived between the first look and now
+        pending_get.wake()
+
+    def _unsubscribe(self, topic):
+        with _subscribers_lock:
+            _subscribers.discard(topic, self)
+        self.subscriptions.discard(topic)
+
+    def _make_room(self, topic, messages):
+        """
+        Check whether `messages` fit in `topic` within the memory budget,
+        and if they don't, do what the topic's "when_full" policy says.
+        Returns True if the messages should be stored.
+        """
+        if _memory_budget is None:
+            return True
+        n_new_bytes = sum(message_size(message) for message in messages)
+        n_bytes_over = _store.n_bytes() + n_new_bytes - _memory_budget
+        if n_bytes_over <= 0:
+            return True
+
+        when_full = _policy(topic)["when_full"]
+        if when_full == "delay":
+            self.delay = _over_budget_delay
+            return True
+        if when_full == "drop_oldest":
+            n_bytes_to_keep = _store.n_bytes(topic) - n_bytes_over
+            if n_bytes_to_keep >= 0:
+                _evict(topic, max_bytes=n_bytes_to_keep)
+                return True
+        return False
+
+    def _acknowledge(self, msg, errors):
+        """
+        Let the client know how the put request in `msg` went.
+        `errors` is a dict of {topic: error} for the topics
+        whose messages weren't stored.
+
+        If the put carries a "seq", it gets an ack with that sequence number,
+        listing any errors, as the reply. Otherwise the client only
+        hears about errors.
+        """
+        if "seq" in msg:
+            return {
+                "action": "ack",
+                "topic": msg["topic"],
+                "seq": msg["seq"],
+                "errors": errors,
+            }
+        for topic, error in errors.items():
+            self._report_error(topic, error)
+        return None
+
+    def _report_error(self, topic, error):
+        """
+        Tell the client about a problem with a request that gets no reply.
+        """
+        try:
+            self.send({"action": "error", "topic": topic, "error": error})
+        except (ConnectionClosedError, ConnectionClosedOK):
+            pass
+
+    def _put(self, topic, message, via=()):
+        """
+        Returns an error message if `message` wasn't stored, otherwise None.
+        `via` lists the servers a bridged message has already been through.
+        """
+        with _budget_guard():
+            if not self._make_room(topic, [message]):
+                return _over_budget_error
+            (timestamp,) = new_timestamps(1)
+            offset = _store.put(topic, timestamp, message)
+        if offset is None:
+            return _store_busy_error
+        _remember_latest(topic, offset, message)
+        publish(topic, offset, message, via)
+        return None
+
+    def _put_many(self, topic, messages, via=()):
+        """
+        Returns an error message if `messages` weren't stored, otherwise None.
+        """
+        if not messages:
+            return None
+        with _budget_guard():
+            if not self._make_room(topic, messages):
+                return _over_budget_error
+            records = list(zip(new_timestamps(len(messages)), messages))
+            first_offset = _store.put_many(topic, records)
+        if first_offset is None:
+            return _store_busy_error
+        _remember_latest(topic, first_offset + len(messages) - 1, messages[-1])
+        for offset, message in enumerate(messages, first_offset):
+            publish(topic, offset, message, via)
+        return None
+
+    def _get_many(self, topic, max_n):
+        """
+        Returns a list of (offset, message) pairs.
+        """
+        records = _store.get_many(topic, self._next_offset(topic), max_n)
+        if records:
+            self.next_offsets[topic] = records[-1][0] + 1
+        return records
+
+    def _get_any(self, topics, group=None):
+        """
+        Returns (topic, offset, message) for the oldest unread message
+        in any of `topics`, or None if there isn't one.
+        With a consumer `group`, "unread" means unread by anyone in it.
+        """
+        if group is not None:
+            for topic in topics:
+                records = self._claim(topic, group, 1)
+                if records:
+                    return (topic, *records[0])
+            return None
+        if len(topics) == 1:
+            (topic,) = topics
+            result = _store.get(topic, self._next_offset(topic))
+            if result is None:
+                return None
+            return (topic, *result)
+        return _store.get_any({topic: self._next_offset(topic) for topic in topics})
+
+    def _get_latest(self, topic):
+        """
+        Returns (offset, message) for the newest message in `topic`, if this
+        client hasn't read past it already, or None otherwise.
+        """
+        with _latest_lock:
+            latest = _latest.get(topic)
+        if latest is None or latest[0] < self._next_offset(topic):
+            return None
+        return latest
+
+    def _claim(self, topic, group, max_n):
+        """
+        Take up to `max_n` of the oldest messages in `topic` that haven't
+        been handed to anyone in consumer `group` yet.
+        Returns a list of (offset, message) pairs.
+
+        Claiming a message moves the group's cursor past it, so no one else
+        in the group will get it. A new group starts reading from where
+        its first member would have on its own.
+        """
+        key = (topic, group)
+        with _groups_lock:
+            offset = _group_offsets.get(key)
+            if offset is None:
+                offset = self._next_offset(topic)
+            records = _store.get_many(topic, offset, max_n)
+            if records:
+                offset = records[-1][0] + 1
+            _group_offsets[key] = offset
+        return records
+
+    def _next_offset(self, topic):
+        try:
+            return self.next_offsets[topic]
+        except KeyError:
+            offset = _store.offset_after(topic, self.client_creation_time)
+            self.next_offsets[topic] = offset
+            return offset
+
+    def _seek(self, topic, msg, group=None):
+        """
+        If the request in `msg` asks to read from a particular offset,
+        move the read cursor for `topic` there. Reading carries on from
+        there, so older messages can be read again, or some skipped.
+        With a consumer `group`, it's the group's cursor that moves.
+        """
+        from_offset = msg.get("from_offset")
+        if from_offset is None:
+            return
+        if group is None:
+            self.next_offsets[topic] = from_offset
+        else:
+            with _groups_lock:
+                _group_offsets[(topic, group)] = from_offset
+
+    def _advance(self, topic, result):
+        """
+        Move the read cursor for `topic` past the message in `result`,
+        an (offset, message) pair, and return the reply for it.
+        """
+        if result is None:
+            # Handle the case where no results are returned
+            return {"message": "", "offset": None}
+        offset, message = result
+        self.next_offsets[topic] = offset + 1
+        return {"message": message, "offset": offset}
+
+    def _advance_any(self, result, group=None):
+        """
+        _advance() for a (topic, offset, message) result from _get_any().
+        The reply also says which topic the message came from.
+        Messages claimed for a consumer `group` have already moved
+        the group's cursor, and leave this client's own cursor alone.
+        """
+        if result is None:
+            return {"topic": None, "message": "", "offset": None}
+        topic, offset, message = result
+        if group is not None:
+            return {"topic": topic, "message": message, "offset": offset}
+        return {"topic": topic} | self._advance(topic, (offset, message))
+
+
+class PendingGet:
+    """
+    A get request that the server is holding open until a message
+    arrives in one of its topics or its timeout runs out,
+    whichever comes first. Exactly one reply gets sent.
+    """
+
+    def __init__(self, session, topics, request_id=None, group=None):
+        self.session = session
+        self.topics = topics
+        self.request_id = request_id
+        self.group = group
+        self.timer = None
+        self.done = False
+        self.lock = Lock()
+
+    def wake(self):
+        """
+        Called from the put path. Reply if there's now a message to read.
+        """
+        with self.lock:
+            if self.done:
+                return
+            result = self.session._get_any(self.topics, self.group)
+            if result is None:
+                return
+            self._finish(self.session._advance_any(result, self.group))
+
+    def expire(self):
+        with self.lock:
+            if self.done:
+                return
+            self._finish(self.session._advance_any(None))
+
+    def cancel(self):
+        with self.lock:
+            self.done = True
+            self._forget()
 
+    def _finish(self, reply):
+        self.done = True
+        self._forget()
+        if self.request_id is not None:
+            reply["id"] = self.request_id
+        try:
+            self.session.send(reply)
+        except (ConnectionClosedError, ConnectionClosedOK):
+            pass
+
+    def _forget(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        with _waiters_lock:
+            for topic in self.topics:
                 try:
-                    cursor.execute(
-                        """
-                        SELECT message,
-                        timestamp
-                        FROM messages
-                        WHERE topic = :topic
-                        AND timestamp > :last_read_time
-                        ORDER BY timestamp DESC
-                        LIMIT 1;
-                        """,
-                        msg,
-                    )
-                except sqlite3.OperationalError:
+                    _waiters[topic].discard(self)
+                    if not _waiters[topic]:
+                        del _waiters[topic]
+                except KeyError:
                     pass
+        self.session.pending_gets.discard(self)
 
-                try:
-                    result = cursor.fetchall()[0]
-                    message = result[0]
-                    timestamp = result[1]
-                    last_read_times[topic] = timestamp
-                except IndexError:
-                    # Handle the case where no results are returned
-                    message = ""
 
-                websocket.send(json.dumps({"message": message}))
+def new_timestamps(n):
+    """
+    Get `n` timestamps for new messages. They are close to the current time,
+    but each is guaranteed to be later than every one handed out before,
+    even when several messages arrive within the same clock tick.
+    """
+    global _last_timestamp
+    timestamps = []
+    with _timestamp_lock:
+        timestamp = max(time.time(), math.nextafter(_last_timestamp, math.inf))
+        for _ in range(n):
+            timestamps.append(timestamp)
+            timestamp = math.nextafter(timestamp, math.inf)
+        if timestamps:
+            _last_timestamp = timestamps[-1]
+    return timestamps
+
+
+def set_retention(topic, policy):
+    """
+    Set the retention limits for `topic`, or for every topic if it's "*".
+    Limits left out of `policy` fall back to those for "*".
+    Raises a ValueError for a limit or when_full policy it doesn't know.
+    """
+    check_policy(policy)
+    with _retention_lock:
+        _retention[topic] = _retention.get(topic, {}) | dict(policy)
+
+
+def sweep(stop_sweeping, verbose=False):
+    """
+    Every `_time_between_cleanup` seconds, evict the messages in every topic
+    that are beyond its retention limits, until `stop_sweeping` is set.
+    This keeps the work off the request path, and reaches topics
+    that no one is reading from or writing to anymore.
+    """
+    while not stop_sweeping.wait(_time_between_cleanup):
+        n_evicted = sweep_once()
+        if verbose and n_evicted:
+            print(f"Evicted {n_evicted} messages")
+    _store.disconnect()
+
+
+def sweep_once():
+    """
+    Returns the number of messages evicted.
+    """
+    n_evicted = 0
+    for topic in _store.topics():
+        policy = _policy(topic)
+        max_age = policy["max_age"]
+        n_evicted += _evict(
+            topic,
+            cutoff_time=None if max_age is None else time.time() - max_age,
+            max_length=policy["max_length"],
+            max_bytes=policy["max_bytes"],
+        )
+    return n_evicted
+
+
+def _policy(topic):
+    with _retention_lock:
+        return _retention["*"] | _retention.get(topic, {})
+
+
+def _evict(topic, **limits):
+    """
+    Evict messages from `topic` down to `limits`, as in the store's evict().
+    Returns the number of messages evicted.
+    """
+    n_evicted = _store.evict(topic, **limits)
+    if n_evicted:
+        with _evictions_lock:
+            _evictions[topic] = _evictions.get(topic, 0) + n_evicted
+        _forget_latest_if_evicted(topic)
+    return n_evicted
+
+
+def _budget_guard():
+    """
+    The lock to hold while checking the memory budget and storing,
+    or a stand-in that does nothing if there's no budget to check.
+    """
+    if _memory_budget is None:
+        return nullcontext()
+    return _budget_lock
+
+
+def _remember_latest(topic, offset, message):
+    with _latest_lock:
+        latest = _latest.get(topic)
+        # The store commits puts in offset order, but two clients' puts
+        # can still get from there to here in either order.
+        if latest is None or latest[0] < offset:
+            _latest[topic] = (offset, message)
+
+
+def _forget_latest_if_evicted(topic):
+    """
+    A topic's latest message can age out like any other.
+    Once it has, get_latest has nothing to return.
+    """
+    with _latest_lock:
+        latest = _latest.get(topic)
+    if latest is not None and _store.get(topic, latest[0]) is None:
+        with _latest_lock:
+            if _latest.get(topic) is latest:
+                del _latest[topic]
+
+
+def _close_shared_rings():
+    with _shared_lock:
+        for ring in _shared_rings.values():
+            ring.close()
+            ring.unlink()
+        _shared_rings.clear()
+
+
+def publish(topic, offset, message, via=()):
+    """
+    Hand a newly put message to every session subscribed to its topic,
+    or to a pattern matching it, then wake up any get requests
+    being held open on it, and pass it to any bridges carrying it on
+    to other servers.
+    """
+    with _subscribers_lock:
+        subscribers = _subscribers.match(topic)
+    for session in subscribers:
+        session.push(topic, offset, message)
+
+    with _waiters_lock:
+        waiters = list(_waiters.get(topic, ()))
+    for pending_get in waiters:
+        pending_get.wake()
+
+    for bridge in _bridges:
+        bridge.forward(topic, message, via)
+
+
+def request_handler(websocket):
+    global _store
+
+    def send(msg):
+        websocket.send(encode(msg, session.codec))
 
-            elif action == "shutdown":
+    session = ClientSession(send, _schedule_in_thread)
+
+    try:
+        for msg_text in websocket:
+            msg = decode(msg_text)
+
+            if msg["action"] == "shutdown":
                 # Run this from a separate thread to prevent deadlock
-                global dsmq_server
+                Thread(target=shutdown_gracefully).start()
+                break
 
-                def shutdown_gracefully(server_to_shutdown):
-                    server_to_shutdown.shutdown()
+            reply = session.respond(msg)
+            if session.delay:
+                # Before replying, so that a client waiting on acks waits too
+                time.sleep(session.delay)
+                session.delay = 0.0
+            if reply is not None:
+                send(reply)
 
-                Thread(target=shutdown_gracefully, args=(dsmq_server,)).start()
+    except (ConnectionClosedError, ConnectionClosedOK):
+        # Something happened on the other end and this handler
+        # is no longer needed.
+        pass
+
+    session.close()
+    _store.disconnect()
+
+
+def front_request_handler(websocket, uris):
+    """
+    The front of a sharded server only tells clients where the shards are,
+    in its reply to their hello, and passes shutdown requests on to them.
+    """
+    codec = "json"
+    try:
+        for msg_text in websocket:
+            msg = decode(msg_text)
+            if msg["action"] == "hello":
+                codec = choose_codec(msg.get("codecs", []))
+                websocket.send(encode({"codec": codec, "shards": uris}, codec))
+            elif msg["action"] == "shutdown":
+                # The front shuts itself down once the shards have stopped.
+                for shard_uri in uris:
+                    _shut_down_shard(shard_uri)
                 break
             else:
-                raise RuntimeWarning(
-                    "dsmq client action must either be\n"
-                    + "'put', 'get', 'get_wait', 'get_latest', or 'shutdown'"
-                )
+                error = {"action": "error", "topic": msg["topic"]}
+                websocket.send(encode(error | {"error": _sharded_error}, codec))
+    except (ConnectionClosedError, ConnectionClosedOK):
+        pass
 
-            # Periodically clean out messages to keep individual queues at
-            # a manageable length and the overall mq small.
-            if time.time() - time_of_last_purge > _time_between_cleanup:
-                cutoff_time = time.time() - _time_to_keep
-                try:
-                    cursor.execute(
-                        """
-                        DELETE
-                        FROM messages
-                        WHERE topic = :topic
-                        AND timestamp < :cutoff_time
-                        """,
-                        {
-                            "cutoff_time": cutoff_time,
-                            "topic": topic,
-                        },
-                    )
-                    sqlite_conn.commit()
-                    time_of_last_purge = time.time()
-
-                    cursor.execute(
-                        """
-                        DELETE
-                        FROM messages
-                        WHERE topic = :topic
-                        AND timestamp IN (
-                          SELECT timestamp
-                          FROM (
-                              SELECT timestamp,
-                              RANK() OVER (ORDER BY timestamp DESC) recency_rank
-                              FROM messages
-                              WHERE topic = :topic
-                          )
-                          WHERE recency_rank >= :max_queue_length
-                        )
-                        """,
-                        {
-                            "max_queue_length": _max_queue_length,
-                            "topic": topic,
-                        },
-                    )
-                    sqlite_conn.commit()
-                    time_of_last_purge = time.time()
-
-                except sqlite3.OperationalError:
-                    # Database may be locked. Try again next time.
-                    pass
+
+def _shut_down_shard(uri):
+    try:
+        shard = transport.connect(uri, max_size=_max_frame_size)
+    except ConnectionRefusedError:
+        # It's already down.
+        return
+    shard.send(encode({"action": "shutdown", "topic": ""}, "json"))
+    shard.close()
+
+
+async def async_request_handler(websocket):
+    """
+    The asyncio counterpart to request_handler(). All of these run
+    on the same event loop, but the sweeper uses the store
+    from its own thread, so the store still has to be thread-safe.
+
+    Everything sent to the client goes through an outbox queue.
+    That lets other sessions push messages to this one without
+    having to wait on its websocket.
+    """
+    outbox = asyncio.Queue()
+    session = ClientSession(outbox.put_nowait, asyncio.get_running_loop().call_later)
+    sender = asyncio.create_task(_send_from_outbox(websocket, outbox, session))
+
+    try:
+        async for msg_text in websocket:
+            msg = decode(msg_text)
+
+            if msg["action"] == "shutdown":
+                shutdown_gracefully()
+                break
+
+            reply = session.respond(msg)
+            if session.delay:
+                # Before replying, so that a client waiting on acks waits too
+                await asyncio.sleep(session.delay)
+                session.delay = 0.0
+            if reply is not None:
+                outbox.put_nowait(reply)
 
     except (ConnectionClosedError, ConnectionClosedOK):
         # Something happened on the other end and this handler
         # is no longer needed.
         pass
 
-    sqlite_conn.close()
+    session.close()
+    sender.cancel()
+
+
+def _schedule_in_thread(delay, fn):
+    timer = Timer(delay, fn)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+async def _send_from_outbox(websocket, outbox, session):
+    try:
+        while True:
+            msg = await outbox.get()
+            await websocket.send(encode(msg, session.codec))
+    except (ConnectionClosedError, ConnectionClosedOK):
+        pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,44 @@
+"""
+Spreading topics across several server processes, so that a busy server
+isn't held to what one Python interpreter can do.
+
+serve(workers=N) starts N shard servers, each in its own process,
+and a front server at the address clients connect to. Each topic belongs
+to exactly one shard, picked by hashing its name. The front doesn't
+handle any messages itself. It answers a client's hello with the
+addresses of the shards, and from then on the client talks to the shards
+directly, sending each request to the shard that owns its topic.
+"""
+
+import zlib
+from dsmq.transport import parse_uri
+
+
+def shard_uris(uri, n_shards):
+    """
+    Shard `i` listens on the front's port + 1 + i,
+    or for Unix sockets, at the front's path with ".i" added.
+    """
+    scheme, address = parse_uri(uri)
+    if scheme == "unix":
+        return [f"unix://{address}.{i_shard}" for i_shard in range(n_shards)]
+    host, port = address
+    return [f"{scheme}://{host}:{port + 1 + i_shard}" for i_shard in range(n_shards)]
+
+
+def shard_of(topic, n_shards):
+    """
+    crc32 rather than hash(), which gives different answers
+    in different processes.
+    """
+    return zlib.crc32(topic.encode("utf-8")) % n_shards
+
+
+def split_topics(topics, n_shards):
+    """
+    Returns {shard: list of topics}, for the shards that own any of `topics`.
+    """
+    topics_by_shard = {}
+    for topic in topics:
+        topics_by_shard.setdefault(shard_of(topic, n_shards), []).append(topic)
+    return topics_by_shard
@@ -0,0 +1,186 @@
+"""
+A ring buffer in shared memory, for passing a topic's messages between
+processes on the same machine without going through the server.
+
+The server creates the ring and tells clients its name, but after that
+messages go straight from the writer's memory to the readers'.
+There's one writer per topic, and as many readers as you like.
+Nothing is locked. Each reader keeps its own cursor, the sequence number
+of the next message it wants, and the writer never waits on a reader.
+A reader that falls more than a ring's length behind skips ahead to
+the oldest message still in the ring.
+
+The ring is a header followed by `n_slots` fixed-size slots.
+- The header holds `n_slots`, `slot_size`, and the number of messages
+  ever written, which is also the sequence number of the next one.
+- Message number `seq` goes in slot `seq % n_slots`. Each slot holds a
+  version, the message's size, its kind (str or bytes), and then
+  up to `slot_size` bytes of message.
+
+The version works like a seqlock. The writer sets it to 2 * seq + 1
+before it starts writing message `seq` and to 2 * seq + 2 when it's
+done. A reader checks the version before and after copying a message
+out. If either doesn't match 2 * seq + 2, the message was overwritten
+while it was being read, and the reader moves on.
+"""
+
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import struct
+import sys
+from threading import Lock
+from dsmq.codec import _flat_view
+
+_default_n_slots = 1024
+_default_slot_size = 4096  # bytes
+
+_ring_header = struct.Struct("QQQ")  # n_slots, slot_size, next seq
+_next_seq_offset = 16
+_uint64 = struct.Struct("Q")
+_slot_header = struct.Struct("QIB")  # version, size, kind
+_slot_header_size = 16
+_str = 0
+_bytes = 1
+
+# Swapping out the resource tracker's register() for attach()
+# mustn't happen from two threads at once.
+_attach_lock = Lock()
+
+
+class SharedRing:
+    def __init__(self, shm):
+        self.shm = shm
+        self.buf = shm.buf
+        self.n_slots, self.slot_size, _ = _ring_header.unpack_from(self.buf, 0)
+        self.slot_stride = _slot_header_size + self.slot_size
+
+    @classmethod
+    def create(cls, n_slots=_default_n_slots, slot_size=_default_slot_size):
+        size = _ring_header.size + n_slots * (_slot_header_size + slot_size)
+        shm = SharedMemory(create=True, size=size)
+        _ring_header.pack_into(shm.buf, 0, n_slots, slot_size, 0)
+        return cls(shm)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Open a ring created by another process.
+        """
+        if sys.version_info >= (3, 13):
+            return cls(SharedMemory(name=name, track=False))
+
+        # Before Python 3.13, attaching to shared memory also registers it
+        # with the resource tracker, which unlinks it when this process
+        # exits, pulling it out from under the server and every other client.
+        with _attach_lock:
+            register = resource_tracker.register
+            resource_tracker.register = lambda name, rtype: None
+            try:
+                return cls(SharedMemory(name=name))
+            finally:
+                resource_tracker.register = register
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def next_seq(self):
+        (next_seq,) = _uint64.unpack_from(self.buf, _next_seq_offset)
+        return next_seq
+
+    def put(self, message):
+        """
+        Only one process may put into a ring.
+        `message` can be a str, anything bytes-like,
+        or a tuple of bytes-like parts to be joined end to end.
+        """
+        if isinstance(message, str):
+            kind = _str
+            parts = [message.encode("utf-8")]
+        elif isinstance(message, tuple):
+            kind = _bytes
+            parts = [_flat_view(part) for part in message]
+        else:
+            kind = _bytes
+            parts = [_flat_view(message)]
+        size = sum(len(part) for part in parts)
+        if size > self.slot_size:
+            raise ValueError(
+                f"A {size} byte message won't fit in this topic's "
+                + f"{self.slot_size} byte shared memory slots."
+            )
+
+        seq = self.next_seq
+        i_slot = _ring_header.size + (seq % self.n_slots) * self.slot_stride
+        _slot_header.pack_into(self.buf, i_slot, 2 * seq + 1, 0, kind)
+        i_start = i_slot + _slot_header_size
+        for part in parts:
+            self.buf[i_start : i_start + len(part)] = part
+            i_start += len(part)
+        _slot_header.pack_into(self.buf, i_slot, 2 * seq + 2, size, kind)
+        _uint64.pack_into(self.buf, _next_seq_offset, seq + 1)
+
+    def get(self, cursor):
+        """
+        Get the oldest message at or after sequence number `cursor`.
+        Returns (message, the cursor for the message after it),
+        or (None, cursor) if there isn't one yet.
+        """
+        while True:
+            next_seq = self.next_seq
+            if cursor >= next_seq:
+                return None, cursor
+            # Anything older than this has been overwritten.
+            cursor = max(cursor, next_seq - self.n_slots)
+            message = self._read(cursor)
+            if message is not None:
+                return message, cursor + 1
+            cursor += 1
+
+    def get_latest(self, cursor):
+        """
+        Get the newest message at or after sequence number `cursor`,
+        skipping any older ones.
+        Returns (message, the cursor for the message after it),
+        or (None, cursor) if there isn't one yet.
+        """
+        while True:
+            next_seq = self.next_seq
+            if cursor >= next_seq:
+                return None, cursor
+            message = self._read(next_seq - 1)
+            if message is not None:
+                return message, next_seq
+            # It was overwritten mid-read, so there's a newer one.
+            cursor = next_seq
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+    def _read(self, seq):
+        """
+        Copy message number `seq` out of the ring.
+        Returns None if it was overwritten before it could be read.
+        """
+        i_slot = _ring_header.size + (seq % self.n_slots) * self.slot_stride
+        version, size, kind = _slot_header.unpack_from(self.buf, i_slot)
+        if version != 2 * seq + 2:
+            return None
+        i_start = i_slot + _slot_header_size
+        if kind == _str:
+            try:
+                message = str(self.buf[i_start : i_start + size], "utf-8")
+            except UnicodeDecodeError:
+                # Half overwritten
+                return None
+        else:
+            message = bytes(self.buf[i_start : i_start + size])
+        (version,) = _uint64.unpack_from(self.buf, i_slot)
+        if version != 2 * seq + 2:
+            return None
+        return message
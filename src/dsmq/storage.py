@@ -0,0 +1,838 @@
+"""
+Storage engines that hold the messages for a dsmq server.
+
+Every engine stores (offset, timestamp, topic, message) records and answers
+the handful of questions the server asks of it:
+- put a message, or a batch of messages, into a topic,
+  and say what offset it got, if it was stored,
+- get the oldest message (or messages) in a topic at or after an offset,
+- get the oldest message across several topics, each from its own offset,
+- get the newest message in a topic, if it's at or after an offset,
+- find the offset of the oldest message in a topic newer than a given time,
+- list the topics that hold messages,
+- evict messages to keep a topic within its retention limits,
+- count the bytes of messages held, in one topic or all of them.
+
+Each topic numbers its messages 0, 1, 2, ... in the order they're stored.
+Offsets are never reused, even after messages are evicted or a topic
+empties out, so a reader's position in a topic is a single integer.
+A write that fails can leave a gap.
+
+All engines are safe to share between the server's handler threads.
+"""
+
+from bisect import bisect_right
+import os
+import queue
+import sqlite3
+from threading import Event, Lock, Thread, local
+import time
+
+_default_ring_capacity = 10_000  # messages per topic
+_backends = ["sqlite", "sqlite_ingest", "ring"]
+# The most writes to commit together, and how long to wait for
+# more to arrive before committing the ones at hand
+_default_batch_size = 1000  # writes
+_default_batch_delay = 0.0  # seconds
+
+
+def open_store(backend="sqlite", name="mqdb"):
+    """
+    Create a storage engine by name.
+    - `backend` (str), one of "sqlite", "sqlite_ingest", or "ring".
+    - `name` (str), used to name the in-memory SQLite database.
+    """
+    if backend == "sqlite":
+        return SQLiteStore(name)
+    elif backend == "sqlite_ingest":
+        return SQLiteIngestStore(name)
+    elif backend == "ring":
+        return RingStore()
+    else:
+        raise ValueError(
+            f"Unknown dsmq storage backend '{backend}'. Try one of {_backends}."
+        )
+
+
+class SQLiteStore:
+    """
+    Messages live in a shared-cache in-memory SQLite database.
+    Each thread that touches the store gets its own connection.
+    """
+
+    def __init__(self, name="mqdb"):
+        # May occasionally create files with this name.
+        # https://sqlite.org/inmemorydb.html
+        # "...parts of a temporary database might be flushed to disk if the
+        # database becomes large or if SQLite comes under memory pressure."
+        self.db_name = f"file:{name}?mode=memory&cache=shared"
+        self._cleanup_temp_files()
+        self._local = local()
+
+        # Bytes of messages held in each topic, {topic: int}
+        self.topic_bytes = {}
+        self.bytes_lock = Lock()
+        # The offset the next message in each topic will get, {topic: int}
+        self.next_offsets = {}
+        # One past the newest offset stored in each topic, {topic: int}.
+        # Behind next_offsets while a put is on its way into the table.
+        self.stored_offsets = {}
+        self.offsets_lock = Lock()
+        # Held from handing out a put's offsets until it's committed,
+        # so that puts land in the table in offset order. Otherwise a reader
+        # could see offset n + 1 before n and move its cursor past n for good.
+        self.put_lock = Lock()
+
+        # Hang on to this connection for the life of the store.
+        # The in-memory database disappears when its last connection closes.
+        self._keeper_conn = sqlite3.connect(self.db_name, check_same_thread=False)
+        cursor = self._keeper_conn.cursor()
+
+        # Tweak the connection to make it faster
+        # and keep long-term latency more predictable.
+        # These also make it more susceptible to corruption during shutdown,
+        # but since dsmq is meant to be ephemeral, that's not a concern.
+        # See https://www.sqlite.org/pragma.html
+        # After playing around with them, I'm not sure these have any
+        # noticeable effect.
+        #
+        # cursor.execute("PRAGMA journal_mode = OFF")
+        # cursor.execute("PRAGMA journal_mode = MEMORY")
+        # cursor.execute("PRAGMA synchronous = NORMAL")
+        # cursor.execute("PRAGMA synchronous = OFF")
+        # cursor.execute("PRAGMA secure_delete = OFF")
+        # cursor.execute("PRAGMA temp_store = MEMORY")
+
+        cursor.execute("""
+CREATE TABLE IF NOT EXISTS messages (
+    topic_offset INTEGER, timestamp DOUBLE, topic TEXT, message TEXT
+)
+        """)
+        cursor.execute("""
+CREATE INDEX IF NOT EXISTS messages_by_offset ON messages (topic, topic_offset)
+        """)
+        self._keeper_conn.commit()
+
+    def _connection(self):
+        try:
+            return self._local.conn
+        except AttributeError:
+            self._local.conn = sqlite3.connect(self.db_name)
+            return self._local.conn
+
+    def put(self, topic, timestamp, message):
+        """
+        Returns the message's offset, or None if it wasn't stored.
+        """
+        return self.put_many(topic, [(timestamp, message)])
+
+    def put_many(self, topic, records):
+        """
+        Add a batch of (timestamp, message) pairs to `topic`
+        in a single transaction. They get consecutive offsets.
+        Returns the offset of the first, or None if they weren't stored.
+        An empty batch stores nothing, and returns the offset
+        the next message will get.
+        """
+        if not records:
+            return self._peek_offset(topic)
+        sqlite_conn = self._connection()
+        with self.put_lock:
+            try:
+                first_offset = self._new_offsets(topic, len(records))
+                _insert(sqlite_conn, topic, first_offset, records)
+                sqlite_conn.commit()
+            except sqlite3.OperationalError:
+                # The database is locked by another connection.
+                sqlite_conn.rollback()
+                return None
+            self._stored(topic, first_offset + len(records))
+        self._add_bytes(topic, sum(message_size(message) for _, message in records))
+        return first_offset
+
+    def get(self, topic, offset):
+        """
+        Returns (offset, message) for the oldest message at or after
+        `offset`, or None if there isn't one.
+        """
+        return _first_or_none(self._select(topic, offset, "ASC", 1))
+
+    def get_many(self, topic, offset, max_n):
+        """
+        Returns a list of up to `max_n` (offset, message) pairs,
+        the oldest messages at or after `offset`, oldest first.
+        """
+        return self._select(topic, offset, "ASC", max_n)
+
+    def get_latest(self, topic, offset):
+        """
+        Returns (offset, message) for the newest message, if it's at or after
+        `offset`, or None if it isn't.
+        """
+        return _first_or_none(self._select(topic, offset, "DESC", 1))
+
+    def get_any(self, offsets):
+        """
+        `offsets` is a dict of {topic: offset}. Returns (topic, offset, message)
+        for the oldest message in any of the topics at or after its offset,
+        or None if there isn't one.
+        """
+        if not offsets:
+            return None
+        cursors = ", ".join(["(?, ?)"] * len(offsets))
+        cursor = self._connection().cursor()
+        try:
+            cursor.execute(
+                f"""
+                WITH cursors (topic, topic_offset) AS (VALUES {cursors})
+                SELECT messages.topic,
+                messages.topic_offset,
+                messages.message
+                FROM messages
+                JOIN cursors
+                ON messages.topic = cursors.topic
+                AND messages.topic_offset >= cursors.topic_offset
+                ORDER BY messages.timestamp ASC
+                LIMIT 1
+                """,
+                [value for topic_offset in offsets.items() for value in topic_offset],
+            )
+        except sqlite3.OperationalError:
+            return None
+        return cursor.fetchone()
+
+    def offset_after(self, topic, timestamp):
+        """
+        The offset of the oldest message in `topic` newer than `timestamp`,
+        or if there isn't one, the offset after the newest one stored.
+        A put that's still on its way into the table has an offset
+        at least that large, so it won't be missed.
+        """
+        # Look this up before the table. A put that lands in between
+        # then shows up in the table rather than being skipped over.
+        with self.offsets_lock:
+            stored_offset = self.stored_offsets.get(topic, 0)
+        cursor = self._connection().cursor()
+        try:
+            cursor.execute(
+                """
+                SELECT MIN(topic_offset)
+                FROM messages
+                WHERE topic = :topic
+                AND timestamp > :timestamp
+                """,
+                {"topic": topic, "timestamp": timestamp},
+            )
+            (offset,) = cursor.fetchone()
+        except sqlite3.OperationalError:
+            offset = None
+        if offset is None:
+            return stored_offset
+        return offset
+
+    def _select(self, topic, offset, order, max_n):
+        cursor = self._connection().cursor()
+        try:
+            cursor.execute(
+                f"""
+                SELECT topic_offset,
+                message
+                FROM messages
+                WHERE topic = :topic
+                AND topic_offset >= :offset
+                ORDER BY topic_offset {order}
+                LIMIT :max_n
+                """,
+                {"topic": topic, "offset": offset, "max_n": max_n},
+            )
+        except sqlite3.OperationalError:
+            return []
+
+        return cursor.fetchall()
+
+    def _peek_offset(self, topic):
+        with self.offsets_lock:
+            return self.next_offsets.get(topic, 0)
+
+    def _new_offsets(self, topic, n):
+        """
+        Set aside `n` consecutive offsets in `topic`.
+        Returns the first.
+        """
+        with self.offsets_lock:
+            first_offset = self.next_offsets.get(topic, 0)
+            self.next_offsets[topic] = first_offset + n
+        return first_offset
+
+    def _stored(self, topic, next_offset):
+        with self.offsets_lock:
+            self.stored_offsets[topic] = max(
+                self.stored_offsets.get(topic, 0), next_offset
+            )
+
+    def topics(self):
+        cursor = self._connection().cursor()
+        try:
+            cursor.execute("SELECT DISTINCT topic FROM messages")
+        except sqlite3.OperationalError:
+            return []
+        return [topic for (topic,) in cursor.fetchall()]
+
+    def evict(self, topic, cutoff_time=None, max_length=None, max_bytes=None):
+        """
+        Delete messages in `topic` older than `cutoff_time`, all but the
+        most recent `max_length`, and the oldest ones beyond the most recent
+        `max_bytes` worth. Limits that are None don't apply.
+        Returns the number of messages deleted.
+        """
+        sqlite_conn = self._connection()
+        try:
+            n_evicted = _delete(sqlite_conn, topic, cutoff_time, max_length, max_bytes)
+            sqlite_conn.commit()
+        except sqlite3.OperationalError:
+            # Database may be locked. Try again next time.
+            sqlite_conn.rollback()
+            return 0
+
+        if n_evicted:
+            self._recount_bytes(topic)
+        return n_evicted
+
+    def n_bytes(self, topic=None):
+        """
+        The bytes of messages held in `topic`, or in all topics if it's None.
+        """
+        with self.bytes_lock:
+            if topic is None:
+                return sum(self.topic_bytes.values())
+            return self.topic_bytes.get(topic, 0)
+
+    def _add_bytes(self, topic, n_bytes):
+        with self.bytes_lock:
+            self.topic_bytes[topic] = self.topic_bytes.get(topic, 0) + n_bytes
+
+    def _recount_bytes(self, topic):
+        """
+        SQLite can't say how many bytes a DELETE removed, so after one,
+        count what's left instead.
+        """
+        cursor = self._connection().cursor()
+        try:
+            cursor.execute(
+                """
+                SELECT SUM(length(CAST(message AS BLOB)))
+                FROM messages
+                WHERE topic = :topic
+                """,
+                {"topic": topic},
+            )
+        except sqlite3.OperationalError:
+            return
+        (n_bytes,) = cursor.fetchone()
+        with self.bytes_lock:
+            if n_bytes:
+                self.topic_bytes[topic] = n_bytes
+            else:
+                self.topic_bytes.pop(topic, None)
+
+    def disconnect(self):
+        """
+        Close the calling thread's connection, if it has one.
+        """
+        try:
+            self._local.conn.close()
+            del self._local.conn
+        except AttributeError:
+            pass
+
+    def close(self):
+        self.disconnect()
+        self._keeper_conn.close()
+        self._cleanup_temp_files()
+
+    def _cleanup_temp_files(self):
+        # Under some condition
+        # (which I haven't yet been able to pin down)
+        # a file is generated with the db name.
+        # If it is not removed, it gets
+        # treated as a SQLite db on disk,
+        # which dramatically slows it down,
+        # especially the way it's used here for
+        # rapid-fire one-item reads and writes.
+        filenames = os.listdir()
+        for filename in filenames:
+            if filename[: len(self.db_name)] == self.db_name:
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+
+
+class SQLiteIngestStore(SQLiteStore):
+    """
+    A SQLiteStore where every write, put or evict, goes through
+    a single ingest thread, fed by a queue.
+
+    With only one connection ever writing, writers never run into each
+    other's table locks. The ingest thread takes whatever writes have piled
+    up while it was busy, up to `batch_size` of them, and commits them
+    together in one transaction, a group commit. If `batch_delay` is more
+    than zero, it also waits up to that many seconds for more to arrive.
+    Each caller still waits until its own write has been committed.
+
+    Readers keep their own connections. They read uncommitted rows, so that
+    they don't take table locks of their own and hold up the ingest thread.
+    """
+
+    def __init__(
+        self,
+        name="mqdb",
+        batch_size=_default_batch_size,
+        batch_delay=_default_batch_delay,
+    ):
+        super().__init__(name)
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.writes = queue.SimpleQueue()
+        self.ingest_thread = Thread(target=self._ingest, daemon=True)
+        self.ingest_thread.start()
+
+    def _connection(self):
+        try:
+            return self._local.conn
+        except AttributeError:
+            self._local.conn = sqlite3.connect(self.db_name)
+            self._local.conn.execute("PRAGMA read_uncommitted = true")
+            return self._local.conn
+
+    def put_many(self, topic, records):
+        """
+        Add a batch of (timestamp, message) pairs to `topic`.
+        They get consecutive offsets, handed out by the ingest thread,
+        so offsets are in the same order the messages are stored.
+        Returns the offset of the first once they've been stored,
+        or None if they couldn't be. An empty batch stores nothing.
+        """
+        if not records:
+            return self._peek_offset(topic)
+        return self._write(_PendingWrite("put", topic, records))
+
+    def evict(self, topic, cutoff_time=None, max_length=None, max_bytes=None):
+        """
+        Delete messages in `topic` older than `cutoff_time`, all but the
+        most recent `max_length`, and the oldest ones beyond the most recent
+        `max_bytes` worth. Limits that are None don't apply.
+        Returns the number of messages deleted.
+        """
+        return self._write(
+            _PendingWrite("evict", topic, cutoff_time, max_length, max_bytes)
+        )
+
+    def close(self):
+        self.writes.put(None)
+        self.ingest_thread.join()
+        super().close()
+
+    def _write(self, write):
+        self.writes.put(write)
+        write.done.wait()
+        return write.result
+
+    def _ingest(self):
+        stopping = False
+        while not stopping:
+            write = self.writes.get()
+            if write is None:
+                break
+            batch = [write]
+            stop_time = time.monotonic() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    timeout = stop_time - time.monotonic()
+                    if timeout > 0:
+                        write = self.writes.get(timeout=timeout)
+                    else:
+                        write = self.writes.get_nowait()
+                except queue.Empty:
+                    break
+                if write is None:
+                    stopping = True
+                    break
+                batch.append(write)
+            self._commit(batch)
+        self.disconnect()
+
+    def _commit(self, batch):
+        sqlite_conn = self._connection()
+        try:
+            for write in batch:
+                if write.action == "put":
+                    topic, records = write.args
+                    write.result = self._new_offsets(topic, len(records))
+                    _insert(sqlite_conn, topic, write.result, records)
+                else:
+                    write.result = _delete(sqlite_conn, *write.args)
+            sqlite_conn.commit()
+        except sqlite3.OperationalError:
+            sqlite_conn.rollback()
+            for write in batch:
+                # Puts report no offset and evicts report no messages deleted.
+                write.result = None if write.action == "put" else 0
+        else:
+            for write in batch:
+                topic = write.args[0]
+                if write.action == "put":
+                    records = write.args[1]
+                    n_bytes = sum(message_size(message) for _, message in records)
+                    self._add_bytes(topic, n_bytes)
+                    self._stored(topic, write.result + len(records))
+                elif write.result:
+                    self._recount_bytes(topic)
+        for write in batch:
+            write.done.set()
+
+
+class _PendingWrite:
+    """
+    A write waiting its turn in the ingest queue. `action` is either
+    "put", with `args` of (topic, records), or "evict", with `args`
+    of the arguments for _delete().
+    """
+
+    def __init__(self, action, *args):
+        self.action = action
+        self.args = args
+        self.done = Event()
+        self.result = None
+
+
+class RingStore:
+    """
+    Messages live in plain Python memory, in a fixed-size ring buffer
+    per topic. Once a topic's ring is full, each new message overwrites
+    the oldest one.
+
+    Each ring holds (offset, timestamp, message) records. Puts into a ring
+    never fail, so its offsets have no gaps, and finding a reader's next
+    message is a subtraction, O(1), rather than a search.
+    Timestamps within a topic only ever increase, so finding a message
+    by time is a binary search, O(log n).
+    """
+
+    def __init__(self, capacity=_default_ring_capacity):
+        self.capacity = capacity
+        self.rings = {}
+        # Bytes of messages held in each topic, {topic: int}
+        self.topic_bytes = {}
+        # The offset the next message in each topic will get, {topic: int}
+        # These outlive the rings, so offsets are never reused.
+        self.next_offsets = {}
+        self.lock = Lock()
+
+    def put(self, topic, timestamp, message):
+        """
+        Returns the message's offset.
+        """
+        with self.lock:
+            return self._append(topic, timestamp, message)
+
+    def put_many(self, topic, records):
+        """
+        Add a batch of (timestamp, message) pairs to `topic`.
+        They get consecutive offsets.
+        Returns the offset of the first. An empty batch stores nothing,
+        and returns the offset the next message will get.
+        """
+        with self.lock:
+            first_offset = self.next_offsets.get(topic, 0)
+            for timestamp, message in records:
+                self._append(topic, timestamp, message)
+        return first_offset
+
+    def get(self, topic, offset):
+        """
+        Returns (offset, message) for the oldest message at or after
+        `offset`, or None if there isn't one.
+        """
+        return _first_or_none(self.get_many(topic, offset, 1))
+
+    def get_many(self, topic, offset, max_n):
+        """
+        Returns a list of up to `max_n` (offset, message) pairs,
+        the oldest messages at or after `offset`, oldest first.
+        """
+        with self.lock:
+            try:
+                ring = self.rings[topic]
+            except KeyError:
+                return []
+            i_next = max(offset - ring[0][0], 0)
+            i_stop = min(i_next + max_n, len(ring))
+            return [(ring[i][0], ring[i][2]) for i in range(i_next, i_stop)]
+
+    def get_latest(self, topic, offset):
+        """
+        Returns (offset, message) for the newest message, if it's at or after
+        `offset`, or None if it isn't.
+        """
+        with self.lock:
+            try:
+                ring = self.rings[topic]
+            except KeyError:
+                return None
+            latest_offset, _, message = ring[-1]
+            if latest_offset < offset:
+                return None
+            return latest_offset, message
+
+    def get_any(self, offsets):
+        """
+        `offsets` is a dict of {topic: offset}. Returns (topic, offset, message)
+        for the oldest message in any of the topics at or after its offset,
+        or None if there isn't one.
+        """
+        oldest = None
+        with self.lock:
+            for topic, offset in offsets.items():
+                try:
+                    ring = self.rings[topic]
+                except KeyError:
+                    continue
+                i_next = max(offset - ring[0][0], 0)
+                if i_next >= len(ring):
+                    continue
+                record = ring[i_next]
+                if oldest is None or _timestamp(record) < _timestamp(oldest[1]):
+                    oldest = (topic, record)
+        if oldest is None:
+            return None
+        topic, (offset, _, message) = oldest
+        return topic, offset, message
+
+    def offset_after(self, topic, timestamp):
+        """
+        The offset of the oldest message in `topic` newer than `timestamp`,
+        or of the next message to be put, if there isn't one.
+        """
+        with self.lock:
+            ring = self.rings.get(topic, ())
+            i_after = bisect_right(ring, timestamp, key=_timestamp)
+            if i_after < len(ring):
+                return ring[i_after][0]
+            return self.next_offsets.get(topic, 0)
+
+    def topics(self):
+        with self.lock:
+            return list(self.rings)
+
+    def evict(self, topic, cutoff_time=None, max_length=None, max_bytes=None):
+        """
+        Drop messages in `topic` older than `cutoff_time`, all but the
+        most recent `max_length`, and the oldest ones beyond the most recent
+        `max_bytes` worth. Limits that are None don't apply.
+        Returns the number of messages dropped.
+        """
+        with self.lock:
+            try:
+                ring = self.rings[topic]
+            except KeyError:
+                return 0
+
+            n_drop = 0
+            if cutoff_time is not None:
+                n_drop = bisect_right(ring, cutoff_time, key=_timestamp)
+            if max_length is not None:
+                n_drop = max(n_drop, len(ring) - max_length)
+            if max_bytes is not None:
+                n_bytes = 0
+                for i in range(len(ring) - 1, n_drop - 1, -1):
+                    n_bytes += message_size(ring[i][2])
+                    if n_bytes > max_bytes:
+                        n_drop = i + 1
+                        break
+
+            self.topic_bytes[topic] -= sum(
+                message_size(ring[i][2]) for i in range(n_drop)
+            )
+            ring.drop_oldest(n_drop)
+
+            if len(ring) == 0:
+                # Let go of the whole ring, so that topics that go quiet
+                # don't keep holding on to memory.
+                del self.rings[topic]
+                del self.topic_bytes[topic]
+            return n_drop
+
+    def n_bytes(self, topic=None):
+        """
+        The bytes of messages held in `topic`, or in all topics if it's None.
+        """
+        with self.lock:
+            if topic is None:
+                return sum(self.topic_bytes.values())
+            return self.topic_bytes.get(topic, 0)
+
+    def disconnect(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            self.rings = {}
+            self.topic_bytes = {}
+
+    def _append(self, topic, timestamp, message):
+        """
+        Returns the new message's offset.
+        """
+        try:
+            ring = self.rings[topic]
+        except KeyError:
+            ring = _Ring(self.capacity)
+            self.rings[topic] = ring
+            self.topic_bytes[topic] = 0
+        if len(ring) == ring.capacity:
+            # The oldest message is about to be overwritten.
+            self.topic_bytes[topic] -= message_size(ring[0][2])
+        offset = self.next_offsets.get(topic, 0)
+        self.next_offsets[topic] = offset + 1
+        ring.append((offset, timestamp, message))
+        self.topic_bytes[topic] += message_size(message)
+        return offset
+
+
+def _insert(sqlite_conn, topic, first_offset, records):
+    """
+    Add (timestamp, message) pairs to `topic`, numbered from `first_offset`,
+    without committing.
+    """
+    sqlite_conn.executemany(
+        """
+        INSERT INTO messages (topic_offset, timestamp, topic, message)
+        VALUES (?, ?, ?, ?)
+        """,
+        [
+            (offset, timestamp, topic, message)
+            for offset, (timestamp, message) in enumerate(records, first_offset)
+        ],
+    )
+
+
+def _delete(sqlite_conn, topic, cutoff_time, max_length, max_bytes):
+    """
+    The SQL behind SQLiteStore.evict(), without committing.
+    Returns the number of messages deleted.
+    """
+    n_changes = sqlite_conn.total_changes
+    if cutoff_time is not None:
+        sqlite_conn.execute(
+            """
+            DELETE
+            FROM messages
+            WHERE topic = :topic
+            AND timestamp < :cutoff_time
+            """,
+            {"topic": topic, "cutoff_time": cutoff_time},
+        )
+
+    if max_length is not None:
+        # Everything from the first message past the limit back
+        sqlite_conn.execute(
+            """
+            DELETE
+            FROM messages
+            WHERE topic = :topic
+            AND topic_offset <= (
+              SELECT topic_offset
+              FROM messages
+              WHERE topic = :topic
+              ORDER BY topic_offset DESC
+              LIMIT 1 OFFSET :max_length
+            )
+            """,
+            {"topic": topic, "max_length": max_length},
+        )
+
+    if max_bytes is not None:
+        sqlite_conn.execute(
+            """
+            DELETE
+            FROM messages
+            WHERE topic = :topic
+            AND topic_offset IN (
+              SELECT topic_offset
+              FROM (
+                  SELECT topic_offset,
+                  SUM(length(CAST(message AS BLOB)))
+                    OVER (ORDER BY topic_offset DESC) newer_bytes
+                  FROM messages
+                  WHERE topic = :topic
+              )
+              WHERE newer_bytes > :max_bytes
+            )
+            """,
+            {"topic": topic, "max_bytes": max_bytes},
+        )
+    return sqlite_conn.total_changes - n_changes
+
+
+def _timestamp(record):
+    return record[1]
+
+
+def message_size(message):
+    """
+    The number of bytes in `message`, UTF-8 encoded if it's a str.
+    """
+    if isinstance(message, str):
+        if message.isascii():
+            # This is quick. It doesn't have to look at every character.
+            return len(message)
+        return len(message.encode("utf-8"))
+    return memoryview(message).nbytes
+
+
+def _first_or_none(records):
+    try:
+        return records[0]
+    except IndexError:
+        # Handle the case where no results are returned
+        return None
+
+
+class _Ring:
+    """
+    A fixed-capacity circular buffer that supports len() and indexing,
+    oldest item first, which is all bisect needs.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = [None] * capacity
+        self.i_start = 0
+        self.n_items = 0
+
+    def __len__(self):
+        return self.n_items
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.n_items
+        if i < 0 or i >= self.n_items:
+            raise IndexError("ring index out of range")
+        return self.buffer[(self.i_start + i) % self.capacity]
+
+    def append(self, item):
+        if self.n_items < self.capacity:
+            self.buffer[(self.i_start + self.n_items) % self.capacity] = item
+            self.n_items += 1
+        else:
+            # Overwrite the oldest item
+            self.buffer[self.i_start] = item
+            self.i_start = (self.i_start + 1) % self.capacity
+
+    def drop_oldest(self, n):
+        n = min(max(n, 0), self.n_items)
+        for _ in range(n):
+            self.buffer[self.i_start] = None
+            self.i_start = (self.i_start + 1) % self.capacity
+        self.n_items -= n
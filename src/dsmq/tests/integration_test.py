@@ -8,10 +8,17 @@ except RuntimeError:
     # Will throw an error if the start method has alraedy been set.
     pass
 
+import asyncio
+from threading import Thread, Timer
 import time
-from dsmq.server import serve
-from dsmq.client import connect
-
+import pytest
+from websockets.protocol import State
+from dsmq import aio
+from dsmq.bridge import Bridge
+from dsmq.server import _time_between_cleanup, serve
+from dsmq.storage import open_store
+from dsmq.client import BufferedProducer, Pool, Prefetcher, connect
+from dsmq.codec import encode
 
 host = "127.0.0.1"
 port = 30303
@@ -22,8 +29,21 @@ _long_pause = 0.1
 _very_long_pause = 2.0
 
 
-def test_client_server():
-    p_server = mp.Process(target=serve, args=(host, port))
+@pytest.fixture(
+    params=[
+        {"backend": "sqlite", "engine": "sync"},
+        {"backend": "sqlite_ingest", "engine": "sync"},
+        {"backend": "ring", "engine": "sync"},
+        {"backend": "ring", "engine": "async"},
+    ],
+    ids=["sqlite-sync", "sqlite_ingest-sync", "ring-sync", "ring-async"],
+)
+def server_options(request):
+    return request.param
+
+
+def test_client_server(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
     p_server.start()
     mq = connect(host, port)
     read_completes = False
@@ -54,8 +74,8 @@ def test_client_server():
     assert closed
 
 
-def test_write_one_read_one():
-    p_server = mp.Process(target=serve, args=(host, port))
+def test_write_one_read_one(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
     p_server.start()
     write_client = connect(host, port)
     read_client = connect(host, port)
@@ -81,8 +101,8 @@ def test_write_one_read_one():
     read_client.close()
 
 
-def test_get_wait():
-    p_server = mp.Process(target=serve, args=(host, port))
+def test_get_wait(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
     p_server.start()
     write_client = connect(host, port)
     read_client = connect(host, port)
@@ -98,8 +118,116 @@ def test_get_wait():
     read_client.close()
 
 
-def test_get_latest():
-    p_server = mp.Process(target=serve, args=(host, port))
+def test_get_timeout(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    write_client = connect(host, port)
+    read_client = connect(host, port)
+
+    # With nothing to read, the reply comes back empty once time runs out
+    start_time = time.time()
+    msg = read_client.get("test", timeout=_long_pause)
+    assert msg == ""
+    assert time.time() - start_time >= _long_pause
+
+    # A put while the get is being held open answers it right away
+    Timer(_long_pause, write_client.put, args=("test", "test_msg")).start()
+    start_time = time.time()
+    msg = read_client.get("test", timeout=_very_long_pause)
+    assert msg == "test_msg"
+    assert time.time() - start_time < _very_long_pause
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+
+
+def test_get_any(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    write_client = connect(host, port)
+    read_client = connect(host, port)
+    topics = ["test_A", "test_B", "test_C"]
+
+    assert read_client.get_any(topics) == (None, "")
+
+    write_client.put("test_B", "test_msg B")
+    write_client.put("test_A", "test_msg A")
+    time.sleep(_pause)
+    assert read_client.get_any(topics) == ("test_B", "test_msg B")
+    assert read_client.get_any(topics) == ("test_A", "test_msg A")
+    assert read_client.get_any(topics) == (None, "")
+
+    # A put in any of the topics answers a get that's being held open.
+    Timer(_long_pause, write_client.put, args=("test_C", "test_msg C")).start()
+    start_time = time.time()
+    assert read_client.get_any(topics, timeout=_very_long_pause) == (
+        "test_C",
+        "test_msg C",
+    )
+    assert time.time() - start_time < _very_long_pause
+
+    write_client.put_many("test_A", ["test_msg A1", "test_msg A2"])
+    write_client.put("test_B", "test_msg B1")
+    time.sleep(_pause)
+    assert read_client.get_all(topics) == {
+        "test_A": "test_msg A1",
+        "test_B": "test_msg B1",
+        "test_C": "",
+    }
+    assert read_client.get_all(topics)["test_A"] == "test_msg A2"
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+
+
+@pytest.mark.parametrize("engine", ["sync", "async"])
+@pytest.mark.parametrize("scheme", ["tcp", "unix"])
+def test_socket_transports(scheme, engine, tmp_path):
+    if scheme == "tcp":
+        uri = f"tcp://{host}:{port}"
+    else:
+        uri = f"unix://{tmp_path / 'dsmq.sock'}"
+    p_server = mp.Process(
+        target=serve, args=(uri,), kwargs={"backend": "ring", "engine": engine}
+    )
+    p_server.start()
+    write_client = connect(uri)
+    read_client = connect(uri)
+    read_client.subscribe("test_pushed")
+
+    write_client.put("test", "test_msg")
+    write_client.put("test", b"\x00" * 100_000)
+    write_client.put("test_pushed", "pushed_msg")
+    time.sleep(_pause)
+
+    assert read_client.get("test") == "test_msg"
+    assert bytes(read_client.get("test")) == b"\x00" * 100_000
+    assert read_client.get("test") == ""
+    assert list(read_client.listen(timeout=_long_pause)) == [
+        ("test_pushed", "pushed_msg")
+    ]
+
+    async def get_async():
+        mq = await aio.connect(uri)
+        msg, _ = await asyncio.gather(
+            mq.get("test", timeout=_very_long_pause), mq.put("test", "async_msg")
+        )
+        await mq.close()
+        return msg
+
+    assert asyncio.run(get_async()) == "async_msg"
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+    p_server.join(_very_long_pause)
+    assert not p_server.is_alive()
+
+
+def test_get_latest(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
     p_server.start()
     write_client = connect(host, port)
     read_client = connect(host, port)
@@ -121,8 +249,109 @@ def test_get_latest():
     read_client.close()
 
 
-def test_multitopics():
-    p_server = mp.Process(target=serve, args=(host, port))
+def test_get_latest_many(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    write_client = connect(host, port)
+    write_client.put("test_old", "test_msg old")
+    time.sleep(_pause)
+    read_client = connect(host, port)
+
+    write_client.put_many("test_A", [f"test_msg A{i}" for i in range(5)])
+    write_client.put("test_B", "test_msg B")
+    time.sleep(_pause)
+    topics = ["test_A", "test_B", "test_old", "test_none"]
+    msgs = read_client.get_latest_many(topics)
+
+    assert msgs == {
+        "test_A": "test_msg A4",
+        "test_B": "test_msg B",
+        "test_old": "",
+        "test_none": "",
+    }
+    assert read_client.offsets == {"test_A": 4, "test_B": 0}
+    assert read_client.get_latest_many(topics) == {topic: "" for topic in topics}
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+
+
+def test_offsets(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    write_client = connect(host, port)
+    read_client = connect(host, port)
+
+    write_client.put_many("test", [f"msg_{i}" for i in range(5)])
+    time.sleep(_pause)
+    assert read_client.get("test") == "msg_0"
+    assert read_client.offsets["test"] == 0
+    assert read_client.get_many("test") == ["msg_1", "msg_2", "msg_3", "msg_4"]
+    assert read_client.offsets["test"] == 4
+
+    # Replay from an earlier offset, then carry on from there.
+    assert read_client.get("test", from_offset=2) == "msg_2"
+    assert read_client.get("test") == "msg_3"
+    assert read_client.get_many("test", max_n=2, from_offset=0) == ["msg_0", "msg_1"]
+
+    write_client.put("test", "msg_5")
+    time.sleep(_pause)
+    assert read_client.get_latest("test") == "msg_5"
+    assert read_client.offsets["test"] == 5
+    assert read_client.get("test", from_offset=6) == ""
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+
+
+def test_consumer_groups(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    write_client = connect(host, port)
+    workers = [connect(host, port) for _ in range(3)]
+    read_client = connect(host, port)
+
+    write_client.put_many("test", [f"msg_{i}" for i in range(9)])
+    time.sleep(_pause)
+
+    # Each message goes to exactly one member of the group.
+    assert workers[0].get("test", group="workers") == "msg_0"
+    assert workers[1].get("test", group="workers") == "msg_1"
+    assert workers[2].get_many("test", max_n=3, group="workers") == [
+        "msg_2",
+        "msg_3",
+        "msg_4",
+    ]
+    assert workers[0].get("test", group="workers") == "msg_5"
+    assert workers[0].offsets["test"] == 5
+
+    # Other groups, and clients outside of any group, read everything.
+    assert workers[1].get("test", group="auditors") == "msg_0"
+    assert len(read_client.get_many("test")) == 9
+
+    # Replay for the whole group
+    assert workers[1].get("test", from_offset=1, group="workers") == "msg_1"
+    assert workers[2].get("test", group="workers") == "msg_2"
+
+    # A held get is answered from the group's cursor too.
+    assert workers[0].get_many("test", group="workers") == [
+        f"msg_{i}" for i in range(3, 9)
+    ]
+    Timer(_long_pause, write_client.put, args=("test", "msg_9")).start()
+    assert workers[1].get("test", timeout=_very_long_pause, group="workers") == "msg_9"
+    assert workers[2].get("test", group="workers") == ""
+
+    write_client.shutdown_server()
+    write_client.close()
+    for worker in workers:
+        worker.close()
+    read_client.close()
+
+
+def test_multitopics(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
     p_server.start()
     write_client = connect(host, port)
     read_client = connect(host, port)
@@ -141,8 +370,507 @@ def test_multitopics():
     read_client.close()
 
 
-def test_client_history_cutoff():
-    p_server = mp.Process(target=serve, args=(host, port))
+def test_put_many_get_many(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    write_client = connect(host, port)
+    read_client = connect(host, port)
+
+    write_client.put_many("test", [f"test_msg {i}" for i in range(5)])
+    write_client.put_many_topics({"test_A": ["test_msg_A"], "test_B": ["test_msg_B"]})
+    time.sleep(_pause)
+
+    msgs = read_client.get_many("test", max_n=3)
+    assert msgs == ["test_msg 0", "test_msg 1", "test_msg 2"]
+    msgs = read_client.get_many("test", max_n=3)
+    assert msgs == ["test_msg 3", "test_msg 4"]
+    msgs = read_client.get_many("test")
+    assert msgs == []
+
+    msgs = read_client.get_many_topics(["test_A", "test_B", "test_C"])
+    assert msgs == {"test_A": ["test_msg_A"], "test_B": ["test_msg_B"], "test_C": []}
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+
+
+def test_put_empty_batches(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    write_client = connect(host, port, ack_window=4)
+    read_client = connect(host, port)
+
+    write_client.put_many("test", [])
+    write_client.put_many_topics({"test": [], "test_b": ["msg_b"]})
+    write_client.put("test", "msg_a")
+    assert write_client.flush(timeout=_very_long_pause) == []
+    assert write_client.unacked == {}
+    assert read_client.get_many("test") == ["msg_a"]
+    assert read_client.get_many("test_b") == ["msg_b"]
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+
+
+def test_store_empty_batches(server_options):
+    store = open_store(server_options["backend"], name="test_empty_batches")
+    assert store.put_many("test", []) == 0
+    assert store.put("test", time.time(), "msg_a") == 0
+    assert store.put_many("test", []) == 1
+    assert store.get_many("test", 0, 10) == [(0, "msg_a")]
+    store.close()
+
+
+def test_concurrent_puts_read_live(server_options):
+    retention = {"*": {"max_length": None, "max_age": None}}
+    p_server = mp.Process(
+        target=serve,
+        args=(host, port),
+        kwargs=server_options | {"retention": retention},
+    )
+    p_server.start()
+    n_writers = 8
+    n_puts = 200
+    read_client = connect(host, port)
+    write_clients = [connect(host, port, ack_window=1) for _ in range(n_writers)]
+    failed_puts = []
+
+    def write(write_client):
+        for i in range(n_puts):
+            write_client.put("test", f"msg_{i}")
+        failed_puts.extend(write_client.flush(timeout=_very_long_pause))
+
+    threads = [Thread(target=write, args=(client,)) for client in write_clients]
+    for thread in threads:
+        thread.start()
+    # Read while the puts are still landing. No message should be passed over.
+    n_received = 0
+    stop_time = time.time() + _very_long_pause
+    while time.time() < stop_time:
+        n_received += len(read_client.get_many("test", max_n=1000))
+        if n_received + len(failed_puts) >= n_writers * n_puts:
+            break
+    for thread in threads:
+        thread.join()
+    n_received += len(read_client.get_many("test", max_n=1000))
+    assert n_received + len(failed_puts) == n_writers * n_puts
+
+    read_client.shutdown_server()
+    read_client.close()
+    for write_client in write_clients:
+        write_client.close()
+
+
+def test_codecs(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    json_client = connect(host, port, codec="json")
+    binary_client = connect(host, port, codec="binary")
+
+    assert json_client.codec == "json"
+    assert binary_client.codec == "binary"
+
+    long_msg = 'quotes " and backslashes \\ and ünïcödé ' * 1000
+    json_client.put("test", long_msg)
+    binary_client.put_many_topics({"test_A": ["msg_A", long_msg], "test_B": [""]})
+    time.sleep(_pause)
+
+    msg = binary_client.get("test")
+    assert msg == long_msg
+    msgs = json_client.get_many_topics(["test_A", "test_B"])
+    assert msgs == {"test_A": ["msg_A", long_msg], "test_B": [""]}
+
+    json_client.shutdown_server()
+    json_client.close()
+    binary_client.close()
+
+
+def test_bytes_messages(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    write_client = connect(host, port, codec="json")
+    read_client = connect(host, port)
+
+    binary_msg = bytes(range(256)) * 100
+    write_client.put("test", binary_msg)
+    write_client.put_many("test", [b"", bytearray(b"abc"), "text_msg"])
+    time.sleep(_pause)
+
+    msg = read_client.get("test")
+    assert isinstance(msg, memoryview)
+    assert msg == binary_msg
+
+    msgs = read_client.get_many("test")
+    assert [bytes(msg) for msg in msgs[:2]] == [b"", b"abc"]
+    assert msgs[2] == "text_msg"
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+
+
+def test_arrays(server_options):
+    np = pytest.importorskip("numpy")
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    write_client = connect(host, port)
+    read_client = connect(host, port)
+
+    frame = np.arange(480 * 640 * 3, dtype=np.uint16).reshape(480, 640, 3)
+    features = np.linspace(0, 1, 7)[::2]
+    write_client.put_array("test_frames", frame)
+    write_client.put_array("test_features", features)
+    time.sleep(_pause)
+
+    array = read_client.get_array("test_frames", timeout=_very_long_pause)
+    assert array.dtype == frame.dtype
+    np.testing.assert_array_equal(array, frame)
+    np.testing.assert_array_equal(
+        read_client.get_array("test_features", timeout=_very_long_pause), features
+    )
+    assert read_client.get_array("test_features") is None
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+
+
+def test_shared_topics(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    write_client = connect(host, port)
+    read_client = connect(host, port)
+    other_client = connect(host, port)
+
+    write_client.share("test_shared", n_slots=4, slot_size=64)
+    read_client.share("test_shared")
+    other_client.share("test_shared")
+
+    write_client.put("test_shared", "test_msg")
+    write_client.put("test_shared", b"test_bytes")
+    assert read_client.get("test_shared") == "test_msg"
+    assert read_client.get("test_shared") == b"test_bytes"
+    assert read_client.get("test_shared") == ""
+    assert other_client.get_latest("test_shared") == b"test_bytes"
+
+    # Readers that fall behind skip ahead to the oldest message left.
+    write_client.put_many("test_shared", [f"msg_{i}" for i in range(10)])
+    assert read_client.get_many("test_shared") == [f"msg_{i}" for i in range(6, 10)]
+
+    # A held-open get catches a message put while it waits
+    Timer(_long_pause, write_client.put, args=("test_shared", "late_msg")).start()
+    assert read_client.get("test_shared", timeout=_very_long_pause) == "late_msg"
+
+    with pytest.raises(RuntimeError):
+        read_client.put("test_shared", "second_writer")
+    with pytest.raises(ValueError):
+        write_client.put("test_shared", "x" * 100)
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+    other_client.close()
+
+
+def test_retention(server_options):
+    retention = {
+        "*": {"max_length": None, "max_age": None},
+        "test_length": {"max_length": 3},
+    }
+    p_server = mp.Process(
+        target=serve,
+        args=(host, port),
+        kwargs=server_options | {"retention": retention},
+    )
+    p_server.start()
+    write_client = connect(host, port)
+    read_client = connect(host, port)
+
+    write_client.set_retention("test_bytes", max_bytes=10)
+    for topic in ["test_length", "test_bytes", "test_unlimited"]:
+        write_client.put_many(topic, [f"msg_{i}" for i in range(5)])
+
+    # Give the sweeper a chance to run
+    time.sleep(_time_between_cleanup + _very_long_pause)
+
+    assert read_client.get_many("test_length") == ["msg_2", "msg_3", "msg_4"]
+    assert read_client.get_many("test_bytes") == ["msg_3", "msg_4"]
+    assert len(read_client.get_many("test_unlimited")) == 5
+    assert read_client.get_evictions() == {"test_length": 2, "test_bytes": 3}
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+
+
+def test_bad_retention_policy(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    client = connect(host, port)
+
+    with pytest.raises(ValueError):
+        client.set_retention("test", max_len=3)
+    with pytest.raises(ValueError):
+        client.set_retention("test", when_full="wait")
+
+    # A client that doesn't check hears about it, and stays connected.
+    msg = {"action": "set_retention", "topic": "test", "policy": {"max_len": 3}}
+    client.websocket.send(encode(msg, client.codec))
+    client.put("test", "msg_a")
+    assert client.get_latest("test") == "msg_a"
+    assert [topic for topic, _ in client.errors] == ["test"]
+
+    client.shutdown_server()
+    client.close()
+
+
+def test_memory_budget(server_options):
+    retention = {"*": {"max_length": None, "max_age": None}}
+    p_server = mp.Process(
+        target=serve,
+        args=(host, port),
+        kwargs=server_options | {"retention": retention, "memory_budget": 100},
+    )
+    p_server.start()
+    write_client = connect(host, port)
+    read_client = connect(host, port)
+
+    write_client.set_retention("test_reject", when_full="reject")
+    write_client.set_retention("test_delay", when_full="delay")
+    write_client.put_many("test_drop", [f"msg_{i}" for i in range(10)])
+    write_client.put_many("test_reject", [f"msg_{i}" for i in range(10)])
+
+    # Over budget
+    write_client.put("test_drop", "msg_a")
+    write_client.put("test_reject", "msg_b")
+    usage = write_client.get_memory_usage()
+    assert usage["total"] == 100
+    assert usage["topics"] == {"test_drop": 50, "test_reject": 50}
+    assert [topic for topic, _ in write_client.errors] == ["test_reject"]
+
+    assert read_client.get_many("test_drop")[-2:] == ["msg_9", "msg_a"]
+    assert read_client.get_many("test_reject")[-1] == "msg_9"
+    assert read_client.get_evictions() == {"test_drop": 1}
+
+    # Puts over budget slow the client down, but still get through.
+    start_time = time.time()
+    for i in range(5):
+        write_client.put("test_delay", f"msg_{i}")
+    assert write_client.get_memory_usage()["total"] == 125
+    assert time.time() - start_time >= 0.04
+
+    # The ack waits too.
+    ack_client = connect(host, port, ack_window=4)
+    start_time = time.time()
+    ack_client.put("test_delay", "msg_5")
+    assert ack_client.flush(timeout=_very_long_pause) == []
+    assert time.time() - start_time >= 0.01
+    ack_client.close()
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+
+
+def test_memory_budget_concurrent_puts(server_options):
+    retention = {"*": {"max_length": None, "max_age": None, "when_full": "reject"}}
+    p_server = mp.Process(
+        target=serve,
+        args=(host, port),
+        kwargs=server_options | {"retention": retention, "memory_budget": 100},
+    )
+    p_server.start()
+    clients = [connect(host, port) for _ in range(8)]
+
+    def put_all(client, i_client):
+        for i in range(20):
+            client.put("test", f"m{i_client}_{i:02d}")
+
+    # However the puts interleave, no two of them fit in the same room.
+    threads = [
+        Thread(target=put_all, args=(client, i)) for i, client in enumerate(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for client in clients:
+        client.get_memory_usage()
+    assert clients[0].get_memory_usage()["total"] == 100
+    assert len(clients[0].get_many("test", max_n=1000)) == 20
+
+    clients[0].shutdown_server()
+    for client in clients:
+        client.close()
+
+
+def test_put_acks(server_options):
+    retention = {"*": {"max_length": None, "max_age": None}}
+    p_server = mp.Process(
+        target=serve,
+        args=(host, port),
+        kwargs=server_options | {"retention": retention, "memory_budget": 100},
+    )
+    p_server.start()
+    write_client = connect(host, port, ack_window=4)
+    read_client = connect(host, port)
+
+    write_client.set_retention("test_reject", when_full="reject")
+    for i in range(10):
+        write_client.put("test_drop", f"msg_{i}")
+    write_client.put_many("test_reject", [f"msg_{i}" for i in range(10)])
+    assert write_client.flush(timeout=_very_long_pause) == []
+    assert read_client.get_memory_usage()["total"] == 100
+
+    # Over budget. The rejected messages come back to be put again.
+    write_client.put_many_topics({"test_drop": ["msg_a"], "test_reject": ["msg_b"]})
+    write_client.put("test_reject", "msg_c")
+    failed_puts = write_client.flush(timeout=_very_long_pause)
+    assert [(topic, msg) for topic, msg, _ in failed_puts] == [
+        ("test_reject", "msg_b"),
+        ("test_reject", "msg_c"),
+    ]
+    assert write_client.unacked == {}
+    assert list(write_client.errors) == []
+    assert read_client.get_many("test_drop")[-1] == "msg_a"
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+
+
+def test_buffered_producer(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    producer = BufferedProducer(connect(host, port), linger=_long_pause, max_n=5)
+    read_client = connect(host, port)
+
+    # Held back until the linger runs out
+    producer.put_many("test", ["msg_0", "msg_1", "msg_2"])
+    assert read_client.get_many("test") == []
+    time.sleep(2 * _long_pause)
+    assert read_client.get_many("test") == ["msg_0", "msg_1", "msg_2"]
+
+    # Sent as soon as there are max_n, and the rest on close()
+    producer.put_many("test", [f"msg_{i}" for i in range(3, 9)])
+    time.sleep(_pause)
+    assert read_client.get_many("test") == ["msg_3", "msg_4", "msg_5", "msg_6", "msg_7"]
+    producer.close()
+    time.sleep(_pause)
+    assert read_client.get_many("test") == ["msg_8"]
+
+    # max_bytes counts UTF-8 bytes, not characters.
+    producer = BufferedProducer(connect(host, port), linger=10.0, max_bytes=8)
+    producer.put_many("test", ["ééé", "éé"])
+    time.sleep(_pause)
+    assert read_client.get_many("test") == ["ééé", "éé"]
+    producer.close()
+
+    read_client.shutdown_server()
+    read_client.close()
+
+
+def test_prefetcher(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    prefetcher = Prefetcher(connect(host, port), "test", min_depth=4)
+    write_client = connect(host, port)
+
+    write_client.put_many("test", [f"msg_{i}" for i in range(30)])
+    time.sleep(_long_pause)
+    for i in range(30):
+        assert prefetcher.get() == f"msg_{i}"
+    assert prefetcher.offsets["test"] == 29
+    assert prefetcher.get() == ""
+
+    Timer(_long_pause, write_client.put, args=("test", "msg_late")).start()
+    assert prefetcher.get(timeout=_very_long_pause) == "msg_late"
+    assert prefetcher.offsets["test"] == 30
+
+    # Once the connection closes cleanly, get() stops waiting.
+    prefetcher.connection.websocket.close()
+    start_time = time.time()
+    assert prefetcher.get(timeout=10 * _very_long_pause) == ""
+    assert time.time() - start_time < _very_long_pause
+    assert prefetcher.closed
+
+    prefetcher.close()
+    write_client.shutdown_server()
+    write_client.close()
+
+
+def test_connection_pool(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    pool = Pool(host, port, size=2)
+
+    def put_and_get(i_thread, results):
+        for i in range(10):
+            with pool.connection() as mq:
+                mq.put("test", f"msg_{i_thread}_{i}")
+        for i in range(10):
+            with pool.connection() as mq:
+                results.append(mq.get("test", timeout=_long_pause, group="readers"))
+
+    results = []
+    threads = [Thread(target=put_and_get, args=(i, results)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(results) - {""}) == len(results) - results.count("")
+    # Puts from different connections can still be on their way.
+    time.sleep(_long_pause)
+    with pool.connection() as mq:
+        results += mq.get_many("test", max_n=100, group="readers")
+    assert sorted(set(results) - {""}) == sorted(
+        f"msg_{i_thread}_{i}" for i_thread in range(8) for i in range(10)
+    )
+
+    # A connection that breaks is replaced.
+    with pool.connection() as mq:
+        mq.websocket.close()
+    with pool.connection(timeout=_very_long_pause) as mq_a:
+        with pool.connection(timeout=_very_long_pause) as mq_b:
+            mq_a.put("test", "msg_a")
+            assert mq_a.get_latest("test") == "msg_a"
+            mq_b.put("test", "msg_b")
+            assert mq_b.get_latest("test") == "msg_b"
+
+    # One that fails after the pool closes is closed, not left open.
+    with pytest.raises(RuntimeError):
+        with pool.connection() as mq:
+            pool.close()
+            raise RuntimeError
+    assert mq.websocket.protocol.state == State.CLOSED
+
+    write_client = connect(host, port)
+    write_client.shutdown_server()
+    write_client.close()
+
+
+def test_aio_put_acks(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+
+    async def run_clients():
+        write_client = await aio.connect(host, port, ack_window=4)
+        for i in range(20):
+            await write_client.put("test", f"msg_{i}")
+        assert await write_client.flush(timeout=_very_long_pause) == []
+        assert write_client.unacked == {}
+        assert len(await write_client.get_many("test")) == 20
+
+        await write_client.shutdown_server()
+        await write_client.close()
+
+    asyncio.run(run_clients())
+
+
+def test_client_history_cutoff(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
     p_server.start()
     write_client = connect(host, port)
     write_client.put("test", "test_msg")
@@ -158,8 +886,8 @@ def test_client_history_cutoff():
     read_client.close()
 
 
-def test_two_write_clients():
-    p_server = mp.Process(target=serve, args=(host, port))
+def test_two_write_clients(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
     p_server.start()
     write_client_A = connect(host, port)
     write_client_B = connect(host, port)
@@ -181,8 +909,8 @@ def test_two_write_clients():
     read_client.close()
 
 
-def test_two_read_clients():
-    p_server = mp.Process(target=serve, args=(host, port))
+def test_two_read_clients(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
     p_server.start()
     write_client = connect(host, port)
     read_client_A = connect(host, port)
@@ -201,6 +929,252 @@ def test_two_read_clients():
     read_client_B.close()
 
 
+def test_subscribe(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    write_client = connect(host, port)
+    read_client = connect(host, port)
+
+    received = []
+    read_client.subscribe("test")
+    read_client.subscribe("test_callback", callback=received.append)
+    time.sleep(_pause)
+
+    write_client.put("test", "test_msg_A")
+    write_client.put("test_callback", "test_msg_C")
+    write_client.put("test", "test_msg_B")
+
+    pushed = read_client.listen(timeout=_very_long_pause)
+    assert next(pushed) == ("test", "test_msg_A")
+    assert next(pushed) == ("test", "test_msg_B")
+    assert received == ["test_msg_C"]
+
+    # Pushed messages count as read
+    msg = read_client.get("test")
+    assert msg == ""
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+
+
+def test_pattern_subscribe(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+    write_client = connect(host, port)
+    read_client = connect(host, port)
+
+    with pytest.raises(ValueError):
+        read_client.subscribe("robot1/**/joint3")
+    with pytest.raises(ValueError):
+        read_client.subscribe("robot1/arm*")
+
+    received = []
+    read_client.subscribe("robot1/arm/*")
+    read_client.subscribe("robot2/**", callback=received.append)
+    time.sleep(_pause)
+
+    write_client.put("robot1/arm/joint3", "test_msg_A")
+    write_client.put("robot1/leg/joint3", "test_msg_B")
+    write_client.put("robot1/arm/joint3/torque", "test_msg_C")
+    write_client.put("robot2/leg/joint1", "test_msg_D")
+    write_client.put("robot1/arm/joint4", "test_msg_E")
+    write_client.put("robot2", "test_msg_F")
+
+    pushed = read_client.listen(timeout=_very_long_pause)
+    assert next(pushed) == ("robot1/arm/joint3", "test_msg_A")
+    assert next(pushed) == ("robot1/arm/joint4", "test_msg_E")
+    assert received == ["test_msg_D"]
+
+    read_client.unsubscribe("robot1/arm/*")
+    time.sleep(_pause)
+    write_client.put("robot1/arm/joint3", "test_msg_G")
+    time.sleep(_pause)
+    assert list(read_client.listen(timeout=_long_pause)) == []
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+
+
+def test_sharded_server(server_options):
+    p_server = mp.Process(
+        target=serve, args=(host, port), kwargs=server_options | {"workers": 3}
+    )
+    p_server.start()
+    write_client = connect(host, port)
+    read_client = connect(host, port)
+    assert len(read_client.shards) == 3
+
+    topics = [f"test_{i}" for i in range(10)]
+    read_client.subscribe("pattern/*")
+    time.sleep(_pause)
+    write_client.put_many_topics({topic: [f"msg_{topic}"] for topic in topics})
+    write_client.put_many("test_0", ["msg_A", "msg_B"])
+    write_client.put("pattern/A", "msg_pattern_A")
+    write_client.put("pattern/B", "msg_pattern_B")
+    time.sleep(_pause)
+
+    assert read_client.get_all(topics) == {topic: f"msg_{topic}" for topic in topics}
+    assert read_client.get_many("test_0") == ["msg_A", "msg_B"]
+    assert read_client.offsets["test_0"] == 2
+    assert sorted(read_client.listen(timeout=_long_pause)) == [
+        ("pattern/A", "msg_pattern_A"),
+        ("pattern/B", "msg_pattern_B"),
+    ]
+    assert set(read_client.get_memory_usage()["topics"]) == set(topics) | {
+        "pattern/A",
+        "pattern/B",
+    }
+
+    Timer(_long_pause, write_client.put, args=("test_5", "msg_late")).start()
+    assert read_client.get_any(["test_2", "test_5"], timeout=_very_long_pause) == (
+        "test_5",
+        "msg_late",
+    )
+
+    async def run_aio_client():
+        aio_client = await aio.connect(host, port)
+        await aio_client.put_many_topics({topic: ["msg_aio"] for topic in topics})
+        await asyncio.sleep(_pause)
+        messages = await aio_client.get_many_topics(topics)
+        await aio_client.close()
+        return messages
+
+    assert asyncio.run(run_aio_client()) == {topic: ["msg_aio"] for topic in topics}
+
+    # Shutting down the front shuts down every shard.
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+    p_server.join(_very_long_pause)
+    assert not p_server.is_alive()
+
+
+def test_bridges(server_options):
+    other_port = port + 10
+    uri = f"ws://{host}:{port}"
+    other_uri = f"ws://{host}:{other_port}"
+    # Each server bridges the same topics to the other.
+    p_server = mp.Process(
+        target=serve,
+        args=(host, port),
+        kwargs=server_options | {"bridges": {other_uri: ["shared/*"]}},
+    )
+    p_other_server = mp.Process(
+        target=serve,
+        args=(host, other_port),
+        kwargs=server_options | {"bridges": {uri: ["shared/*"]}},
+    )
+    p_server.start()
+    p_other_server.start()
+    client = connect(host, port)
+    other_client = connect(host, other_port)
+
+    client.put("shared/A", "msg_A")
+    client.put("local", "msg_local")
+    other_client.put_many("shared/B", ["msg_B1", "msg_B2"])
+
+    assert other_client.get("shared/A", timeout=_very_long_pause) == "msg_A"
+    assert client.get("shared/B", timeout=_very_long_pause) == "msg_B1"
+    assert client.get("shared/B", timeout=_very_long_pause) == "msg_B2"
+    assert other_client.get("local", timeout=_long_pause) == ""
+
+    # Nothing comes back around to where it started.
+    time.sleep(_long_pause)
+    assert client.get_many("shared/A", from_offset=0) == ["msg_A"]
+    assert other_client.get_many("shared/B", from_offset=0) == ["msg_B1", "msg_B2"]
+
+    client.shutdown_server()
+    other_client.shutdown_server()
+    client.close()
+    other_client.close()
+
+
+def test_bridge_to_sharded_server(server_options):
+    other_port = port + 10
+    other_uri = f"ws://{host}:{other_port}"
+    p_server = mp.Process(
+        target=serve,
+        args=(host, port),
+        kwargs=server_options | {"bridges": {other_uri: ["shared/*"]}},
+    )
+    p_other_server = mp.Process(
+        target=serve,
+        args=(host, other_port),
+        kwargs=server_options | {"workers": 3},
+    )
+    p_server.start()
+    p_other_server.start()
+    client = connect(host, port)
+    other_client = connect(host, other_port)
+
+    topics = [f"shared/{i}" for i in range(6)]
+    client.put_many_topics({topic: [f"msg_{topic}"] for topic in topics})
+    for topic in topics:
+        assert other_client.get(topic, timeout=_very_long_pause) == f"msg_{topic}"
+
+    client.shutdown_server()
+    other_client.shutdown_server()
+    client.close()
+    other_client.close()
+
+
+def test_bridge_rejections(server_options):
+    p_server = mp.Process(
+        target=serve,
+        args=(host, port),
+        kwargs=server_options | {"memory_budget": 100},
+    )
+    p_server.start()
+    client = connect(host, port)
+    client.set_retention("test", when_full="reject")
+    time.sleep(_pause)
+
+    bridge = Bridge(f"ws://{host}:{port}", ["test"], "test_server")
+    bridge.start()
+    for i in range(20):
+        bridge.forward("test", f"msg_{i:02}")
+    bridge.stop(timeout=_very_long_pause)
+    assert bridge.n_rejected > 0
+    assert bridge.n_dropped == 0
+    assert [topic for topic, _ in bridge.errors] == ["test"] * len(bridge.errors)
+    assert len(client.get_many("test", from_offset=0)) == 20 - bridge.n_rejected
+
+    client.shutdown_server()
+    client.close()
+
+
+def test_aio_pipelined_gets(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
+    p_server.start()
+
+    async def run_clients():
+        write_client = await aio.connect(host, port)
+        read_client = await aio.connect(host, port)
+
+        # Several gets in flight at once on the same connection
+        topics = [f"test_{i}" for i in range(5)]
+        gets = [
+            asyncio.create_task(read_client.get(topic, timeout=_very_long_pause))
+            for topic in topics
+        ]
+        await asyncio.sleep(_long_pause)
+
+        # Answer them in the opposite order they were asked
+        for topic in reversed(topics):
+            await write_client.put(topic, f"msg for {topic}")
+        msgs = await asyncio.gather(*gets)
+
+        assert msgs == [f"msg for {topic}" for topic in topics]
+
+        await write_client.shutdown_server()
+        await write_client.close()
+        await read_client.close()
+
+    asyncio.run(run_clients())
+
+
 def speed_write(stop_flag):
     fast_write_client = connect(host, port)
     while True:
@@ -210,8 +1184,8 @@ def speed_write(stop_flag):
     fast_write_client.close()
 
 
-def test_speed_writing():
-    p_server = mp.Process(target=serve, args=(host, port))
+def test_speed_writing(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
     p_server.start()
     write_client = connect(host, port)
     read_client = connect(host, port)
@@ -242,8 +1216,8 @@ def speed_read(stop_flag):
     fast_read_client.close()
 
 
-def test_speed_reading():
-    p_server = mp.Process(target=serve, args=(host, port))
+def test_speed_reading(server_options):
+    p_server = mp.Process(target=serve, args=(host, port), kwargs=server_options)
     p_server.start()
     write_client = connect(host, port)
     read_client = connect(host, port)
@@ -266,4 +1240,4 @@ def test_speed_reading():
 
 
 if __name__ == "__main__":
-    test_get_latest()
+    test_get_latest({})
@@ -7,16 +7,25 @@ try:
 except RuntimeError:
     pass
 
+import asyncio
+from functools import partial
+import json
+from threading import Thread
 import time
 
+from websockets.asyncio.client import connect as ws_connect_async
+
+from dsmq import aio
 from dsmq.server import serve
-from dsmq.client import connect
+from dsmq.client import BufferedProducer, Pool, Prefetcher, connect
+from dsmq.topics import TopicTrie
 
 host = "127.0.0.1"
 port = 30303
 verbose = False
 
 _pause = 0.01
+_long_pause = 0.1
 _very_long_pause = 1.0
 
 _n_iter = int(1e4)
@@ -27,6 +36,40 @@ _long_msg = str(["q"] * _n_long_char)
 
 _test_topic = "test"
 
+_batch_size = 100
+_n_latest_topics = 100
+
+_array_sizes = [2**10, 2**14, 2**17, 2**20, 10 * 2**20]  # bytes
+_n_array_iter = 100
+
+_transport_uris = {
+    "ws": f"ws://{host}:{port}",
+    "tcp": f"tcp://{host}:{port}",
+    "unix": "unix:///tmp/dsmq_performance_suite.sock",
+}
+
+_n_concurrent_clients = [10, 100, 1000]
+_n_concurrent_iter = 100
+
+_n_ingest_clients = [1, 10, 100]
+_n_ingest_iter = 1000
+
+_n_pattern_subscriptions = [10, 1000, 100000]
+
+_group_sizes = [1, 2, 4, 8, 16]
+_n_jobs = 1000
+_job_duration = 0.001  # seconds
+
+_shard_counts = [1, 2, 4]
+_n_sharded_clients = 4
+_n_sharded_iter = 1000
+
+_other_port = port + 10
+
+_n_threads = 16
+_pool_sizes = [1, 4, 16]
+_n_thread_iter = 200
+
 
 def main():
     print()
@@ -37,6 +80,21 @@ def main():
     time_empty_reads()
     time_short_reads()
     time_long_reads()
+    time_codecs()
+    time_batched_reads()
+    time_latest_reads()
+    time_arrays()
+    time_transports()
+    time_shared_topics()
+    time_concurrent_clients()
+    time_ingest()
+    time_pattern_matches()
+    time_consumer_groups()
+    time_sharded_servers()
+    time_bridges()
+    time_buffered_puts()
+    time_prefetched_reads()
+    time_pools()
 
 
 def time_short_writes():
@@ -76,11 +134,11 @@ def time_long_writes():
     )
 
 
-def time_writes(msg="message", n_iter=1):
+def time_writes(msg="message", n_iter=1, codec="binary"):
     p_server = mp.Process(target=serve, args=(host, port, verbose))
     p_server.start()
     time.sleep(_pause)
-    write_client = connect(host, port)
+    write_client = connect(host, port, codec=codec)
 
     start_time = time.time()
     for _ in range(n_iter):
@@ -151,12 +209,12 @@ def time_long_reads():
     )
 
 
-def time_reads(msg=None, n_iter=1):
+def time_reads(msg=None, n_iter=1, codec="binary"):
     p_server = mp.Process(target=serve, args=(host, port, verbose))
     p_server.start()
     time.sleep(_pause)
     # write_client = connect(host, port)
-    read_client = connect(host, port)
+    read_client = connect(host, port, codec=codec)
 
     if msg is not None:
         for _ in range(n_iter):
@@ -183,5 +241,688 @@ def time_reads(msg=None, n_iter=1):
     return avg_duration, avg_duration_close
 
 
+def time_codecs():
+    for codec in ["json", "binary"]:
+        avg_write, _ = time_writes(msg=_long_msg, n_iter=_n_iter, codec=codec)
+        avg_read, _ = time_reads(msg=_long_msg, n_iter=_n_iter, codec=codec)
+
+        print()
+        print(f"Average time per 1000 characters with the {codec} codec")
+        print(f"        write: {1000 * avg_write / _n_long_char:.2f} μs")
+        print(f"        read:  {1000 * avg_read / _n_long_char:.2f} μs")
+
+
+def time_batched_reads():
+    p_server = mp.Process(target=serve, args=(host, port, verbose))
+    p_server.start()
+    time.sleep(_pause)
+    read_client = connect(host, port)
+
+    for _ in range(_n_iter // _batch_size):
+        read_client.put_many(_test_topic, [_short_msg] * _batch_size)
+
+    start_time = time.time()
+    for _ in range(_n_iter // _batch_size):
+        read_client.get_many(_test_topic, max_n=_batch_size)
+    avg_duration = 1e6 * (time.time() - start_time) / _n_iter  # microseconds
+
+    read_client.shutdown_server()
+    read_client.close()
+
+    p_server.join(_very_long_pause)
+    if p_server.is_alive():
+        print("    Doing a hard shutdown on mq server")
+        p_server.kill()
+
+    print()
+    print(f"Average time per message for a short read in batches of {_batch_size}")
+    print(f"        {avg_duration:.1f} μs")
+
+
+def time_latest_reads():
+    p_server = mp.Process(target=serve, args=(host, port, verbose))
+    p_server.start()
+    time.sleep(_pause)
+    read_client = connect(host, port)
+
+    topics = [f"{_test_topic}_{i}" for i in range(_n_latest_topics)]
+    n_rounds = _n_iter // _n_latest_topics
+    read_client.put_many_topics({topic: [_short_msg] for topic in topics})
+    start_time = time.time()
+    for _ in range(n_rounds):
+        for topic in topics:
+            read_client.get_latest(topic)
+    avg_duration = 1e6 * (time.time() - start_time) / _n_iter  # microseconds
+
+    start_time = time.time()
+    for _ in range(n_rounds):
+        read_client.get_latest_many(topics)
+    avg_many_duration = 1e6 * (time.time() - start_time) / _n_iter  # microseconds
+
+    read_client.shutdown_server()
+    read_client.close()
+
+    p_server.join(_very_long_pause)
+    if p_server.is_alive():
+        print("    Doing a hard shutdown on mq server")
+        p_server.kill()
+
+    print()
+    print(f"Average time per topic for the latest value of {_n_latest_topics} topics")
+    print(f"    one at a time:   {avg_duration:.1f} μs")
+    print(f"    all at once:     {avg_many_duration:.1f} μs")
+
+
+def time_arrays():
+    try:
+        import numpy as np
+    except ImportError:
+        print()
+        print("NumPy isn't installed. Skipping array timing.")
+        return
+
+    print()
+    print("Average time for an array write and read, float64")
+    for n_bytes in _array_sizes:
+        array = np.random.default_rng().random(n_bytes // 8)
+        avg_write, avg_read = time_array_round_trips(array)
+        print(
+            f"    {n_bytes // 1024} KB: write {avg_write:.1f} μs, "
+            + f"read {avg_read:.1f} μs, "
+            + f"{2 * n_bytes / (avg_write + avg_read):.0f} MB/s"
+        )
+
+
+def time_array_round_trips(array, n_iter=_n_array_iter):
+    p_server = mp.Process(
+        target=serve, args=(host, port), kwargs={"backend": "ring", "engine": "async"}
+    )
+    p_server.start()
+    time.sleep(_pause)
+    client = connect(host, port)
+
+    # Read each array right after writing it, so that the server
+    # only ever holds one of them.
+    write_duration = 0.0
+    read_duration = 0.0
+    for _ in range(n_iter):
+        start_time = time.time()
+        client.put_array(_test_topic, array)
+        write_duration += time.time() - start_time
+
+        start_time = time.time()
+        client.get_array(_test_topic, timeout=_very_long_pause)
+        read_duration += time.time() - start_time
+    avg_write = 1e6 * write_duration / n_iter  # microseconds
+    avg_read = 1e6 * read_duration / n_iter  # microseconds
+
+    client.shutdown_server()
+    client.close()
+
+    p_server.join(_very_long_pause)
+    if p_server.is_alive():
+        print("    Doing a hard shutdown on mq server")
+        p_server.kill()
+
+    return avg_write, avg_read
+
+
+def time_transports():
+    print()
+    print("Average time for a short read, by transport")
+    for transport, uri in _transport_uris.items():
+        for engine in ["sync", "async"]:
+            avg_duration = time_transport_reads(uri, engine)
+            print(f"    {transport}, {engine} server engine: {avg_duration:.1f} μs")
+
+
+def time_transport_reads(uri, engine, n_iter=_n_iter):
+    p_server = mp.Process(
+        target=serve, args=(uri,), kwargs={"backend": "ring", "engine": engine}
+    )
+    p_server.start()
+    time.sleep(_pause)
+    client = connect(uri)
+
+    for _ in range(n_iter):
+        client.put(_test_topic, _short_msg)
+
+    start_time = time.time()
+    for _ in range(n_iter):
+        client.get(_test_topic)
+    avg_duration = 1e6 * (time.time() - start_time) / n_iter  # microseconds
+
+    client.shutdown_server()
+    client.close()
+
+    p_server.join(_very_long_pause)
+    if p_server.is_alive():
+        print("    Doing a hard shutdown on mq server")
+        p_server.kill()
+
+    return avg_duration
+
+
+def time_shared_topics():
+    p_server = mp.Process(target=serve, args=(host, port, verbose))
+    p_server.start()
+    time.sleep(_pause)
+    write_client = connect(host, port)
+    read_client = connect(host, port)
+    write_client.share(_test_topic)
+    read_client.share(_test_topic)
+
+    # Read each message right after writing it. The ring only holds
+    # the most recent ones.
+    write_duration = 0.0
+    read_duration = 0.0
+    for _ in range(_n_iter):
+        start_time = time.time()
+        write_client.put(_test_topic, _short_msg)
+        write_duration += time.time() - start_time
+
+        start_time = time.time()
+        read_client.get(_test_topic)
+        read_duration += time.time() - start_time
+    avg_write = 1e6 * write_duration / _n_iter  # microseconds
+    avg_read = 1e6 * read_duration / _n_iter  # microseconds
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+
+    p_server.join(_very_long_pause)
+    if p_server.is_alive():
+        print("    Doing a hard shutdown on mq server")
+        p_server.kill()
+
+    print()
+    print("Average time for a short message in a shared memory topic")
+    print(f"        write: {avg_write:.2f} μs")
+    print(f"        read:  {avg_read:.2f} μs")
+
+
+def time_concurrent_clients():
+    for engine in ["sync", "async"]:
+        print()
+        print(f"Concurrent clients, {engine} server engine")
+        for n_clients in _n_concurrent_clients:
+            avg_duration, throughput = time_concurrent_requests(engine, n_clients)
+            print(
+                f"    {n_clients} clients: {int(avg_duration)} μs per request, "
+                + f"{int(throughput)} requests per second overall"
+            )
+
+
+def time_concurrent_requests(engine, n_clients, n_iter=_n_concurrent_iter):
+    """
+    Each client does `n_iter` put/get pairs on its own topic.
+    Returns the average time a client waits for each request, and the
+    combined number of requests per second handled by the server.
+    """
+    p_server = mp.Process(
+        target=serve, args=(host, port), kwargs={"backend": "ring", "engine": engine}
+    )
+    p_server.start()
+    time.sleep(_very_long_pause)
+
+    async def run_client(i_client, websocket):
+        topic = f"{_test_topic}_{i_client}"
+        start_time = time.time()
+        for _ in range(n_iter):
+            await websocket.send(
+                json.dumps({"action": "put", "topic": topic, "message": _short_msg})
+            )
+            await websocket.send(json.dumps({"action": "get", "topic": topic}))
+            await websocket.recv()
+        return time.time() - start_time
+
+    async def run_all_clients():
+        websockets = [
+            await ws_connect_async(f"ws://{host}:{port}") for _ in range(n_clients)
+        ]
+        start_time = time.time()
+        durations = await asyncio.gather(
+            *[run_client(i, ws) for i, ws in enumerate(websockets)]
+        )
+        total_duration = time.time() - start_time
+
+        await websockets[0].send(json.dumps({"action": "shutdown", "topic": ""}))
+        for websocket in websockets:
+            await websocket.close()
+        return durations, total_duration
+
+    durations, total_duration = asyncio.run(run_all_clients())
+
+    p_server.join(_very_long_pause)
+    if p_server.is_alive():
+        print("    Doing a hard shutdown on mq server")
+        p_server.kill()
+
+    n_requests = 2 * n_iter
+    avg_duration = 1e6 * sum(durations) / (n_clients * n_requests)  # microseconds
+    throughput = n_clients * n_requests / total_duration
+    return avg_duration, throughput
+
+
+def time_ingest():
+    for backend in ["sqlite", "sqlite_ingest"]:
+        print()
+        print(f"Concurrent writers, {backend} backend")
+        for n_clients in _n_ingest_clients:
+            throughput, n_failed = time_concurrent_writes(backend, n_clients)
+            print(
+                f"    {n_clients} clients: {int(throughput)} puts per second "
+                + f"overall, {n_failed} failed"
+            )
+
+
+def time_concurrent_writes(backend, n_clients, n_iter=_n_ingest_iter):
+    """
+    Each client puts `n_iter` messages into its own topic as fast as it can,
+    then reads them all back to be sure they've landed.
+    Returns the combined number of puts per second stored by the server,
+    and the number of puts that failed.
+    """
+    p_server = mp.Process(
+        target=serve,
+        args=(host, port),
+        kwargs={
+            "backend": backend,
+            "retention": {"*": {"max_length": None, "max_age": None}},
+        },
+    )
+    p_server.start()
+    time.sleep(_very_long_pause)
+
+    async def run_client(i_client, websocket):
+        topic = f"{_test_topic}_{i_client}"
+        for _ in range(n_iter):
+            await websocket.send(
+                json.dumps({"action": "put", "topic": topic, "message": _short_msg})
+            )
+        await websocket.send(
+            json.dumps({"action": "get_many", "topic": topic, "max_n": n_iter})
+        )
+        n_failed = 0
+        while True:
+            reply = json.loads(await websocket.recv())
+            if reply.get("action") == "error":
+                n_failed += 1
+            else:
+                return len(reply["messages"]), n_failed
+
+    async def run_all_clients():
+        websockets = [
+            await ws_connect_async(f"ws://{host}:{port}") for _ in range(n_clients)
+        ]
+        start_time = time.time()
+        results = await asyncio.gather(
+            *[run_client(i, ws) for i, ws in enumerate(websockets)]
+        )
+        total_duration = time.time() - start_time
+
+        await websockets[0].send(json.dumps({"action": "shutdown", "topic": ""}))
+        for websocket in websockets:
+            await websocket.close()
+        n_stored = sum(n_client_stored for n_client_stored, _ in results)
+        n_failed = sum(n_client_failed for _, n_client_failed in results)
+        return n_stored, n_failed, total_duration
+
+    n_stored, n_failed, total_duration = asyncio.run(run_all_clients())
+
+    p_server.join(_very_long_pause)
+    if p_server.is_alive():
+        print("    Doing a hard shutdown on mq server")
+        p_server.kill()
+
+    return n_stored / total_duration, n_failed
+
+
+def time_pattern_matches():
+    """
+    Finding the subscribers for a new message shouldn't get slower
+    as the number of pattern subscriptions grows.
+    """
+    print()
+    print("Average time to find the pattern subscriptions matching a topic")
+    for n_subscriptions in _n_pattern_subscriptions:
+        subscriptions = TopicTrie()
+        for i in range(n_subscriptions):
+            subscriptions.add(f"robot{i}/arm/*", i)
+            subscriptions.add(f"robot{i}/**", i)
+        start_time = time.time()
+        for _ in range(_n_iter):
+            subscriptions.match("robot0/arm/joint3")
+        avg_duration = 1e6 * (time.time() - start_time) / _n_iter  # microseconds
+        print(f"    {2 * n_subscriptions:>7} subscriptions: {avg_duration:.2f} μs")
+
+
+def time_consumer_groups():
+    print()
+    print(
+        f"Jobs per second for a consumer group working through {_n_jobs} jobs, "
+        + f"{int(_job_duration * 1e3)} ms each"
+    )
+    for group_size in _group_sizes:
+        throughput = time_group_jobs(group_size)
+        print(f"    {group_size:>2} workers: {int(throughput)} jobs per second")
+
+
+def time_group_jobs(group_size):
+    """
+    `group_size` workers split `_n_jobs` jobs between them, each job
+    taking `_job_duration` to do. Returns the number of jobs finished
+    per second.
+    """
+    p_server = mp.Process(
+        target=serve,
+        args=(host, port),
+        kwargs={"retention": {"*": {"max_length": None, "max_age": None}}},
+    )
+    p_server.start()
+    time.sleep(_pause)
+
+    async def run_worker(worker):
+        n_done = 0
+        while True:
+            job = await worker.get(_test_topic, timeout=_long_pause, group="workers")
+            if job == "":
+                return n_done, time.time()
+            await asyncio.sleep(_job_duration)
+            n_done += 1
+
+    async def run_group():
+        write_client = await aio.connect(host, port)
+        workers = [await aio.connect(host, port) for _ in range(group_size)]
+        start_time = time.time()
+        await write_client.put_many(_test_topic, [_short_msg] * _n_jobs)
+        results = await asyncio.gather(*[run_worker(worker) for worker in workers])
+        # Don't count the time it takes the last worker to find nothing left.
+        total_duration = max(end_time for _, end_time in results) - start_time
+        total_duration -= _long_pause
+        n_done = sum(n_worker_done for n_worker_done, _ in results)
+        if n_done != _n_jobs:
+            print(f"    Expected {_n_jobs} jobs done, got {n_done}")
+
+        await write_client.shutdown_server()
+        await write_client.close()
+        for worker in workers:
+            await worker.close()
+        return n_done / total_duration
+
+    throughput = asyncio.run(run_group())
+
+    p_server.join(_very_long_pause)
+    if p_server.is_alive():
+        print("    Doing a hard shutdown on mq server")
+        p_server.kill()
+
+    return throughput
+
+
+def time_sharded_servers():
+    print()
+    print(
+        f"Requests per second from {_n_sharded_clients} client processes, "
+        + "each putting and getting on its own topic"
+    )
+    for n_shards in _shard_counts:
+        throughput = time_sharded_requests(n_shards)
+        print(f"    {n_shards} shards: {int(throughput)} requests per second")
+
+
+def time_sharded_requests(n_shards):
+    """
+    Returns the combined number of requests per second handled by
+    a server split into `n_shards` shards.
+    """
+    p_server = mp.Process(
+        target=serve,
+        args=(host, port),
+        kwargs={"backend": "ring", "workers": n_shards},
+    )
+    p_server.start()
+    time.sleep(_very_long_pause)
+
+    ready = mp.Queue()
+    start = mp.Event()
+    results = mp.Queue()
+    p_clients = [
+        mp.Process(target=run_sharded_client, args=(i_client, ready, start, results))
+        for i_client in range(_n_sharded_clients)
+    ]
+    for p_client in p_clients:
+        p_client.start()
+    # Only start the clock once every client has connected.
+    for _ in p_clients:
+        ready.get()
+    start.set()
+    times = [results.get() for _ in p_clients]
+    for p_client in p_clients:
+        p_client.join()
+    total_duration = max(end for _, end in times) - min(begin for begin, _ in times)
+
+    client = connect(host, port)
+    client.shutdown_server()
+    client.close()
+    p_server.join(_very_long_pause)
+    if p_server.is_alive():
+        print("    Doing a hard shutdown on mq server")
+        p_server.kill()
+
+    return 2 * _n_sharded_iter * _n_sharded_clients / total_duration
+
+
+def run_sharded_client(i_client, ready, start, results):
+    client = connect(host, port)
+    topic = f"{_test_topic}_{i_client}"
+    ready.put(i_client)
+    start.wait()
+    start_time = time.time()
+    for _ in range(_n_sharded_iter):
+        client.put(topic, _short_msg)
+        client.get(topic)
+    results.put((start_time, time.time()))
+    client.close()
+
+
+def time_bridges():
+    print()
+    print(f"Messages per second carried from one server to another, {_n_iter} total")
+    print(f"    bridged:                    {int(time_carrying(bridged=True))}")
+    print(f"    relayed with get() and put(): {int(time_carrying(bridged=False))}")
+
+
+def time_carrying(bridged):
+    """
+    Put `_n_iter` messages into one server and time how long it takes
+    for them all to arrive at another, either over a bridge, or with
+    a client that gets each from one and puts it into the other.
+    Returns messages per second.
+    """
+    retention = {"*": {"max_length": None, "max_age": None}}
+    bridges = {f"ws://{host}:{_other_port}": [_test_topic]} if bridged else None
+    p_server = mp.Process(
+        target=serve,
+        args=(host, port),
+        kwargs={"retention": retention, "bridges": bridges},
+    )
+    p_other_server = mp.Process(
+        target=serve, args=(host, _other_port), kwargs={"retention": retention}
+    )
+    p_server.start()
+    p_other_server.start()
+    time.sleep(_very_long_pause)
+    write_client = connect(host, port)
+    read_client = connect(host, _other_port)
+    relay_client = connect(host, port)
+    relay_put_client = connect(host, _other_port)
+
+    start_time = time.time()
+    write_client.put_many(_test_topic, [_short_msg] * _n_iter)
+    n_received = 0
+    while n_received < _n_iter:
+        if not bridged:
+            for msg in relay_client.get_many(_test_topic):
+                relay_put_client.put(_test_topic, msg)
+        n_received += len(read_client.get_many(_test_topic))
+    throughput = _n_iter / (time.time() - start_time)
+
+    write_client.shutdown_server()
+    read_client.shutdown_server()
+    for client in [write_client, read_client, relay_client, relay_put_client]:
+        client.close()
+    for p in [p_server, p_other_server]:
+        p.join(_very_long_pause)
+        if p.is_alive():
+            print("    Doing a hard shutdown on mq server")
+            p.kill()
+
+    return throughput
+
+
+def time_buffered_puts():
+    print()
+    print(f"Short messages per second put and handled, {_n_iter} total")
+    print(f"    one frame per put:   {int(time_producing(buffered=False))}")
+    print(f"    buffered producer:   {int(time_producing(buffered=True))}")
+
+
+def time_producing(buffered):
+    """
+    Time how long it takes to put `_n_iter` short messages, one at a time,
+    until the server has handled them all. Returns messages per second.
+    """
+    p_server = mp.Process(target=serve, args=(host, port))
+    p_server.start()
+    time.sleep(_pause)
+    connection = connect(host, port)
+    write_client = BufferedProducer(connection) if buffered else connection
+
+    start_time = time.time()
+    for _ in range(_n_iter):
+        write_client.put(_test_topic, _short_msg)
+    write_client.flush()
+    # The server handles requests from a connection in order,
+    # so this reply comes back after the last put is done.
+    connection.get_memory_usage()
+    throughput = _n_iter / (time.time() - start_time)
+
+    connection.shutdown_server()
+    write_client.close()
+    p_server.join(_very_long_pause)
+    if p_server.is_alive():
+        print("    Doing a hard shutdown on mq server")
+        p_server.kill()
+
+    return throughput
+
+
+def time_prefetched_reads():
+    print()
+    print(f"Average time to get() each of {_n_iter} short messages")
+    print(f"    one round trip per get():  {int(time_draining(prefetch=False))} μs")
+    print(f"    prefetched:                {int(time_draining(prefetch=True))} μs")
+
+
+def time_draining(prefetch):
+    """
+    Time reading `_n_iter` short messages from a topic, one get() at a time.
+    Returns microseconds per message.
+    """
+    retention = {"*": {"max_length": None, "max_age": None}}
+    p_server = mp.Process(
+        target=serve, args=(host, port), kwargs={"retention": retention}
+    )
+    p_server.start()
+    time.sleep(_pause)
+    read_client = connect(host, port)
+    if prefetch:
+        read_client = Prefetcher(read_client, _test_topic)
+        get = read_client.get
+    else:
+        get = partial(read_client.get, _test_topic)
+    write_client = connect(host, port, ack_window=100)
+    for _ in range(_n_iter // _batch_size):
+        write_client.put_many(_test_topic, [_short_msg] * _batch_size)
+    write_client.flush()
+
+    start_time = time.time()
+    n_read = 0
+    while n_read < _n_iter:
+        if get() != "":
+            n_read += 1
+    avg_duration = 1e6 * (time.time() - start_time) / _n_iter  # microseconds
+
+    write_client.shutdown_server()
+    write_client.close()
+    read_client.close()
+    p_server.join(_very_long_pause)
+    if p_server.is_alive():
+        print("    Doing a hard shutdown on mq server")
+        p_server.kill()
+
+    return avg_duration
+
+
+def time_pools():
+    print()
+    print(f"Requests per second from {_n_threads} threads")
+    print(f"    a connection per thread:   {int(time_threaded_requests(None))}")
+    for pool_size in _pool_sizes:
+        throughput = int(time_threaded_requests(pool_size))
+        print(f"    a pool of {pool_size:2} connections:  {throughput}")
+
+
+def time_threaded_requests(pool_size):
+    """
+    Have `_n_threads` threads each make `_n_thread_iter` put-and-get requests,
+    through a Pool of `pool_size` connections, or if None, each through
+    a connection of its own. Returns requests per second.
+    """
+    p_server = mp.Process(target=serve, args=(host, port))
+    p_server.start()
+    time.sleep(_pause)
+    if pool_size is None:
+        connections = [connect(host, port) for _ in range(_n_threads)]
+    else:
+        pool = Pool(host, port, size=pool_size)
+
+    def make_requests(i_thread):
+        for _ in range(_n_thread_iter):
+            if pool_size is None:
+                mq = connections[i_thread]
+                mq.put(_test_topic, _short_msg)
+                mq.get_latest(_test_topic)
+            else:
+                with pool.connection() as mq:
+                    mq.put(_test_topic, _short_msg)
+                    mq.get_latest(_test_topic)
+
+    threads = [Thread(target=make_requests, args=(i,)) for i in range(_n_threads)]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    throughput = 2 * _n_threads * _n_thread_iter / (time.time() - start_time)
+
+    shutdown_client = connect(host, port)
+    shutdown_client.shutdown_server()
+    shutdown_client.close()
+    if pool_size is None:
+        for mq in connections:
+            mq.close()
+    else:
+        pool.close()
+    p_server.join(_very_long_pause)
+    if p_server.is_alive():
+        print("    Doing a hard shutdown on mq server")
+        p_server.kill()
+
+    return throughput
+
+
 if __name__ == "__main__":
     main()
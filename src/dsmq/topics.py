@@ -0,0 +1,107 @@
+"""
+Topic patterns, for subscribing to a whole family of topics at once.
+
+Topics are read as levels separated by "/", like "robot1/arm/joint3".
+A pattern is a topic in which some levels are wildcards.
+- "*" matches exactly one level. "robot1/*/joint3" matches
+  "robot1/arm/joint3" and "robot1/leg/joint3".
+- "**" matches one or more levels, and can only be the last level.
+  "robot1/**" matches "robot1/arm" and "robot1/arm/joint3", but not "robot1".
+A pattern without wildcards matches only the topic it names.
+
+TopicTrie keeps patterns in a tree with one level per node, so finding
+every pattern that matches a topic means walking down the tree once,
+one level at a time. It takes time proportional to the topic's depth,
+however many patterns there are.
+"""
+
+_separator = "/"
+_one_level = "*"
+_any_levels = "**"
+
+
+def is_pattern(topic):
+    return any(level in (_one_level, _any_levels) for level in topic.split(_separator))
+
+
+def check_pattern(pattern):
+    levels = pattern.split(_separator)
+    for i_level, level in enumerate(levels):
+        if level == _any_levels and i_level < len(levels) - 1:
+            raise ValueError(
+                f"'**' can only be the last level of a pattern, not '{pattern}'. "
+                + "Try 'robot1/**'."
+            )
+        if _one_level in level and level not in (_one_level, _any_levels):
+            raise ValueError(
+                f"A wildcard has to be a whole level, not '{level}'. "
+                + "Try 'robot1/*/joint3' or 'robot1/**'."
+            )
+
+
+class TopicTrie:
+    """
+    Values, like subscribed sessions, filed under the patterns they're
+    interested in, for looking up everything interested in a topic.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+
+    def add(self, pattern, value):
+        check_pattern(pattern)
+        node = self.root
+        for level in pattern.split(_separator):
+            node = node.children.setdefault(level, _Node())
+        node.values.add(value)
+
+    def discard(self, pattern, value):
+        path = [self.root]
+        for level in pattern.split(_separator):
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].values.discard(value)
+
+        # Prune the branch back to the last node that's still in use.
+        levels = pattern.split(_separator)
+        for i_level in range(len(levels) - 1, -1, -1):
+            node = path[i_level + 1]
+            if node.values or node.children:
+                break
+            del path[i_level].children[levels[i_level]]
+
+    def match(self, topic):
+        """
+        Returns the set of values filed under every pattern matching `topic`.
+        """
+        matched = set()
+        nodes = [self.root]
+        for level in topic.split(_separator):
+            next_nodes = []
+            for node in nodes:
+                rest = node.children.get(_any_levels)
+                if rest is not None:
+                    matched |= rest.values
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+                child = node.children.get(_one_level)
+                if child is not None and level != _one_level:
+                    next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                return matched
+        for node in nodes:
+            matched |= node.values
+        return matched
+
+
+class _Node:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        # {level: _Node}
+        self.children = {}
+        self.values = set()
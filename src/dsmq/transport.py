@@ -0,0 +1,422 @@
+"""
+The ways a dsmq client and server can reach each other, picked by URI.
+
+- "ws://host:port", websockets, the original transport. It works across
+  the network and through anything that speaks HTTP.
+- "tcp://host:port", plain TCP sockets.
+- "unix:///path/to/dsmq.sock", a Unix domain socket, for clients on the
+  same machine as the server.
+
+Websocket compression is turned off. dsmq messages rarely travel far
+enough for it to pay for itself, and compressing a large binary message
+costs far more than sending it.
+
+The tcp and unix transports skip the HTTP upgrade and websocket masking
+and framing. Each frame goes out as
+- a 4-byte, big-endian length of the payload,
+- a 1-byte kind, text or binary, and
+- the payload.
+Text frames come back out as str and binary frames as bytes-like,
+just as they would from a websocket, so the codecs and the request
+handling don't need to know which transport carried them.
+For the same reason, a closed connection raises the same exceptions
+that websockets does.
+"""
+
+import asyncio
+import os
+import select
+import socket
+import socketserver
+from threading import Lock
+from urllib.parse import urlsplit
+from websockets.asyncio.client import connect as ws_connect_async
+from websockets.asyncio.server import serve as ws_serve_async
+from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
+from websockets.sync.client import connect as ws_connect
+from websockets.sync.server import serve as ws_serve
+
+schemes = ["ws", "tcp", "unix"]
+
+_length_size_bytes = 4
+_byteorder = "big"
+_frame_header_size = _length_size_bytes + 1
+_text = 0
+_binary = 1
+_recv_size = 2**16  # bytes
+# Payloads smaller than this get joined to their header and sent
+# in a single call. Larger ones are sent separately to avoid copying them.
+_max_joined_size = 2**16  # bytes
+
+
+def to_uri(host, port):
+    """
+    `host` can be a full URI, in which case `port` is ignored.
+    Otherwise it's a host name for the websocket transport.
+    """
+    if "://" in host:
+        return host
+    return f"ws://{host}:{port}"
+
+
+def parse_uri(uri):
+    """
+    Returns the scheme and the address, which is a (host, port) pair
+    for "ws" and "tcp", and a file path for "unix".
+    """
+    parts = urlsplit(uri)
+    if parts.scheme not in schemes:
+        raise ValueError(
+            f"Unknown dsmq transport '{parts.scheme}'. Try one of {schemes}."
+        )
+    if parts.scheme == "unix":
+        # unix:///run/dsmq.sock is absolute and unix://dsmq.sock is relative
+        return parts.scheme, parts.netloc + parts.path
+    return parts.scheme, (parts.hostname, parts.port)
+
+
+def connect(uri, max_size):
+    scheme, address = parse_uri(uri)
+    if scheme == "ws":
+        return ws_connect(uri, max_size=max_size, compression=None)
+    return SocketConnection(_open_socket(scheme, address), max_size)
+
+
+async def connect_async(uri, max_size):
+    scheme, address = parse_uri(uri)
+    if scheme == "ws":
+        return await ws_connect_async(uri, max_size=max_size)
+    try:
+        if scheme == "tcp":
+            reader, writer = await asyncio.open_connection(*address, limit=_recv_size)
+            _set_nodelay(writer.get_extra_info("socket"))
+        else:
+            reader, writer = await asyncio.open_unix_connection(
+                address, limit=_recv_size
+            )
+    except FileNotFoundError:
+        # No server has created the socket file yet.
+        raise ConnectionRefusedError(f"Nothing listening at {uri}")
+    return AsyncSocketConnection(reader, writer, max_size)
+
+
+def serve(handler, uri, max_size):
+    """
+    Returns a server that calls `handler` with each new connection,
+    each in its own thread. Use it as a context manager, and call
+    serve_forever() to run it and shutdown() to stop it.
+    """
+    scheme, address = parse_uri(uri)
+    if scheme == "ws":
+        return ws_serve(handler, *address, max_size=max_size, compression=None)
+
+    class RequestHandler(socketserver.BaseRequestHandler):
+        def handle(self):
+            if scheme == "tcp":
+                _set_nodelay(self.request)
+            handler(SocketConnection(self.request, max_size))
+
+    if scheme == "tcp":
+        return _ThreadingTCPServer(address, RequestHandler)
+    _remove_stale_socket_file(address)
+    return _ThreadingUnixStreamServer(address, RequestHandler)
+
+
+def serve_async(handler, uri, max_size):
+    """
+    Returns a server that runs `handler(connection)` as a coroutine
+    for each new connection. Use it as an async context manager,
+    and await wait_closed() to run it until close() is called.
+    """
+    scheme, address = parse_uri(uri)
+    if scheme == "ws":
+        return ws_serve_async(handler, *address, max_size=max_size, compression=None)
+    return AsyncSocketServer(handler, scheme, address, max_size)
+
+
+class SocketConnection:
+    """
+    A blocking, length-prefixed frame connection over a TCP or Unix socket,
+    with the parts of the websockets sync connection interface
+    that dsmq uses.
+    """
+
+    def __init__(self, sock, max_size):
+        self.sock = sock
+        self.max_size = max_size
+        self.buffer = bytearray()
+        # The server pushes messages to a subscriber from other clients'
+        # threads, so sends from different threads mustn't interleave.
+        self.send_lock = Lock()
+
+    def __iter__(self):
+        try:
+            while True:
+                yield self.recv()
+        except ConnectionClosedOK:
+            return
+
+    def send(self, frame):
+        header, payload = _frame_parts(frame)
+        with self.send_lock:
+            try:
+                if len(payload) < _max_joined_size:
+                    self.sock.sendall(header + payload)
+                else:
+                    self.sock.sendall(header)
+                    self.sock.sendall(payload)
+            except OSError:
+                raise ConnectionClosedError(None, None)
+
+    def recv(self, timeout=None):
+        """
+        Raises TimeoutError if no frame starts to arrive
+        within `timeout` seconds.
+        """
+        if timeout is not None and not self.buffer:
+            readable, _, _ = select.select([self.sock], [], [], timeout)
+            if not readable:
+                raise TimeoutError()
+
+        header = self._recv_exactly(_frame_header_size)
+        size = int.from_bytes(header[:_length_size_bytes], _byteorder)
+        if size > self.max_size:
+            self.close()
+            raise ConnectionClosedError(None, None)
+        payload = self._recv_exactly(size)
+        if header[-1] == _text:
+            return payload.decode("utf-8")
+        # Read-only, to match the bytes that websockets hands back
+        return memoryview(payload).toreadonly()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _recv_exactly(self, n):
+        if n - len(self.buffer) > _recv_size:
+            return self._recv_large(n)
+        while len(self.buffer) < n:
+            # This returns as soon as anything arrives, so asking for more
+            # than is needed costs nothing, and saves a system call
+            # when several small frames arrive together.
+            self.buffer += self._recv(_recv_size)
+        data = self.buffer[:n]
+        del self.buffer[:n]
+        return data
+
+    def _recv_large(self, n):
+        """
+        Receive straight into place, rather than through the buffer,
+        so that large frames are only copied once.
+        """
+        data = bytearray(n)
+        view = memoryview(data)
+        i_start = len(self.buffer)
+        view[:i_start] = self.buffer
+        self.buffer.clear()
+        while i_start < n:
+            try:
+                n_received = self.sock.recv_into(view[i_start:])
+            except OSError:
+                raise ConnectionClosedError(None, None)
+            if n_received == 0:
+                raise ConnectionClosedOK(None, None)
+            i_start += n_received
+        return data
+
+    def _recv(self, max_n_bytes):
+        try:
+            chunk = self.sock.recv(max_n_bytes)
+        except OSError:
+            raise ConnectionClosedError(None, None)
+        if not chunk:
+            raise ConnectionClosedOK(None, None)
+        return chunk
+
+
+class AsyncSocketConnection:
+    """
+    The asyncio counterpart to SocketConnection, with the parts of the
+    websockets asyncio connection interface that dsmq uses.
+    """
+
+    def __init__(self, reader, writer, max_size):
+        self.reader = reader
+        self.writer = writer
+        self.max_size = max_size
+
+    async def __aiter__(self):
+        try:
+            while True:
+                yield await self.recv()
+        except ConnectionClosedOK:
+            return
+
+    async def send(self, frame):
+        header, payload = _frame_parts(frame)
+        if self.writer.is_closing():
+            raise ConnectionClosedOK(None, None)
+        self.writer.writelines([header, payload])
+        try:
+            await self.writer.drain()
+        except OSError:
+            raise ConnectionClosedError(None, None)
+
+    async def recv(self):
+        try:
+            header = await self.reader.readexactly(_frame_header_size)
+            size = int.from_bytes(header[:_length_size_bytes], _byteorder)
+            if size > self.max_size:
+                await self.close()
+                raise ConnectionClosedError(None, None)
+            payload = await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError as err:
+            if err.partial:
+                raise ConnectionClosedError(None, None)
+            raise ConnectionClosedOK(None, None)
+        except OSError:
+            raise ConnectionClosedError(None, None)
+        if header[-1] == _text:
+            return payload.decode("utf-8")
+        return payload
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+class AsyncSocketServer:
+    """
+    An asyncio TCP or Unix socket server whose close() also closes every
+    open connection, the way a websockets server's does. Without that,
+    wait_closed() would keep waiting on clients that are still connected.
+    """
+
+    def __init__(self, handler, scheme, address, max_size):
+        self.handler = handler
+        self.scheme = scheme
+        self.address = address
+        self.max_size = max_size
+        self.server = None
+        self.connections = set()
+
+    async def __aenter__(self):
+        if self.scheme == "tcp":
+            self.server = await asyncio.start_server(
+                self._handle, *self.address, limit=_recv_size
+            )
+        else:
+            _remove_stale_socket_file(self.address)
+            self.server = await asyncio.start_unix_server(
+                self._handle, self.address, limit=_recv_size
+            )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+        await self.wait_closed()
+
+    def close(self):
+        self.server.close()
+        for connection in self.connections:
+            connection.writer.close()
+        if self.scheme == "unix":
+            _remove_socket_file(self.address)
+
+    async def wait_closed(self):
+        await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        if self.scheme == "tcp":
+            _set_nodelay(writer.get_extra_info("socket"))
+        connection = AsyncSocketConnection(reader, writer, self.max_size)
+        self.connections.add(connection)
+        try:
+            await self.handler(connection)
+        finally:
+            self.connections.discard(connection)
+            await connection.close()
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _ThreadingUnixStreamServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self):
+        super().server_close()
+        _remove_socket_file(self.server_address)
+
+
+def _frame_parts(frame):
+    if isinstance(frame, str):
+        kind = _text
+        payload = frame.encode("utf-8")
+    else:
+        kind = _binary
+        payload = frame
+    header = len(payload).to_bytes(_length_size_bytes, _byteorder) + bytes([kind])
+    return header, payload
+
+
+def _open_socket(scheme, address):
+    if scheme == "tcp":
+        sock = socket.create_connection(address)
+        _set_nodelay(sock)
+        return sock
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+    except FileNotFoundError:
+        sock.close()
+        # No server has created the socket file yet.
+        raise ConnectionRefusedError(f"Nothing listening at unix://{address}")
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _set_nodelay(sock):
+    """
+    Frames are small and latency matters more than packet count,
+    so don't let Nagle's algorithm hold them back.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def _remove_stale_socket_file(path):
+    """
+    A server that was killed rather than shut down leaves its socket file
+    behind, and binding to the same path fails until it's removed.
+    Only remove it if there's no server still listening there.
+    """
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except ConnectionRefusedError:
+        _remove_socket_file(path)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+
+def _remove_socket_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass